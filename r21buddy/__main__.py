@@ -0,0 +1,8 @@
+"""Allows running the tools as "python -m r21buddy <command>"."""
+
+from __future__ import absolute_import
+
+import sys
+from r21buddy.cli import main
+
+sys.exit(main())
@@ -0,0 +1,167 @@
+"""Reading song packs straight out of .zip and .tar archives.
+
+Member data is read once, in archive order, as it is streamed out to
+the target.  Zip files have an index up front, so their song
+directories are known before anything is copied.  Tar files (which are
+often compressed) have none, so they are read in a single pass: the
+small .sm members are kept in memory as they go by, and their song
+directories are only known at the end of it.
+
+"""
+
+from __future__ import absolute_import
+
+import os, posixpath, zipfile, tarfile
+from cStringIO import StringIO
+from r21buddy import smfile
+
+
+def is_archive(path):
+    if not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def _decode_name(name):
+    if isinstance(name, unicode):
+        return name
+    try:
+        return name.decode("utf-8")
+    except UnicodeDecodeError:
+        # Zip's legacy default encoding.
+        return name.decode("cp437")
+
+
+class ArchiveSong(object):
+    def __init__(self, member_dir, members):
+        self.member_dir = member_dir  # Directory within the archive
+        self.members = members        # Member names to copy
+
+    @property
+    def name(self):
+        return posixpath.basename(self.member_dir)
+
+
+class SongArchive(object):
+
+    """A .zip or .tar file containing one or more song directories.
+
+    .sm members are kept in memory (they're small and we need them to
+    decide which audio to copy).  For zip files they are read up front,
+    so indexed is True and find_songs works straight away; for tar
+    files, the member list and .sm data are only complete once
+    iter_members has gone through the whole archive.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if zipfile.is_zipfile(path):
+            self.zip = zipfile.ZipFile(path)
+            self.tar = None
+        else:
+            self.zip = None
+            # Stream mode: one pass, no seeking back.
+            self.tar = tarfile.open(path, "r|*")
+        self.sizes = {}      # member name -> size, in archive order
+        self.order = []
+        self.sm_data = {}    # member name -> contents
+        self._index()
+
+    @property
+    def indexed(self):
+        return self.zip is not None
+
+    def _index(self):
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if info.filename.endswith("/"):
+                    continue
+                self._add(info.filename, info.file_size)
+            for name in self.order:
+                if name.lower().endswith(".sm"):
+                    self.sm_data[name] = self.zip.read(name)
+
+    def _add(self, name, size):
+        self.order.append(name)
+        self.sizes[name] = size
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+    def find_songs(self):
+        """Returns (songs, problems): a list of ArchiveSongs, and a list
+        of (member_dir, message) tuples for incompatible song
+        directories."""
+        by_dir = {}
+        for name in self.order:
+            by_dir.setdefault(posixpath.dirname(name), []).append(name)
+
+        songs = []
+        problems = []
+        for member_dir in sorted(by_dir):
+            files = by_dir[member_dir]
+            lower = [f.lower() for f in files]
+            if not any(f.endswith(".sm") or f.endswith(".dwi") for f in lower):
+                continue
+            if not any(f.endswith(".sm") for f in lower):
+                problems.append((member_dir, u"Could not find .sm; only .dwi was found."))
+                continue
+            if not any(f.endswith(".ogg") for f in lower):
+                if any(f.endswith(".mp3") for f in lower):
+                    problems.append((member_dir, u"Could not find .ogg; only .mp3 was found."))
+                else:
+                    problems.append((member_dir, u"Could not find .ogg."))
+                continue
+            sm_files = [f for f in files if f.lower().endswith(".sm")]
+            ogg_files = [f for f in files if f.lower().endswith(".ogg")]
+            music = [smfile.SmHeader(StringIO(self.sm_data[f])).music
+                     for f in sm_files]
+            songs.append(ArchiveSong(
+                member_dir, sm_files + smfile.match_audio(music, ogg_files)))
+        return songs, problems
+
+    def iter_members(self, names=None):
+        """Yields (name, size, fileobj) for the given members (or every
+        file, if names is None), in archive order.  Each fileobj must
+        be read before the next member is asked for."""
+        if names is not None:
+            names = set(names)
+        if self.zip is not None:
+            for name in self.order:
+                if names is None or name in names:
+                    yield name, self.sizes[name], self.zip.open(name)
+            return
+        for info in self.tar:
+            if not info.isfile():
+                continue
+            self._add(info.name, info.size)
+            if info.name.lower().endswith(".sm"):
+                # Kept for find_songs, which can only run at the end.
+                self.sm_data[info.name] = self.tar.extractfile(info).read()
+                if names is None or info.name in names:
+                    yield (info.name, info.size,
+                           StringIO(self.sm_data[info.name]))
+            elif names is None or info.name in names:
+                yield info.name, info.size, self.tar.extractfile(info)
+
+    def dest_name(self, name):
+        return _decode_name(posixpath.basename(name))
+
+    def song_name(self, song):
+        return self.dir_song_name(song.member_dir)
+
+    def dir_song_name(self, member_dir):
+        """Returns the name of the song a member directory would be."""
+        if member_dir == "":
+            # Song files at the top level of the archive; name the song
+            # after the archive itself.
+            name = os.path.basename(self.path)
+            for ext in (".zip", ".tar", ".tgz", ".gz", ".bz2"):
+                if name.lower().endswith(ext):
+                    name = name[:-len(ext)]
+            return _decode_name(name)
+        return _decode_name(posixpath.basename(member_dir))
@@ -0,0 +1,66 @@
+"""Shared memory budget for parallel workers.
+
+Patching a file that can't be handled from its final page alone means
+holding it in memory (see oggpatch.Patcher).  With several workers
+running, a MemoryBudget keeps the total of such in-flight bytes under
+a limit.  Workers reserve bytes before starting on a file and wait
+while the budget is used up.  Files too large to ever fit comfortably
+are meant to take a streaming path instead.
+
+"""
+
+from __future__ import absolute_import
+
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_LIMIT = 256 * 1024 * 1024
+
+
+class MemoryBudget(object):
+
+    def __init__(self, limit=DEFAULT_LIMIT):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak = 0
+        self.waits = 0  # Times a worker had to wait for room
+        self.cond = threading.Condition()
+
+    def fits(self, size):
+        """Returns whether a reservation of size bytes is reasonable.
+        Anything over half the limit would stall the other workers, so
+        should be streamed instead."""
+        return size <= self.limit // 2
+
+    def acquire(self, size):
+        """Blocks until size bytes are available, then reserves them."""
+        # Oversized requests are let through on their own rather than
+        # waiting forever.
+        size = min(size, self.limit)
+        with self.cond:
+            if self.in_flight + size > self.limit:
+                self.waits += 1
+                while self.in_flight + size > self.limit:
+                    self.cond.wait()
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+        return size
+
+    def release(self, size):
+        with self.cond:
+            self.in_flight -= size
+            self.cond.notify_all()
+
+    @contextmanager
+    def reserve(self, size):
+        size = self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def __str__(self):
+        mb = 1024.0 * 1024
+        return u"peak {0:.1f} MB of {1:.1f} MB in flight; waited {2} time(s)".format(
+            self.peak / mb, self.limit / mb, self.waits)
@@ -0,0 +1,294 @@
+"""SQLite catalog of a song library.
+
+Scanning reads only the .sm headers and the first and last pages of
+each .ogg file, using a pool of threads.  Rescans only look at files
+whose mtime or size changed since the last scan, so keeping the
+catalog current is cheap, and queries such as "songs over 1:45 which
+still need patching" don't need to touch the library at all.
+
+"""
+
+from __future__ import absolute_import
+
+import os, sys, time, argparse, sqlite3
+from multiprocessing.pool import ThreadPool
+from r21buddy import oggpatch, smfile
+from r21buddy.logger import logger
+
+
+CATALOG_NAME = u"r21buddy-catalog.db"
+SCAN_THREADS = 8
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    name TEXT,
+    title TEXT,
+    artist TEXT,
+    sm_path TEXT,
+    sm_mtime REAL,
+    sm_size INTEGER
+);
+CREATE TABLE IF NOT EXISTS audio (
+    id INTEGER PRIMARY KEY,
+    song_id INTEGER NOT NULL REFERENCES songs(id),
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL,
+    size INTEGER,
+    length REAL,
+    sample_rate INTEGER,
+    channels INTEGER,
+    title TEXT,
+    artist TEXT,
+    needs_patch INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS songs_title ON songs(title);
+CREATE INDEX IF NOT EXISTS songs_artist ON songs(artist);
+CREATE INDEX IF NOT EXISTS audio_song ON audio(song_id);
+CREATE INDEX IF NOT EXISTS audio_length ON audio(length);
+CREATE INDEX IF NOT EXISTS audio_needs_patch ON audio(needs_patch, length);
+"""
+
+
+def parse_time(s):
+    """Parses seconds given either as a number or as M:SS."""
+    if u":" in s:
+        minutes, seconds = s.split(u":", 1)
+        return int(minutes) * 60 + float(seconds)
+    return float(s)
+
+
+def find_song_dirs(root):
+    """Yields (song_dir, sm_files, ogg_files) for each directory under
+    root containing a .sm file."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        sm_files = [os.path.join(dirpath, f) for f in sorted(filenames)
+                    if f.lower().endswith(".sm")]
+        if len(sm_files) == 0:
+            continue
+        ogg_files = [os.path.join(dirpath, f) for f in sorted(filenames)
+                     if f.lower().endswith(".ogg")]
+        yield dirpath, sm_files, ogg_files
+
+
+def _stat(path):
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+def _scan_audio(path):
+    try:
+        return path, oggpatch.read_info(path), None
+    except (ValueError, IOError) as e:
+        return path, None, unicode(e)
+
+
+class ScanResult(object):
+    def __init__(self):
+        self.songs = 0
+        self.scanned = 0    # Audio files (re)read
+        self.unchanged = 0  # Audio files skipped as unchanged
+        self.removed = 0    # Catalog entries for vanished files
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return (u"{0} songs; {1} audio files scanned, {2} unchanged, "
+                u"{3} removed, {4} errors in {5:.1f}s".format(
+                    self.songs, self.scanned, self.unchanged, self.removed,
+                    self.errors, self.elapsed))
+
+
+class Catalog(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _song_id(self, song_dir, sm_files):
+        """Adds or refreshes a song row; returns its id."""
+        sm_file = sm_files[0]
+        mtime, size = _stat(sm_file)
+        row = self.db.execute(
+            "SELECT id, sm_path, sm_mtime, sm_size FROM songs WHERE path = ?",
+            (song_dir,)).fetchone()
+        if row is not None and (row["sm_path"], row["sm_mtime"], row["sm_size"]) \
+                == (sm_file, mtime, size):
+            return row["id"]
+        header = smfile.get_header(sm_file)
+        values = (os.path.basename(song_dir), header.title, header.artist,
+                  sm_file, mtime, size)
+        if row is None:
+            cur = self.db.execute(
+                "INSERT INTO songs (name, title, artist, sm_path, sm_mtime, "
+                "sm_size, path) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                values + (song_dir,))
+            return cur.lastrowid
+        self.db.execute(
+            "UPDATE songs SET name = ?, title = ?, artist = ?, sm_path = ?, "
+            "sm_mtime = ?, sm_size = ? WHERE id = ?", values + (row["id"],))
+        return row["id"]
+
+    def scan(self, roots, target_length=oggpatch.TARGET_LENGTH,
+             threads=SCAN_THREADS):
+        """Brings the catalog up to date with the song directories under
+        roots.  Returns a ScanResult."""
+        result = ScanResult()
+        start = time.time()
+        known = dict(
+            (row["path"], (row["mtime"], row["size"]))
+            for row in self.db.execute("SELECT path, mtime, size FROM audio"))
+        seen_songs = set()
+        seen_audio = set()
+        to_scan = {}  # audio path -> (song id, mtime, size)
+
+        for root in roots:
+            for song_dir, sm_files, ogg_files in find_song_dirs(root):
+                song_id = self._song_id(song_dir, sm_files)
+                seen_songs.add(song_dir)
+                result.songs += 1
+                for f in smfile.referenced_audio(sm_files, ogg_files):
+                    seen_audio.add(f)
+                    stat = _stat(f)
+                    if known.get(f) == stat:
+                        result.unchanged += 1
+                    else:
+                        to_scan[f] = (song_id,) + stat
+
+        pool = ThreadPool(threads)
+        try:
+            for path, info, error in pool.imap_unordered(
+                    _scan_audio, list(to_scan)):
+                song_id, mtime, size = to_scan[path]
+                result.scanned += 1
+                if info is None:
+                    result.errors += 1
+                    values = (song_id, mtime, size, None, None, None, None,
+                              None, 1, error)
+                else:
+                    values = (song_id, mtime, size, info.length,
+                              info.sample_rate, info.channels, info.title,
+                              info.artist, int(info.length > target_length),
+                              None)
+                self.db.execute(
+                    "INSERT OR REPLACE INTO audio (song_id, mtime, size, "
+                    "length, sample_rate, channels, title, artist, "
+                    "needs_patch, error, path) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    values + (path,))
+        finally:
+            pool.close()
+            pool.join()
+
+        # Forget anything under the scanned roots which has gone away.
+        for path in set(known) - seen_audio:
+            if any(_under(path, root) for root in roots):
+                self.db.execute("DELETE FROM audio WHERE path = ?", (path,))
+                result.removed += 1
+        for row in self.db.execute("SELECT id, path FROM songs").fetchall():
+            if row["path"] not in seen_songs and any(
+                    _under(row["path"], root) for root in roots):
+                self.db.execute("DELETE FROM audio WHERE song_id = ?", (row["id"],))
+                self.db.execute("DELETE FROM songs WHERE id = ?", (row["id"],))
+        self.db.commit()
+        result.elapsed = time.time() - start
+        return result
+
+    def query(self, min_length=None, max_length=None, needs_patch=None,
+              title=None, artist=None):
+        """Returns catalog rows (one per audio file) matching all of the
+        given criteria.  title and artist are substring matches against
+        either the .sm or the Vorbis comments."""
+        clauses = []
+        params = []
+        if min_length is not None:
+            clauses.append("audio.length > ?")
+            params.append(min_length)
+        if max_length is not None:
+            clauses.append("audio.length <= ?")
+            params.append(max_length)
+        if needs_patch is not None:
+            clauses.append("audio.needs_patch = ?")
+            params.append(int(needs_patch))
+        for column, value in (("title", title), ("artist", artist)):
+            if value is not None:
+                clauses.append("(songs.{0} LIKE ? OR audio.{0} LIKE ?)".format(column))
+                params.extend([u"%{0}%".format(value)] * 2)
+        sql = ("SELECT songs.path AS song_dir, audio.path AS path, "
+               "COALESCE(songs.title, audio.title) AS title, "
+               "COALESCE(songs.artist, audio.artist) AS artist, "
+               "audio.length, audio.sample_rate, audio.channels, audio.size, "
+               "audio.needs_patch, audio.error "
+               "FROM audio JOIN songs ON audio.song_id = songs.id")
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY songs.path, audio.path"
+        return self.db.execute(sql, params).fetchall()
+
+
+def _under(path, root):
+    root = os.path.join(root, u"")
+    return path.startswith(root) or path == root[:-1]
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Catalog a song library for quick queries.")
+    ap.add_argument("-c", "--catalog", default=CATALOG_NAME,
+                    help="Catalog database file.  (Default: %(default)s)")
+    sub = ap.add_subparsers(dest="command")
+    scan = sub.add_parser("scan", help="Add or refresh library paths.")
+    scan.add_argument("paths", nargs="+", help="Library path(s).")
+    scan.add_argument("-j", "--threads", type=int, default=SCAN_THREADS,
+                      help="Scanning threads.  (Default: %(default)s)")
+    query = sub.add_parser("query", help="List matching songs.")
+    query.add_argument("--longer-than", type=parse_time, metavar="TIME",
+                       help="Only songs longer than TIME (seconds or M:SS).")
+    query.add_argument("--shorter-than", type=parse_time, metavar="TIME",
+                       help="Only songs no longer than TIME.")
+    query.add_argument("--unpatched", dest="needs_patch", action="store_const",
+                       const=True, help="Only songs still needing a patch.")
+    query.add_argument("--patched", dest="needs_patch", action="store_const",
+                       const=False, help="Only songs not needing a patch.")
+    query.add_argument("--title", help="Title contains this text.")
+    query.add_argument("--artist", help="Artist contains this text.")
+    return ap.parse_args()
+
+
+def main():
+    options = parse_args()
+    catalog = Catalog(options.catalog)
+    try:
+        if options.command == "scan":
+            paths = [os.path.abspath(p.decode(sys.getfilesystemencoding()))
+                     for p in options.paths]
+            logger.info(unicode(catalog.scan(paths, threads=options.threads)))
+        else:
+            rows = catalog.query(
+                min_length=options.longer_than, max_length=options.shorter_than,
+                needs_patch=options.needs_patch, title=options.title,
+                artist=options.artist)
+            for row in rows:
+                if row["length"] is None:
+                    length = u"?"
+                else:
+                    length = oggpatch.pprint_time(row["length"])
+                logger.info(u"{0:>8}  {1}  {2} - {3}  ({4})".format(
+                    length, u"patch" if row["needs_patch"] else u"ok   ",
+                    row["artist"] or u"?", row["title"] or u"?", row["path"]))
+            logger.info(u"{0} file(s)".format(len(rows)))
+    finally:
+        catalog.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
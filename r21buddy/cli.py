@@ -0,0 +1,144 @@
+"""Single entry point for the r21buddy tools.
+
+Usage: r21buddy <command> [arguments]
+
+Commands:
+  patch   Patch .ogg files to the R21 length limit (see "patch -h")
+  check   Check .ogg file lengths without changing them
+  sync    Copy songs to a R21-compatible directory (see "sync -h")
+  audit   Check every .ogg file under the given directories
+  gui     Start a GUI: "gui sync" (default) or "gui patch"
+  serve   Take requests over a local socket (see "serve -h")
+
+Only the modules needed by the chosen command are imported, so that
+scripted calls (e.g. "check" on a single file) start quickly.
+
+"""
+
+from __future__ import absolute_import
+
+import sys
+
+
+COMMANDS = ("patch", "check", "sync", "audit", "gui", "serve")
+
+
+def usage(out=sys.stdout):
+    out.write("\n\n".join(__doc__.split("\n\n")[1:3]) + "\n")
+
+
+def _run_module_main(module, command, args):
+    # The tools' own argument parsers read sys.argv; make their usage
+    # messages name the subcommand.
+    sys.argv = [u"r21buddy {0}".format(command)] + args
+    return module.main()
+
+
+def _simple_files(args):
+    """Returns args if they're all plain file names, else None."""
+    for arg in args:
+        if arg.startswith("-") or arg.startswith("@") or \
+                any(c in arg for c in "*?["):
+            return None
+    return args
+
+
+def check(args):
+    files = _simple_files(args)
+    if files is None or len(files) == 0:
+        from r21buddy import oggpatch
+        return _run_module_main(oggpatch, "check", ["--check"] + args)
+    # Fast path: skip argument parsing altogether.
+    from r21buddy.oggpatch import Patcher
+    patcher = Patcher()
+    status = 0
+    for f in files:
+        result = patcher.check(f)
+        if not result.ok:
+            print >> sys.stderr, unicode(result).encode("utf-8")
+            status = 1
+        else:
+            print unicode(result).encode("utf-8")
+            if result.needs_patch and status == 0:
+                status = 2
+    return status
+
+
+def patch(args):
+    from r21buddy import oggpatch
+    return _run_module_main(oggpatch, "patch", args)
+
+
+def sync(args):
+    from r21buddy import r21buddy
+    return _run_module_main(r21buddy, "sync", args)
+
+
+def audit(args):
+    """Checks all .ogg files below the given directories, listing only
+    those with problems unless -v is given."""
+    verbose = "-v" in args
+    dirs = [a for a in args if a != "-v"]
+    if len(dirs) == 0:
+        sys.stderr.write("Usage: r21buddy audit [-v] <dir> [<dir> ...]\n")
+        return 1
+    from r21buddy.oggpatch import Patcher, walk_ogg_files
+    patcher = Patcher()
+    counts = {"ok": 0, "long": 0, "error": 0}
+    for f in walk_ogg_files(dirs):
+        result = patcher.check(f)
+        if not result.ok:
+            counts["error"] += 1
+        elif result.needs_patch:
+            counts["long"] += 1
+        else:
+            counts["ok"] += 1
+            if not verbose and len(result.skipped) == 0:
+                continue
+        print unicode(result).encode("utf-8")
+    print "{0} ok, {1} too long, {2} unreadable".format(
+        counts["ok"], counts["long"], counts["error"])
+    if counts["error"] > 0:
+        return 1
+    if counts["long"] > 0:
+        return 2
+    return 0
+
+
+def gui(args):
+    which = args[0] if len(args) > 0 else "sync"
+    if which == "sync":
+        from r21buddy import r21buddy_gui as module
+    elif which == "patch":
+        from r21buddy import oggpatch_gui as module
+    else:
+        sys.stderr.write("Unknown GUI: {0} (use sync or patch)\n".format(which))
+        return 1
+    return module.main()
+
+
+def serve(args):
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        sys.stderr.write("Serve mode needs Unix domain sockets, which this platform lacks.\n")
+        return 1
+    from r21buddy import server
+    return _run_module_main(server, "serve", args)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        usage()
+        return 0 if len(argv) > 0 else 1
+    command, args = argv[0], argv[1:]
+    if command not in COMMANDS:
+        sys.stderr.write("Unknown command: {0}\n\n".format(command))
+        usage(sys.stderr)
+        return 1
+    return globals()[command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""File copying tuned for slow flash drives.
+
+Thumb drives are usually FAT32, where lots of small writes are slow
+and files written bit by bit while other files are also growing end up
+fragmented.  The Copier here:
+
+- preallocates each destination file to its final size before writing
+  (where the filesystem supports it natively), so the filesystem can
+  hand out one contiguous run of clusters,
+- writes in large blocks, optionally auto-tuning the block size to
+  whatever gives the best throughput on the target,
+- lets the kernel do the copying (sendfile) on Linux when the data
+  doesn't need to pass through Python,
+- writes one file at a time, start to finish.
+
+"""
+
+from __future__ import absolute_import
+
+import os, sys, time, errno, ctypes, ctypes.util
+
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+MIN_BLOCK_SIZE = 256 * 1024
+MAX_BLOCK_SIZE = 32 * 1024 * 1024
+# Minimum amount of copying, in blocks, to measure each block size over.
+TUNE_SAMPLE_BLOCKS = 4
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        libc.fallocate64.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        libc.fallocate64.restype = ctypes.c_int
+        libc.sendfile64.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+            ctypes.c_size_t]
+        libc.sendfile64.restype = ctypes.c_ssize_t
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+# From linux/falloc.h: allocate without changing the file size.
+FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def preallocate(outfile, size):
+    """Reserves size bytes for outfile, if the filesystem can do so
+    natively; otherwise does nothing.
+
+    Only fallocate(2) is used.  posix_fallocate and extending with
+    truncate both zero-fill where there's no native support (as on
+    vfat), which would write every byte twice.  The space is reserved
+    without changing the file size, so the file only grows as it is
+    written.
+
+    """
+    if size <= 0 or _libc is None:
+        return
+    outfile.flush()
+    if _libc.fallocate64(outfile.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) == 0:
+        return
+    err = ctypes.get_errno()
+    if err in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+        return
+    raise OSError(err, os.strerror(err))
+
+
+def _sendfile(out_fd, in_fd, offset, count):
+    """Returns the number of bytes copied, or None if sendfile isn't
+    usable for these files."""
+    pos = ctypes.c_int64(offset)
+    result = _libc.sendfile64(out_fd, in_fd, ctypes.byref(pos), count)
+    if result < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            return None
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class CopyResult(object):
+    def __init__(self, path, size, elapsed, method):
+        self.path = path
+        self.size = size
+        self.elapsed = elapsed
+        self.method = method  # "sendfile" or "read/write"
+
+    @property
+    def rate(self):
+        """Bytes per second."""
+        return self.size / max(self.elapsed, 1e-6)
+
+    def __str__(self):
+        return u"{0:.1f} MB/s ({1})".format(
+            self.rate / (1024.0 * 1024), self.method)
+
+
+class Copier(object):
+
+    """Copies files one at a time.
+
+    If block_size is None, it is auto-tuned: starting from
+    DEFAULT_BLOCK_SIZE, it is doubled or halved between files for as
+    long as that improves throughput.  Song files are often smaller
+    than a block, so throughput is measured over several files at a
+    time: each block size is tried for at least TUNE_SAMPLE_BLOCKS
+    blocks' worth of copying.
+
+    """
+
+    def __init__(self, block_size=None, use_sendfile=True):
+        self.auto = block_size is None
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+        self.use_sendfile = use_sendfile and _libc is not None
+        self._best = None   # (block size, rate) of the best so far
+        self._step = 2
+        self._sample_size = 0
+        self._sample_time = 0.0
+
+    def _tune(self, result):
+        if not self.auto:
+            return
+        self._sample_size += result.size
+        self._sample_time += result.elapsed
+        if self._sample_size < self.block_size * TUNE_SAMPLE_BLOCKS:
+            return
+        rate = self._sample_size / max(self._sample_time, 1e-6)
+        self._sample_size = 0
+        self._sample_time = 0.0
+        if self._best is None or rate > self._best[1] * 1.05:
+            self._best = (self.block_size, rate)
+        elif self._step != 1:
+            # Got worse; go back and try the other direction once.
+            self._step = 0.5 if self._step == 2 else 1
+            self.block_size = self._best[0]
+        new_size = int(self.block_size * self._step)
+        self.block_size = max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, new_size))
+
+    def copy(self, src_file, dest_file, progress=None, cancel=None):
+        """Copies src_file to dest_file and returns a CopyResult."""
+        size = os.path.getsize(src_file)
+        with open(src_file, "rb") as infile:
+            return self._copy(infile, dest_file, size, progress, cancel,
+                              self.use_sendfile)
+
+    def copy_stream(self, infile, dest_file, size, progress=None, cancel=None):
+        """Like copy, but reads from a file-like object of known size
+        (e.g. an archive member)."""
+        return self._copy(infile, dest_file, size, progress, cancel, False)
+
+    def _copy(self, infile, dest_file, size, progress, cancel, use_sendfile):
+        start = time.time()
+        method = "read/write"
+        with open(dest_file, "wb") as outfile:
+            preallocate(outfile, size)
+            done = 0
+            if use_sendfile:
+                method = "sendfile"
+                while done < size:
+                    if cancel is not None:
+                        cancel.check()
+                    count = _sendfile(outfile.fileno(), infile.fileno(),
+                                      done, min(self.block_size, size - done))
+                    if count is None:
+                        method = "read/write"
+                        infile.seek(done)
+                        outfile.seek(done)
+                        break
+                    if count == 0:
+                        break
+                    done += count
+                    if progress is not None:
+                        progress.add_bytes(count)
+            if method == "read/write":
+                while True:
+                    if cancel is not None:
+                        cancel.check()
+                    chunk = infile.read(self.block_size)
+                    if len(chunk) == 0:
+                        break
+                    outfile.write(chunk)
+                    done += len(chunk)
+                    if progress is not None:
+                        progress.add_bytes(len(chunk))
+            if done != size:
+                # Source changed size under us; release any space
+                # preallocated past the end.
+                outfile.truncate(done)
+        result = CopyResult(dest_file, done, time.time() - start, method)
+        self._tune(result)
+        return result
@@ -1,7 +1,7 @@
 # Author: Paul Goins
 # License (this module only): PUBLIC DOMAIN
 
-import sys
+import sys, struct, zlib
 
 def get_bits(message):
     """Yields bits of message in MSB to LSB order"""
@@ -32,16 +32,52 @@ def bit_by_bit(message, poly=0x04c11db7, width=32, init=0):
 
     return reg
 
+def make_table(poly=0x04c11db7):
+    table = []
+    for i in xrange(256):
+        reg = i << 24
+        for j in xrange(8):
+            if reg & 0x80000000:
+                reg = ((reg << 1) ^ poly) & 0xFFFFFFFF
+            else:
+                reg = (reg << 1) & 0xFFFFFFFF
+        table.append(reg)
+    return table
+
+TABLE = make_table()
+
 def direct_table_with_padding(message):
-    return 0
+    # Same as bit_by_bit, but a byte at a time.
+    reg = 0
+    for char in message + chr(0)*4:
+        top = reg >> 24
+        reg = (((reg << 8) & 0xFFFFFFFF) | ord(char)) ^ TABLE[top]
+    return reg
 
 def direct_table(message):
-    return 0
+    # Feeds message bytes into the top of the register, so no padding
+    # is needed.
+    reg = 0
+    for char in message:
+        reg = ((reg << 8) & 0xFFFFFFFF) ^ TABLE[(reg >> 24) ^ ord(char)]
+    return reg
+
+# zlib's crc32 uses the same polynomial, but bit-reversed ("reflected")
+# and with the register inverted before and after.  Reversing the bits
+# of each input byte and of the result, and cancelling out the
+# inversions, gives the Ogg CRC at C speed.
+_REVERSED_BYTES = "".join(
+    chr(int("{0:08b}".format(i)[::-1], 2)) for i in xrange(256))
+
+def fast(message):
+    reg = ~zlib.crc32(message.translate(_REVERSED_BYTES), 0xFFFFFFFF)
+    reg = struct.pack("<I", reg & 0xFFFFFFFF).translate(_REVERSED_BYTES)
+    return struct.unpack(">I", reg)[0]
 
 
 def main():
     message = "123456789"
-    for method in bit_by_bit, direct_table_with_padding, direct_table:
+    for method in bit_by_bit, direct_table_with_padding, direct_table, fast:
         crc = method(message)
         print "{0:50s}: {1:08X}".format(str(method), crc)
 
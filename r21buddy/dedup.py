@@ -0,0 +1,176 @@
+"""Content-addressed deduplication of song audio.
+
+Song packs frequently reuse the same .ogg in several song directories.
+Rather than copying and patching each of these separately, the first
+copy is patched and every later duplicate is linked to it (if the
+target filesystem supports it) or written straight from the patched
+bytes.
+
+"""
+
+from __future__ import absolute_import
+
+import os, hashlib, shutil
+from r21buddy import oggpatch
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows
+
+
+HASH_CHUNK_SIZE = 1024 * 1024
+MEMORY_CACHE_SIZE = 64 * 1024 * 1024  # Max bytes of patched audio kept in memory
+
+FICLONE = 0x40049409  # Linux reflink ioctl: _IOW(0x94, 9, int)
+
+# Digest cache: path -> (size, mtime, digest)
+_digest_cache = {}
+
+
+def file_digest(path, data=None):
+    """Returns the SHA-1 digest of a file.
+
+    Results are cached by size and mtime, so unchanged files are only
+    read once per process.  If the file's contents are already in
+    memory, they may be passed via data to avoid re-reading the file.
+
+    """
+    st = os.stat(path)
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+        return cached[2]
+    h = hashlib.sha1()
+    if data is not None:
+        h.update(data)
+    else:
+        with open(path, "rb") as infile:
+            while True:
+                chunk = infile.read(HASH_CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+    digest = h.hexdigest()
+    _digest_cache[path] = (st.st_size, st.st_mtime, digest)
+    return digest
+
+
+def _cached_digest(path, st):
+    cached = _digest_cache.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime):
+        return cached[2]
+    return None
+
+
+def reflink(src, dest):
+    """Attempts a copy-on-write clone of src to dest.  Returns whether
+    it succeeded."""
+    if fcntl is None:
+        return False
+    try:
+        infile = open(src, "rb")
+    except IOError:
+        return False
+    with infile:
+        with open(dest, "wb") as outfile:
+            try:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                return True
+            except (IOError, OSError):
+                pass
+    os.remove(dest)
+    return False
+
+
+def hardlink(src, dest):
+    link = getattr(os, "link", None)
+    if link is None:
+        return False
+    try:
+        link(src, dest)
+        return True
+    except OSError:
+        return False
+
+
+class AudioIndex(object):
+
+    """Tracks which target file holds the (patched) copy of each
+    unique piece of source audio."""
+
+    def __init__(self, length_patch=True,
+                 target_length=oggpatch.TARGET_LENGTH, verbose=False,
+                 memory_cache_size=MEMORY_CACHE_SIZE):
+        self.length_patch = length_patch
+        self.target_length = target_length
+        self.verbose = verbose
+        self.memory_cache_size = memory_cache_size
+        self.targets = {}      # digest -> first target file
+        self.sizes = set()     # sizes of all source files seen so far
+        self.memory = {}       # digest -> patched bytes
+        self.memory_used = 0
+        self.handled = set()   # target files which are already patched
+
+    def copy(self, src, dest):
+        """Copies src to dest, patching it if needed.
+
+        Returns a short description of how the file was produced:
+        "copied", "hardlink", "reflink", "memory" or "disk".
+
+        """
+        st = os.stat(src)
+        digest = _cached_digest(src, st)
+        data = None
+        if digest is None:
+            if st.st_size in self.sizes:
+                digest = file_digest(src)
+            else:
+                # Can't be a duplicate of anything seen so far; read it
+                # once for both hashing and copying.
+                with open(src, "rb") as infile:
+                    data = infile.read()
+                digest = file_digest(src, data=data)
+        self.sizes.add(st.st_size)
+
+        existing = self.targets.get(digest)
+        if existing is not None and not os.path.isfile(existing):
+            # Removed since (e.g. overwritten in watch mode); this copy
+            # takes its place.
+            self._forget(digest)
+            existing = None
+        if existing is None:
+            self._copy_unique(src, dest, digest, data)
+            method = "copied"
+        elif hardlink(existing, dest):
+            method = "hardlink"
+        elif reflink(existing, dest):
+            method = "reflink"
+        elif digest in self.memory:
+            with open(dest, "wb") as outfile:
+                outfile.write(self.memory[digest])
+            method = "memory"
+        else:
+            shutil.copyfile(existing, dest)
+            method = "disk"
+        self.handled.add(dest)
+        return method
+
+    def _forget(self, digest):
+        self.handled.discard(self.targets.pop(digest))
+        data = self.memory.pop(digest, None)
+        if data is not None:
+            self.memory_used -= len(data)
+
+    def _copy_unique(self, src, dest, digest, data):
+        if data is None:
+            with open(src, "rb") as infile:
+                data = infile.read()
+        if self.length_patch:
+            data = oggpatch.patch_data(data, self.target_length,
+                                       verbose=self.verbose)
+        with open(dest, "wb") as outfile:
+            outfile.write(data)
+        self.targets[digest] = dest
+        if self.memory_used + len(data) <= self.memory_cache_size:
+            self.memory[digest] = data
+            self.memory_used += len(data)
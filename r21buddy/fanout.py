@@ -0,0 +1,150 @@
+"""Writes the same song files to several target directories at once.
+
+Each target gets its own writer thread fed through a bounded buffer.
+Source files are read (and patched) once by the caller and handed to
+all writers; a slow target can only fall behind by as much as its
+buffer allows before the caller waits for it.
+
+"""
+
+from __future__ import absolute_import
+
+import os, threading, traceback
+
+
+BUFFER_SIZE = 32 * 1024 * 1024  # Max bytes queued per target
+
+
+class TargetResult(object):
+    def __init__(self, target_dir):
+        self.target_dir = target_dir
+        self.songs = 0
+        self.files = 0
+        self.bytes = 0
+        self.errors = []   # Per-song problems; the target keeps going
+        self.failure = None  # Set if the target stopped accepting writes
+        self.written = set()  # Paths of all files written
+
+    @property
+    def ok(self):
+        return self.failure is None and len(self.errors) == 0
+
+    def __str__(self):
+        status = "OK"
+        if self.failure is not None:
+            status = "FAILED"
+        elif len(self.errors) > 0:
+            status = "{0} error(s)".format(len(self.errors))
+        return u"{0}: {1} songs, {2} files, {3:.1f} MB written [{4}]".format(
+            self.target_dir, self.songs, self.files,
+            self.bytes / (1024.0 * 1024), status)
+
+
+class TargetWriter(threading.Thread):
+
+    def __init__(self, target_dir, buffer_size=BUFFER_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.song_root = os.path.join(target_dir, u"In The Groove 2", u"Songs")
+        self.buffer_size = buffer_size
+        self.result = TargetResult(target_dir)
+        self.items = []
+        self.buffered = 0
+        self.cond = threading.Condition()
+
+    def put(self, item, size=0):
+        """Queues an item, waiting while the buffer is full.
+
+        An item larger than the whole buffer is still accepted once the
+        buffer has drained, so huge files can't deadlock the writer.
+
+        """
+        with self.cond:
+            while (self.buffered > 0
+                   and self.buffered + size > self.buffer_size
+                   and self.result.failure is None):
+                self.cond.wait()
+            if self.result.failure is not None:
+                return  # Dead target; drop everything.
+            self.items.append((item, size))
+            self.buffered += size
+            self.cond.notify_all()
+
+    def _get(self):
+        with self.cond:
+            while len(self.items) == 0:
+                self.cond.wait()
+            return self.items[0]
+
+    def _done(self, size):
+        with self.cond:
+            self.items.pop(0)
+            self.buffered -= size
+            self.cond.notify_all()
+
+    def run(self):
+        skip_song = False
+        while True:
+            item, size = self._get()
+            try:
+                if item is None:
+                    return
+                if item[0] == "song":
+                    song_dir = os.path.join(self.song_root, item[1])
+                    if os.path.exists(song_dir):
+                        self.result.errors.append(
+                            u"{0} already exists; not copying files.".format(song_dir))
+                        skip_song = True
+                    else:
+                        os.makedirs(song_dir)
+                        self.result.songs += 1
+                        skip_song = False
+                elif item[0] == "file" and not skip_song:
+                    path = os.path.join(self.song_root, item[1], item[2])
+                    with open(path, "wb") as outfile:
+                        outfile.write(item[3])
+                    self.result.files += 1
+                    self.result.bytes += len(item[3])
+                    self.result.written.add(path)
+            except Exception:
+                # Whatever went wrong, mark the target failed so that
+                # put() drops items from now on instead of waiting for
+                # a writer which is gone.
+                with self.cond:
+                    self.result.failure = traceback.format_exc()
+                    self.items = []
+                    self.buffered = 0
+                    self.cond.notify_all()
+                return
+            finally:
+                if self.result.failure is None:
+                    self._done(size)
+
+
+class FanoutWriter(object):
+
+    """Distributes song directories and files to several targets."""
+
+    def __init__(self, target_dirs, buffer_size=BUFFER_SIZE):
+        self.writers = [TargetWriter(t, buffer_size=buffer_size)
+                        for t in target_dirs]
+        for writer in self.writers:
+            writer.start()
+
+    def add_song(self, song_dir_name):
+        for writer in self.writers:
+            writer.put(("song", song_dir_name))
+
+    def add_file(self, song_dir_name, file_name, data):
+        for writer in self.writers:
+            writer.put(("file", song_dir_name, file_name, data),
+                       size=len(data))
+
+    def close(self):
+        """Waits for all writers to finish.  Returns a list of
+        TargetResult objects, one per target."""
+        for writer in self.writers:
+            writer.put(None)
+        for writer in self.writers:
+            writer.join()
+        return [writer.result for writer in self.writers]
@@ -0,0 +1,192 @@
+"""Patching in supervised worker processes.
+
+A damaged .ogg file can hang the parser or eat all available memory,
+and with it a whole batch run.  In isolated mode each file is patched
+by a separate worker process, which is killed if it takes longer than
+a timeout; on platforms with the resource module, its address space is
+capped as well.  Files which fail are quarantined and retried once at
+the end of the run; any still failing are written to a report.
+
+"""
+
+from __future__ import absolute_import
+
+import os, io, threading, multiprocessing
+from r21buddy import oggpatch
+from r21buddy.budget import MemoryBudget
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows: timeouts only
+
+
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MEMORY_LIMIT = 512 * 1024 * 1024
+QUARANTINE_NAME = u"r21buddy-quarantine.txt"
+
+
+class WorkerError(Exception):
+    """A failure inside, or of, a worker process."""
+
+
+def _limit_memory(limit):
+    if resource is None or limit is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _worker_main(conn, target_length, memory_limit):
+    _limit_memory(memory_limit)
+    # Stream anything which wouldn't comfortably fit under the cap.
+    budget = None
+    if memory_limit is not None:
+        budget = MemoryBudget(memory_limit // 2)
+    patcher = oggpatch.Patcher(target_length=target_length, budget=budget)
+    while True:
+        try:
+            path = conn.recv()
+        except EOFError:
+            return
+        if path is None:
+            return
+        result = patcher.patch(path)
+        if result.error is not None:
+            # Exceptions don't all survive pickling.
+            if isinstance(result.error, MemoryError):
+                result.error = WorkerError(u"Exceeded the memory limit")
+            else:
+                result.error = WorkerError(u"{0}: {1}".format(
+                    type(result.error).__name__, result.error))
+        conn.send(result)
+
+
+class IsolatedPatcher(object):
+
+    """Patches files in a worker process, one at a time.
+
+    Has the same patch() method as oggpatch.Patcher.  The worker is
+    started on first use and replaced after a timeout or crash.
+
+    """
+
+    def __init__(self, target_length=oggpatch.TARGET_LENGTH,
+                 timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.target_length = target_length
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.process = None
+        self.conn = None
+
+    def _start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker_main,
+            args=(child_conn, self.target_length, self.memory_limit))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def _kill(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        self.process = self.conn = None
+
+    def patch(self, path):
+        """Patches path in place.  Returns a PatchResult; timeouts and
+        crashes are reported as its error."""
+        if self.process is None or not self.process.is_alive():
+            self._start()
+        try:
+            self.conn.send(path)
+            if self.conn.poll(self.timeout):
+                return self.conn.recv()
+            error = WorkerError(u"Timed out after {0:g}s".format(self.timeout))
+        except (EOFError, IOError):
+            # poll() also returns once the worker has died.
+            self.process.join(1)
+            error = WorkerError(u"Worker died (exit code {0})".format(
+                self.process.exitcode))
+        self._kill()
+        return oggpatch.PatchResult(path, error=error)
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join(1)
+        self._kill()
+
+
+class Supervisor(object):
+
+    """Worker processes and quarantine for one batch run.
+
+    Workers are handed out with checkout() and returned with checkin(),
+    so they are reused across the songs of a run.
+
+    """
+
+    def __init__(self, target_length=oggpatch.TARGET_LENGTH,
+                 timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT):
+        self.target_length = target_length
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.idle = []
+        self.quarantined = []   # PatchResults awaiting a retry
+        self.failed = []        # (first, retry) PatchResults of files failing twice
+        self.lock = threading.Lock()
+
+    def checkout(self):
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        return IsolatedPatcher(self.target_length, timeout=self.timeout,
+                               memory_limit=self.memory_limit)
+
+    def checkin(self, patcher):
+        with self.lock:
+            self.idle.append(patcher)
+
+    def quarantine(self, result):
+        with self.lock:
+            self.quarantined.append(result)
+
+    def retry(self):
+        """Retries each quarantined file once.  Yields a PatchResult
+        for each; failures are kept for the report."""
+        patcher = self.checkout()
+        try:
+            while len(self.quarantined) > 0:
+                first = self.quarantined.pop(0)
+                if not os.path.exists(first.path):
+                    result = first  # Nothing left to retry
+                else:
+                    result = patcher.patch(first.path)
+                if not result.ok:
+                    self.failed.append((first, result))
+                yield result
+        finally:
+            self.checkin(patcher)
+
+    def write_report(self, path):
+        """Writes the files which failed twice to path, one per line
+        with both errors."""
+        with io.open(path, "w", encoding="utf-8") as outfile:
+            for first, second in self.failed:
+                outfile.write(u"{0}\t{1}\t{2}\n".format(
+                    first.path, first.error, second.error))
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for patcher in idle:
+            patcher.close()
@@ -0,0 +1,153 @@
+"""Write-ahead journal of a batch run, for resuming interrupted runs.
+
+The journal lives in the target directory and is a plain text file
+with one JSON record per line.  Songs to be copied are recorded
+("planned") as they are found, and each batch of planned songs is
+flushed to disk before any of them is copied; afterwards each song
+moves through the copied, patched and verified states (or is marked
+skipped), each of which is flushed to disk before the corresponding
+work continues.  So after
+a crash or a pulled USB stick the journal tells exactly which songs
+are done and which need to be redone.
+
+"""
+
+from __future__ import absolute_import
+
+import os, json
+
+
+JOURNAL_NAME = u"r21buddy-journal.txt"
+
+PLANNED = "planned"
+COPIED = "copied"
+PATCHED = "patched"
+VERIFIED = "verified"
+FAILED = "failed"
+SKIPPED = "skipped"     # Not copied on purpose (e.g. broken audio); not retried
+
+# Later states imply the earlier ones.
+STATE_ORDER = [PLANNED, COPIED, PATCHED, VERIFIED]
+
+# Planned songs written per fsync.  On FAT sticks every fsync costs a
+# FAT and directory entry update, so they're not done per song.
+SYNC_BATCH = 100
+
+
+class SongEntry(object):
+    def __init__(self, name, source, files):
+        self.name = name
+        self.source = source
+        self.files = files
+        self.state = PLANNED
+
+    @property
+    def done(self):
+        return self.state in (VERIFIED, SKIPPED)
+
+    def reached(self, state):
+        """Returns whether this song got at least as far as state."""
+        if self.state not in STATE_ORDER:
+            return False
+        return STATE_ORDER.index(self.state) >= STATE_ORDER.index(state)
+
+    def __repr__(self):
+        return "<SongEntry {0!r} state:{1}>".format(self.name, self.state)
+
+
+class Journal(object):
+
+    def __init__(self, target_dir):
+        self.path = os.path.join(target_dir, JOURNAL_NAME)
+        self.songs = []     # SongEntry objects, in plan order
+        self.by_name = {}
+        self.complete = False
+        self.all_planned = True     # Journals from before "planning" existed
+        self.outfile = None
+
+    def load(self):
+        """Reads an existing journal.  Returns False if there is none."""
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, "rb") as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Truncated final record from an interrupted write.
+                    break
+                self._apply(record)
+        return True
+
+    def _apply(self, record):
+        op = record["op"]
+        if op == PLANNED:
+            entry = SongEntry(record["song"], record["source"],
+                              record["files"])
+            self.songs.append(entry)
+            self.by_name[entry.name] = entry
+        elif op == "planning":
+            self.all_planned = False
+        elif op == "planned_all":
+            self.all_planned = True
+        elif op == "complete":
+            self.complete = True
+        else:
+            self.by_name[record["song"]].state = op
+
+    def _write(self, record, sync=True):
+        if self.outfile is None:
+            self.outfile = open(self.path, "ab")
+        self.outfile.write(json.dumps(record) + "\n")
+        if sync:
+            self.sync()
+        self._apply(record)
+
+    def sync(self):
+        """Makes sure everything written so far is on disk."""
+        if self.outfile is not None:
+            self.outfile.flush()
+            os.fsync(self.outfile.fileno())
+
+    def start(self):
+        """Starts a new journal, discarding any previous one."""
+        self.close()
+        self.outfile = open(self.path, "wb")
+        self.songs = []
+        self.by_name = {}
+        self.complete = False
+        self._write({"op": "planning"}, sync=False)
+
+    def plan(self, name, source, files, sync=True):
+        """Records a song to copy.  With sync=False, the record is only
+        buffered; call sync() before copying the song.  Paths are
+        stored absolute, so that --resume works from any directory."""
+        self._write({"op": PLANNED, "song": name,
+                     "source": os.path.abspath(source),
+                     "files": [os.path.abspath(f) for f in files]},
+                    sync=sync)
+        return self.by_name[name]
+
+    def finish_planning(self):
+        """Records that every song to copy has been planned."""
+        self._write({"op": "planned_all"})
+
+    def record(self, name, state):
+        self._write({"op": state, "song": name})
+
+    def finish(self):
+        self._write({"op": "complete"})
+        self.close()
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+    @property
+    def pending(self):
+        return [song for song in self.songs if not song.done]
+
+    @property
+    def skipped(self):
+        return [song for song in self.songs if song.state == SKIPPED]
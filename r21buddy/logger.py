@@ -13,6 +13,14 @@ class StdoutStderrLogger(object):
         print >> sys.stderr, msg
 
 
+class StderrLogger(StdoutStderrLogger):
+
+    """For when stdout is being used for data, e.g. in pipes."""
+
+    def info(self, msg):
+        print >> sys.stderr, msg
+
+
 class ThreadQueueLogger(object):
 
     """Logger for use between monitor and worker threads."""
@@ -0,0 +1,132 @@
+"""Log window widget for the GUIs.
+
+A plain Text widget gets slower and slower as a long run pours
+thousands of lines into it.  LogView keeps only the most recent lines,
+inserts everything received in one poll with a single call, and only
+scrolls to the end every so often (and once more when output stops).  Optionally the full, untrimmed log
+can be written to a file as well.
+
+"""
+
+from __future__ import absolute_import
+
+import time, codecs
+import Tkinter
+
+
+MAX_LINES = 2000      # Lines kept in the window
+SCROLL_INTERVAL = 0.5  # Min. seconds between auto-scrolls
+
+
+class LogView(object):
+
+    def __init__(self, parent, text=None, max_lines=MAX_LINES, height=10):
+        if text is None:
+            self.frame = Tkinter.Frame(parent)
+        else:
+            self.frame = Tkinter.LabelFrame(parent, text=text)
+        # Note: using really small width since we'll auto-expand.
+        self.text = Tkinter.Text(self.frame, width=1, height=height,
+                                 state=Tkinter.DISABLED)
+        self.text.pack(side=Tkinter.LEFT, fill=Tkinter.BOTH, expand=True)
+        scroll = Tkinter.Scrollbar(self.frame)
+        scroll.pack(side=Tkinter.RIGHT, fill=Tkinter.Y)
+        self.text.configure(yscrollcommand=scroll.set)
+        scroll.configure(command=self._on_scrollbar)
+        # Other ways the user can scroll.
+        for event in ("<MouseWheel>", "<Button-4>", "<Button-5>",
+                      "<Prior>", "<Next>", "<Up>", "<Down>",
+                      "<Control-Home>", "<Control-End>"):
+            self.text.bind(event, self._on_user_scroll, add="+")
+
+        self.max_lines = max_lines
+        self.line_count = 0
+        self.last_scroll = 0
+        self.following = True   # Keep the end of the log in view
+        self.pending_scroll = None
+        self.spill_file = None
+
+    def pack(self, *args, **kwargs):
+        self.frame.pack(*args, **kwargs)
+
+    def grid(self, *args, **kwargs):
+        self.frame.grid(*args, **kwargs)
+
+    def open_spill_file(self, path):
+        """Starts writing the full log to path, in addition to the
+        window."""
+        self.close_spill_file()
+        self.spill_file = codecs.open(path, "a", encoding="utf-8")
+
+    def close_spill_file(self):
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+
+    def append(self, msg):
+        """Appends text to the log.  Intended to be called once per
+        poll with everything that arrived since the last one."""
+        if len(msg) == 0:
+            return
+        if self.spill_file is not None:
+            self.spill_file.write(msg)
+
+        # No point inserting more than we'd keep.
+        lines = msg.count(u"\n")
+        if lines > self.max_lines:
+            cut = len(msg)
+            for i in xrange(self.max_lines + 1):
+                cut = msg.rfind(u"\n", 0, cut)
+            msg = msg[cut+1:]
+            lines = self.max_lines
+
+        self.text.configure(state=Tkinter.NORMAL)
+        self.text.insert(Tkinter.END, msg)
+        self.line_count += lines
+        excess = self.line_count - self.max_lines
+        if excess > 0:
+            self.text.delete("1.0", "{0}.0".format(excess + 1))
+            self.line_count -= excess
+        self.text.configure(state=Tkinter.DISABLED)
+
+        if not self.following or self.pending_scroll is not None:
+            return
+        wait = self.last_scroll + SCROLL_INTERVAL - time.time()
+        if wait <= 0:
+            self._scroll()
+        else:
+            # Make sure the last lines come into view even if nothing
+            # else arrives.
+            self.pending_scroll = self.text.after(int(wait * 1000) + 1,
+                                                  self._scroll)
+
+    def _scroll(self):
+        self.pending_scroll = None
+        if self.following:
+            self.text.see(Tkinter.END)
+            self.last_scroll = time.time()
+
+    def _on_scrollbar(self, *args):
+        self.text.yview(*args)
+        self._update_following()
+
+    def _on_user_scroll(self, event):
+        # The view only moves once the default binding has run.
+        self.text.after_idle(self._update_following)
+
+    def _update_following(self):
+        # Only follow the end of the log if the user hasn't scrolled
+        # up to read something.
+        self.following = self.text.yview()[1] >= 1.0
+
+    def flush(self):
+        """Scrolls to the end and flushes the spill file; call when a
+        run has finished."""
+        if self.pending_scroll is not None:
+            self.text.after_cancel(self.pending_scroll)
+            self.pending_scroll = None
+        self.following = True
+        self.text.see(Tkinter.END)
+        self.last_scroll = time.time()
+        if self.spill_file is not None:
+            self.spill_file.flush()
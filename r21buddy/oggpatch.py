@@ -43,10 +43,11 @@ CRC checksum used for Ogg:
 
 from __future__ import absolute_import
 
-import sys, argparse
+import os, sys, itertools
+from contextlib import contextmanager
 from cStringIO import StringIO
 from r21buddy import crc
-from r21buddy.logger import logger
+from r21buddy.logger import logger, StderrLogger
 
 
 TARGET_LENGTH = 105  # Default length to patch
@@ -64,6 +65,9 @@ class NoMorePages(Exception):
     pass
 class NoMoreBitstreams(Exception):
     pass
+class NoOggData(ValueError):
+    def __init__(self):
+        ValueError.__init__(self, "No valid Ogg pages found")
 class UnexpectedContinuedPacket(Exception):
     pass
 class InvalidFramingBit(Exception):
@@ -88,6 +92,13 @@ class OggPage(object):
 
         self.raw = static_header + seg_table + payload
 
+    @classmethod
+    def from_raw(cls, raw):
+        """Wraps a complete page already in memory, without copying."""
+        page = cls.__new__(cls)
+        page.raw = raw
+        return page
+
     @property
     def capture_pattern(self):
         return self.raw[:4]
@@ -129,9 +140,21 @@ class OggPage(object):
         payload_index = 27 + self.segments
         return self.raw[payload_index:]
     def get_segment(self, i):
-        payload_index = 27 + self.segments
-        segment_index = payload_index + sum(self.seg_table[:i])
-        return self.raw[segment_index:segment_index+self.seg_table[i]]
+        offsets = self.segment_offsets
+        return self.raw[offsets[i]:offsets[i+1]]
+    @property
+    def segment_offsets(self):
+        """Offsets of each segment within raw, plus the end offset.
+        Worked out once per page."""
+        offsets = self.__dict__.get("_segment_offsets")
+        if offsets is None:
+            pos = 27 + self.segments
+            offsets = [pos]
+            for seg_len in bytearray(self.raw[27:pos]):
+                pos += seg_len
+                offsets.append(pos)
+            self._segment_offsets = offsets
+        return offsets
     def get_data_without_crc(self):
         return "".join([self.raw[:22], chr(0) * 4, self.raw[26:]])
     def get_data_with_new_length(self, granulepos):
@@ -148,7 +171,7 @@ class OggPage(object):
                         self.raw[14:22],
                         chr(0) * 4,
                         self.raw[26:]])
-        checksum = crc.bit_by_bit(data)
+        checksum = crc.fast(data)
         return "".join([self.raw[:6],
                         int_to_bytes(granulepos, 8),
                         self.raw[14:22],
@@ -185,43 +208,76 @@ Ogg Page:
         return "<OggPage FirstPage:{0:5s} LastPage:{1:5s} ContinuedPacket:{2:5s}>".format(str(self.first_page), str(self.last_page), str(self.continued_packet))
 
 
-class VorbisBitStream(object):
-    def __init__(self, pages):
+def iter_packets(pages, join=False):
+    """Generates the packets of a bitstream from pages, until a last
+    page marker is found.
+
+    Each packet is a list of memoryviews over the raw data of the pages
+    it is on (usually just one), so nothing is copied.  Pass join=True
+    to get each packet as a string instead.
+
+    """
+    spans = []
+    for i, page in enumerate(pages):
+        if page.continued_packet and len(spans) == 0:
+            if i == 0:
+                raise UnexpectedContinuedPacket()
+            # The start of this packet was on a damaged page which got
+            # skipped.
+            logger.error(u"WARNING: Packet continued from a missing page, ignoring.")
+        raw = page.raw
+        view = raw if join else memoryview(raw)
+        offsets = page.segment_offsets
+        start = offsets[0]
+        for j in xrange(len(offsets) - 1):
+            end = offsets[j+1]
+            if end - offsets[j] < 255:
+                spans.append(view[start:end])
+                yield "".join(spans) if join else spans
+                spans = []
+                start = end
+        if start < offsets[-1]:
+            spans.append(view[start:offsets[-1]])
+        if page.last_page:
+            break
+    if len(spans) > 0:
+        # I *think* the patch should still work - the patch operates on
+        # the page level, but this error is at the underlying packet; it
+        # shouldn't matter.
+        logger.error(u"WARNING: Unterminated packet detected, ignoring.")
+
+def check_framing(pages):
+    """Like iter_packets, logs packets continued from missing pages and
+    unterminated packets, but without assembling any packets."""
+    open_packet = False
+    for page in pages:
+        if page.continued_packet and not open_packet:
+            logger.error(u"WARNING: Packet continued from a missing page, ignoring.")
+        segments = page.segments
+        if segments > 0:
+            open_packet = ord(page.raw[26 + segments]) == 255
+        if page.last_page:
+            break
+    if open_packet:
+        logger.error(u"WARNING: Unterminated packet detected, ignoring.")
 
-        def get_packets(pages):
-            """Generates packets from pages until a last page marker is found."""
-            data = []
-            for i, page in enumerate(pages):
-                #print "{0:4d}".format(i), page
-                if page.continued_packet and len(data) == 0:
-                    raise UnexpectedContinuedPacket()
-
-                for j in xrange(page.segments):
-                    segment = page.get_segment(j)
-                    data.append(segment)
-                    if page.seg_table[j] < 255:
-                        yield "".join(data)
-                        data = []
-
-                if page.last_page:
-                    break
-            if len(data) > 0:
-                # I *think* the patch should still work - the patch
-                # operates on the page level, but this error is at the
-                # underlying packet; it shouldn't matter.
-                logger.error(u"WARNING: Unterminated packet detected, ignoring.")
 
+class VorbisBitStream(object):
+    def __init__(self, pages):
         self.pages = list(pages)  # Needed to recreate stream with updated final page
+        if len(self.pages) == 0:
+            raise NoMoreBitstreams
+        if self.pages[0].continued_packet:
+            raise UnexpectedContinuedPacket()
 
-        packet_gen = get_packets(self.pages)
+        # Only the ID header is needed; the rest is checked a page at a
+        # time.
         try:
-            first_packet = packet_gen.next()
+            first_packet = next(iter_packets(self.pages, join=True))
         except StopIteration:
             raise NoMoreBitstreams
-
         self.id_header = IdHeader(first_packet)
-        for packet in packet_gen:
-            pass
+        check_framing(self.pages)
 
         # Here's how we -really- would decode a vorbis packet stream:
         # # 1. Pull headers
@@ -418,12 +474,94 @@ class SetupHeader(VorbisHeader):
         return "<SetupHeader raw:%s>" % (repr(self.raw),)
 
 
+SCAN_BLOCK_SIZE = 64 * 1024
+
+def page_crc_ok(raw):
+    return crc.fast("".join([raw[:22], chr(0) * 4, raw[26:]])) == _int(raw[22:26])
+
+class PageScanner(object):
+
+    """Iterates over the valid pages in a file.
+
+    Anything which isn't a page with a correct checksum (junk or ID3
+    tags before the first page, damaged pages, trailing garbage) is
+    skipped by searching ahead for the next capture pattern.  The
+    skipped byte ranges are listed in .skipped as (start, end) offsets.
+    .page_offset is the file offset of the page last yielded.
+
+    """
+
+    def __init__(self, infile, block_size=SCAN_BLOCK_SIZE):
+        self.infile = infile
+        self.block_size = block_size
+        self.skipped = []
+        self.buf = ""
+        self.start = 0      # Position of unconsumed data within buf
+        self.offset = 0     # File offset of buf[0]
+        self.eof = False
+        self.page_offset = None
+
+    def _fill(self):
+        """Reads another block; returns False at EOF."""
+        if self.eof:
+            return False
+        data = self.infile.read(self.block_size)
+        if len(data) == 0:
+            self.eof = True
+            return False
+        self.offset += self.start
+        self.buf = self.buf[self.start:] + data
+        self.start = 0
+        return True
+
+    def _skip(self, count):
+        start = self.offset + self.start
+        if len(self.skipped) > 0 and self.skipped[-1][1] == start:
+            self.skipped[-1] = (self.skipped[-1][0], start + count)
+        else:
+            self.skipped.append((start, start + count))
+        self.start += count
+
+    def __iter__(self):
+        while True:
+            pos = self.buf.find("OggS", self.start)
+            if pos < 0:
+                # Keep a few bytes in case the pattern straddles blocks.
+                keep = min(3, len(self.buf) - self.start)
+                if len(self.buf) - self.start > keep:
+                    self._skip(len(self.buf) - self.start - keep)
+                if not self._fill():
+                    if len(self.buf) > self.start:
+                        self._skip(len(self.buf) - self.start)
+                    return
+                continue
+            if pos > self.start:
+                self._skip(pos - self.start)
+            size = _page_size(self.buf, self.start)
+            if size is None:
+                if self._fill():
+                    continue
+                # Runs past the end of the file: either a truncated
+                # final page, or a damaged header overstating its size
+                # with valid pages still to come.
+                self._skip(1)
+                continue
+            raw = self.buf[self.start:self.start+size]
+            if raw[4] != chr(0) or not page_crc_ok(raw):
+                # Not really a page; look for the next one.
+                self._skip(1)
+                continue
+            self.page_offset = self.offset + self.start
+            self.start += size
+            yield OggPage.from_raw(raw)
+
 def _get_pages(infile):
-    while True:
-        try:
-            yield OggPage(infile)
-        except NoMorePages:
-            break
+    return iter(PageScanner(infile))
+
+def report_skipped(scanner):
+    for start, end in scanner.skipped:
+        logger.error(u"WARNING: Skipped {0} bytes of invalid data at offset {1}.".format(
+            end - start, start))
 
 def _get_bitstreams(pages):
     while True:
@@ -436,16 +574,153 @@ def get_bitstreams(infile):
     page_gen = _get_pages(infile)
     return _get_bitstreams(page_gen)
 
+# Max size of an Ogg page: 27 byte header, 255 byte segment table and
+# 255 segments of 255 bytes each.
+MAX_PAGE_SIZE = 27 + 255 + 255*255
+
+def _first_packet(page):
+    """Returns the first packet on a page (assuming it doesn't span
+    pages, which is true of the Vorbis ID header)."""
+    length = 0
+    for seg_len in page.seg_table:
+        length += seg_len
+        if seg_len < 255:
+            break
+    return page.payload[:length]
+
+def _page_size(data, pos):
+    """Returns the size of the page starting at data[pos:], or None if
+    the page is incomplete."""
+    header_end = pos + 27
+    if header_end > len(data):
+        return None
+    segments = ord(data[header_end-1])
+    if header_end + segments > len(data):
+        return None
+    size = 27 + segments + sum(bytearray(data[header_end:header_end+segments]))
+    if pos + size > len(data):
+        return None
+    return size
+
+def find_last_page(infile):
+    """Locates the final page of an Ogg file by reading only its tail.
+
+    Returns (offset, OggPage), or None if no page could be found.
+
+    """
+    infile.seek(0, 2)
+    file_size = infile.tell()
+    start = max(0, file_size - MAX_PAGE_SIZE)
+    infile.seek(start)
+    tail = infile.read()
+    fallback = None
+    pos = tail.rfind("OggS")
+    while pos >= 0:
+        size = _page_size(tail, pos)
+        if size is not None and page_crc_ok(tail[pos:pos+size]):
+            page = OggPage(StringIO(tail[pos:pos+size]))
+            if pos + size == len(tail):
+                return start + pos, page
+            elif fallback is None and page.last_page:
+                # Trailing junk after the final page.
+                fallback = (start + pos, page)
+        pos = tail.rfind("OggS", 0, pos)
+    return fallback
+
+def read_length(input_file):
+    """Returns a file's length in seconds, reading only the first and
+    last pages rather than the whole file.
+
+    Raises ValueError if the length can't be determined this way.
+
+    """
+    with open(input_file, "rb") as infile:
+        try:
+            id_header = IdHeader(_first_packet(next(iter(PageScanner(infile)))))
+        except (StopIteration, IndexError):
+            raise ValueError("No ID header found", input_file)
+        last = find_last_page(infile)
+    if last is None:
+        raise ValueError("Could not find final page", input_file)
+    if id_header.audio_sample_rate == 0:
+        raise ValueError("Bad sample rate", input_file)
+    return float(last[1].granule_pos) / id_header.audio_sample_rate
+
+class OggInfo(object):
+    def __init__(self, id_header, comments_header, length):
+        self.length = length
+        self.sample_rate = id_header.audio_sample_rate
+        self.channels = id_header.audio_channels
+        self.comments = {}
+        if comments_header is not None:
+            for s in comments_header.user_strings:
+                key, sep, value = s.partition(u"=")
+                if sep:
+                    self.comments.setdefault(key.upper(), value)
+
+    @property
+    def title(self):
+        return self.comments.get(u"TITLE")
+
+    @property
+    def artist(self):
+        return self.comments.get(u"ARTIST")
+
+def _read_header_packets(infile, count):
+    """Returns the first count packets of a stream, reading no more
+    pages than needed."""
+    pages = PageScanner(infile, block_size=8192)
+    return list(itertools.islice(iter_packets(pages, join=True), count))
+
+def read_info(input_file):
+    """Returns an OggInfo with the length, audio format and comments of
+    a file, reading only its header and final pages.
+
+    Raises ValueError if the file can't be read this way.
+
+    """
+    with open(input_file, "rb") as infile:
+        try:
+            packets = _read_header_packets(infile, 2)
+            id_header = IdHeader(packets[0])
+        except (IndexError, UnexpectedContinuedPacket):
+            raise ValueError("No ID header found", input_file)
+        try:
+            comments_header = CommentsHeader(packets[1])
+        except (ValueError, IndexError, InvalidFramingBit, UnicodeDecodeError):
+            comments_header = None
+        last = find_last_page(infile)
+    if last is None:
+        raise ValueError("Could not find final page", input_file)
+    if id_header.audio_sample_rate == 0:
+        raise ValueError("Bad sample rate", input_file)
+    length = float(last[1].granule_pos) / id_header.audio_sample_rate
+    return OggInfo(id_header, comments_header, length)
+
 def parse_args():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("input_file", help="Input file.")
+    # Imported here to keep startup fast for scripted use; see
+    # r21buddy.cli.
+    import argparse
+    ap = argparse.ArgumentParser(
+        epilog=("Exit status is 0 if all files are OK, 1 if any file could "
+                "not be read or patched, and 2 if --check found files which "
+                "are too long."))
+    ap.add_argument("input_files", nargs="+", metavar="input_file",
+                    help=("Input file(s).  Wildcards are expanded, and "
+                          "@FILE reads a list of files (one per line) from "
+                          "FILE.  A single - reads from stdin; a second - "
+                          "after one input writes to stdout, like -o -."))
     ap.add_argument("-o", "--output-file",
-                    help="Output file.  (Default: overwrite input file)")
+                    help=("Output file, or - for stdout; only with a single "
+                          "input file.  (Default: overwrite input file; "
+                          "stdout if reading from stdin)"))
     ap.add_argument("-c", "--check", action="store_true",
                     help="Check length only; do not modify file")
+    ap.add_argument("-j", "--jobs", type=int, default=1,
+                    help="Number of files to work on at once.  (Default: %(default)s)")
     ap.add_argument("-v", "--verbose", action="store_true",
                     help="Verbose output")
-    ap.add_argument("-l", "--length", default=TARGET_LENGTH,
+    ap.add_argument("-l", "--length", type=int, default=TARGET_LENGTH,
                     help="Desired max length to patch into the input file.  (Default: %(default)s)")
     return ap.parse_args()
 
@@ -456,22 +731,32 @@ def pprint_time(t):
     return "{0:d}:{1:05.2f}".format(int(mins), secs)
 
 
+def _patch_bitstreams(bitstreams, target_length, verbose=True):
+    """Patches the final bitstream if needed.  Returns whether it was."""
+    if len(bitstreams) == 0:
+        raise NoOggData()
+    for bitstream in bitstreams:
+        length = bitstream.get_length()
+    if verbose:
+        logger.info(u"Current file length: {0}".format(pprint_time(length)))
+        logger.info(u"Target file length:  {0}".format(pprint_time(target_length)))
+    if length > target_length:
+        bitstream.patch_length(target_length, verbose=verbose)
+        return True
+    return False
+
 def patch_file(input_file, target_length=TARGET_LENGTH,
                output_file=None, verbose=True):
+    """Patches a file.  Returns whether a patch was needed."""
     patched = False
     if target_length < 0:
         logger.error(u"Bad length ({0}), not patching file".format(target_length))
-        return
+        return False
     with open(input_file, "rb") as infile:
-        bitstreams = list(get_bitstreams(infile))
-        for bitstream in bitstreams:
-            length = bitstream.get_length()
-        if verbose:
-            logger.info(u"Current file length: {0}".format(pprint_time(length)))
-            logger.info(u"Target file length:  {0}".format(pprint_time(target_length)))
-        if length > target_length:
-            patched = True
-            bitstream.patch_length(target_length, verbose=verbose)
+        scanner = PageScanner(infile)
+        bitstreams = list(_get_bitstreams(iter(scanner)))
+        report_skipped(scanner)
+        patched = _patch_bitstreams(bitstreams, target_length, verbose=verbose)
     if patched:
         if output_file is None:
             output_file = input_file
@@ -483,6 +768,87 @@ def patch_file(input_file, target_length=TARGET_LENGTH,
     elif verbose:
         logger.info(u"Not patching file; file already appears to be {0} or shorter.".format(
             pprint_time(target_length)))
+    return patched
+
+def patch_data(data, target_length=TARGET_LENGTH, verbose=True):
+    """Like patch_file, but operates on an in-memory copy of a file.
+
+    Returns the patched data, or the original data if no patch was
+    needed.
+
+    """
+    if target_length < 0:
+        logger.error(u"Bad length ({0}), not patching file".format(target_length))
+        return data
+    scanner = PageScanner(StringIO(data))
+    bitstreams = list(_get_bitstreams(iter(scanner)))
+    report_skipped(scanner)
+    if not _patch_bitstreams(bitstreams, target_length, verbose=verbose):
+        return data
+    outfile = StringIO()
+    for bitstream in bitstreams:
+        bitstream.write_to_file(outfile)
+    return outfile.getvalue()
+
+def _copy_pages(scanner, outfile):
+    """Copies all but the final page from a PageScanner to outfile (if
+    not None).  Returns (sample_rate, final_page)."""
+    sample_rate = None
+    prev = None
+    for page in scanner:
+        if page.first_page:
+            sample_rate = IdHeader(_first_packet(page)).audio_sample_rate
+        if prev is not None and outfile is not None:
+            outfile.write(prev.raw)
+        prev = page
+    if prev is None:
+        raise NoOggData()
+    if sample_rate is None:
+        raise ValueError("No beginning-of-stream page found")
+    return sample_rate, prev
+
+def _check_final_page(scanner, page):
+    """Refuses to patch page as the final one if damaged data follows
+    it: the real final page may be in there, and patching an earlier
+    one would leave the file with a granule position that goes back."""
+    if page.last_page:
+        return
+    for start, end in scanner.skipped:
+        if start > scanner.page_offset:
+            raise ValueError("Damaged data after the last intact page; not patching")
+
+def patch_stream(infile, outfile, target_length=TARGET_LENGTH, verbose=True):
+    """Copies an Ogg stream from infile to outfile, patching its length
+    on the way through.
+
+    Unlike patch_file, the input is never held in memory as a whole:
+    pages are written out as soon as the next page has been read, so
+    at most two pages are in memory at once.  Returns whether a patch
+    was applied.
+
+    """
+    if target_length < 0:
+        logger.error(u"Bad length ({0}), not patching file".format(target_length))
+        target_length = None
+    scanner = PageScanner(infile)
+    sample_rate, prev = _copy_pages(scanner, outfile)
+    report_skipped(scanner)
+
+    patched = False
+    length = float(prev.granule_pos) / sample_rate
+    if verbose:
+        logger.info(u"Current file length: {0}".format(pprint_time(length)))
+        if target_length is not None:
+            logger.info(u"Target file length:  {0}".format(pprint_time(target_length)))
+    if target_length is not None and length > target_length:
+        new_granule_pos = sample_rate * target_length
+        if verbose:
+            logger.info(u"Current granule position: {0}".format(prev.granule_pos))
+            logger.info(u"New granule position:     {0}".format(new_granule_pos))
+        prev = OggPage(StringIO(prev.get_data_with_new_length(new_granule_pos)))
+        patched = True
+    outfile.write(prev.raw)
+    return patched
 
 def check_file(input_file, target_length, verbose=True):
     if target_length < 0:
@@ -507,20 +873,387 @@ def check_file(input_file, target_length, verbose=True):
 
     return True
 
+def check_stream(infile, target_length, verbose=True):
+    """Like check_file, but for a non-seekable stream such as stdin."""
+    scanner = PageScanner(infile)
+    sample_rate, last = _copy_pages(scanner, None)
+    report_skipped(scanner)
+    length = float(last.granule_pos) / sample_rate
+    if verbose:
+        logger.info(u"Current file length: {0}".format(pprint_time(length)))
+        logger.info(u"Target file length:  {0}".format(pprint_time(target_length)))
+    if length > target_length:
+        logger.error(u"File exceeds {0}.  Length: {1}".format(
+            pprint_time(target_length), pprint_time(length)))
+        return False
+    if verbose:
+        logger.info(u"File passes length check.")
+    return True
+
+class PatchResult(object):
+    def __init__(self, path, length=None, needs_patch=False, patched=False,
+                 method=None, skipped=(), error=None):
+        self.path = path
+        self.length = length            # Length before patching
+        self.needs_patch = needs_patch
+        self.patched = patched
+        self.method = method            # "tail", "full", "streaming" or None
+        self.skipped = list(skipped)    # Byte ranges of invalid data
+        self.error = error              # Exception, if the file failed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.error is not None:
+            status = u"ERROR: {0}".format(self.error)
+        elif self.patched:
+            status = u"patched from {0}".format(pprint_time(self.length))
+        elif self.needs_patch:
+            status = u"too long ({0})".format(pprint_time(self.length))
+        else:
+            status = u"ok ({0})".format(pprint_time(self.length))
+        if len(self.skipped) > 0:
+            status += u", {0} bytes of invalid data".format(
+                sum(end - start for start, end in self.skipped))
+        return u"{0}: {1}".format(self.path, status)
+
+
+class Patcher(object):
+
+    """A patching session for many files.
+
+    Configuration and the logger are held here rather than in module
+    globals, so several sessions (e.g. one per GUI job) can coexist.
+    Where possible, files are checked and patched using only their
+    first and last pages, with the final page rewritten in place; files
+    which can't be handled that way (junk at the start, no clean final
+    page) fall back to a full parse.
+
+    If a budget.MemoryBudget is given (shared between the Patchers of
+    parallel workers), in-memory work is reserved against it first, and
+    files too large for it are rewritten via a temporary file instead.
+
+    """
+
+    # Bytes held while working from the first and last pages, or while
+    # streaming.
+    PAGE_COST = 2 * MAX_PAGE_SIZE
+
+    def __init__(self, target_length=TARGET_LENGTH, logger=None,
+                 verbose=False, budget=None):
+        if target_length < 0:
+            raise ValueError("Bad length", target_length)
+        self.target_length = target_length
+        self.logger = logger if logger is not None else get_logger()
+        self.verbose = verbose
+        self.budget = budget
+        self._out = StringIO()  # Reused for full rewrites
+
+    def _reserve(self, size):
+        if self.budget is None:
+            return _no_reservation()
+        return self.budget.reserve(size)
+
+    def _read_ends(self, infile):
+        """Returns (sample_rate, last_page_offset, last_page), or None
+        if the file doesn't start and end with clean pages."""
+        scanner = PageScanner(infile, block_size=8192)
+        first = next(iter(scanner), None)
+        if first is None or len(scanner.skipped) > 0 or not first.first_page:
+            return None
+        sample_rate = IdHeader(_first_packet(first)).audio_sample_rate
+        last = find_last_page(infile)
+        if sample_rate == 0 or last is None:
+            return None
+        offset, page = last
+        if offset + len(page.raw) != infile.tell():
+            return None  # Trailing junk
+        return sample_rate, offset, page
+
+    def check(self, path):
+        """Returns a PatchResult describing path, without changing it."""
+        result = PatchResult(path)
+        try:
+            with open(path, "rb") as infile:
+                ends = self._read_ends(infile)
+                if ends is not None:
+                    sample_rate, offset, page = ends
+                    result.method = "tail"
+                else:
+                    infile.seek(0)
+                    scanner = PageScanner(infile)
+                    sample_rate, page = _copy_pages(scanner, None)
+                    result.skipped = scanner.skipped
+                    result.method = "full"
+            result.length = float(page.granule_pos) / sample_rate
+            result.needs_patch = result.length > self.target_length
+        except Exception as e:
+            result.error = e
+        return result
+
+    def patch(self, path, output_file=None):
+        """Patches path (in place, unless output_file is given) if it
+        is too long.  Returns a PatchResult."""
+        result = PatchResult(path)
+        try:
+            if output_file is None:
+                with self._reserve(self.PAGE_COST):
+                    self._patch_tail(result)
+            if result.method is None:
+                # The file and its rewritten copy are both in memory.
+                cost = 2 * os.path.getsize(path)
+                if self.budget is not None and not self.budget.fits(cost):
+                    with self._reserve(self.PAGE_COST):
+                        self._patch_streaming(result, output_file)
+                else:
+                    with self._reserve(cost):
+                        self._patch_full(result, output_file)
+        except Exception as e:
+            result.error = e
+        if self.verbose:
+            self.logger.info(unicode(result))
+        return result
+
+    def patch_many(self, paths):
+        """Patches each path in place, yielding a PatchResult for each.
+        Failures are reported in the results rather than raised."""
+        for path in paths:
+            yield self.patch(path)
+
+    def _new_granule_pos(self, sample_rate):
+        return int(sample_rate * self.target_length)
+
+    def _patch_tail(self, result):
+        with open(result.path, "r+b") as f:
+            ends = self._read_ends(f)
+            if ends is None:
+                return
+            sample_rate, offset, page = ends
+            result.method = "tail"
+            result.length = float(page.granule_pos) / sample_rate
+            result.needs_patch = result.length > self.target_length
+            if result.needs_patch:
+                f.seek(offset)
+                f.write(page.get_data_with_new_length(
+                    self._new_granule_pos(sample_rate)))
+                result.patched = True
+
+    def _patch_full(self, result, output_file):
+        result.method = "full"
+        out = self._out
+        try:
+            with open(result.path, "rb") as infile:
+                scanner = PageScanner(infile)
+                sample_rate, page = _copy_pages(scanner, out)
+            result.skipped = scanner.skipped
+            result.length = float(page.granule_pos) / sample_rate
+            result.needs_patch = result.length > self.target_length
+            if result.needs_patch:
+                _check_final_page(scanner, page)
+                page = OggPage(StringIO(page.get_data_with_new_length(
+                    self._new_granule_pos(sample_rate))))
+                result.patched = True
+            elif output_file is None:
+                return
+            out.write(page.raw)
+            with open(output_file or result.path, "wb") as outfile:
+                outfile.write(out.getvalue())
+        finally:
+            # Don't hang on to the data once the budget is released.
+            out.seek(0)
+            out.truncate()
+
+    def _patch_streaming(self, result, output_file):
+        """Like _patch_full, but writes pages to a temporary file as
+        they're read, rather than holding the file in memory."""
+        result.method = "streaming"
+        dest = output_file or result.path
+        temp = dest + u".r21tmp"
+        try:
+            with open(result.path, "rb") as infile:
+                with open(temp, "wb") as outfile:
+                    scanner = PageScanner(infile)
+                    sample_rate, page = _copy_pages(scanner, outfile)
+                    result.skipped = scanner.skipped
+                    result.length = float(page.granule_pos) / sample_rate
+                    result.needs_patch = result.length > self.target_length
+                    if result.needs_patch:
+                        _check_final_page(scanner, page)
+                        page = OggPage(StringIO(page.get_data_with_new_length(
+                            self._new_granule_pos(sample_rate))))
+                        result.patched = True
+                    outfile.write(page.raw)
+            if result.patched or output_file is not None:
+                if os.path.exists(dest) and sys.platform == "win32":
+                    os.remove(dest)  # No atomic replace on Windows
+                os.rename(temp, dest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+
+@contextmanager
+def _no_reservation():
+    yield
+
+def get_logger():
+    return logger
+
 def set_logger(_logger):
     """Used for calling this module's logic via GUIs."""
     # Yes, a bit kludgy, but it works...
     global logger
     logger = _logger
 
+def _binary_stdio(f):
+    if sys.platform == "win32":
+        import msvcrt
+        msvcrt.setmode(f.fileno(), os.O_BINARY)
+    return f
+
+def expand_inputs(args):
+    """Expands wildcards and @listfiles into a list of file names."""
+    import glob
+    files = []
+    for arg in args:
+        if arg.startswith("@"):
+            with open(arg[1:], "rb") as listfile:
+                for line in listfile:
+                    line = line.strip()
+                    if len(line) > 0 and not line.startswith("#"):
+                        files.append(line)
+        elif any(c in arg for c in "*?["):
+            matches = sorted(glob.glob(arg))
+            if len(matches) == 0:
+                # Let it fail like any other missing file.
+                matches = [arg]
+            files.extend(matches)
+        else:
+            files.append(arg)
+    return files
+
+def walk_ogg_files(dirs):
+    """Yields the .ogg files below each of dirs, in sorted order."""
+    for d in dirs:
+        for dirpath, dirnames, filenames in os.walk(d):
+            dirnames.sort()
+            for f in sorted(filenames):
+                if f.lower().endswith(".ogg"):
+                    yield os.path.join(dirpath, f)
+
 def main():
     options = parse_args()
-    if options.check:
-        check_file(options.input_file, options.length, verbose=options.verbose)
+    if len(options.input_files) == 2 and options.input_files[1] == "-" \
+            and options.output_file is None:
+        # "in -" is shorthand for "in -o -"; "-" can't be one of several
+        # inputs, so this is unambiguous.
+        options.input_files = options.input_files[:1]
+        options.output_file = "-"
+    if options.input_files == ["-"] or options.output_file == "-":
+        if len(options.input_files) > 1:
+            logger.error(u"- can only be used with a single input file.")
+            return 1
+        options.input_file = options.input_files[0]
+        return pipe_main(options)
+
+    files = expand_inputs(options.input_files)
+    if options.output_file is not None and len(files) != 1:
+        logger.error(u"--output-file can only be used with a single input file.")
+        return 1
+    if options.length < 0:
+        logger.error(u"Bad length ({0}), not patching files".format(options.length))
+        return 1
+
+    import threading
+    local = threading.local()
+    budget = None
+    if options.jobs > 1:
+        from r21buddy.budget import MemoryBudget
+        budget = MemoryBudget()
+    def work(f):
+        # Patcher keeps a scratch buffer, so each thread gets its own.
+        patcher = getattr(local, "patcher", None)
+        if patcher is None:
+            patcher = local.patcher = Patcher(options.length, logger=logger,
+                                              budget=budget)
+        if options.check:
+            return patcher.check(f)
+        return patcher.patch(f, output_file=options.output_file)
+    if options.jobs > 1:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(options.jobs)
+        results = pool.imap(work, files)
     else:
-        patch_file(options.input_file, options.length, output_file=options.output_file, verbose=options.verbose)
+        pool = None
+        results = (work(f) for f in files)
+
+    errors = too_long = 0
+    try:
+        for result in results:
+            if not result.ok:
+                errors += 1
+                logger.error(unicode(result))
+            else:
+                if result.needs_patch and not result.patched:
+                    too_long += 1
+                logger.info(unicode(result))
+                if options.verbose:
+                    for start, end in result.skipped:
+                        logger.info(u"    skipped {0} bytes at offset {1}".format(
+                            end - start, start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if len(files) > 1:
+        logger.info(u"{0} file(s): {1} error(s){2}".format(
+            len(files), errors,
+            u", {0} too long".format(too_long) if options.check else u""))
+    if errors > 0:
+        return 1
+    if too_long > 0:
+        return 2
     return 0
 
+def pipe_main(options):
+    """Streams from stdin and/or to stdout; "-" may be given for either
+    the input or the output file."""
+    if options.output_file == "-" or (options.input_file == "-"
+                                      and options.output_file is None):
+        # stdout carries the data, so messages go to stderr.
+        set_logger(StderrLogger())
+        outfile = _binary_stdio(sys.stdout)
+    else:
+        outfile = None
+    if options.input_file == "-":
+        infile = _binary_stdio(sys.stdin)
+    else:
+        infile = open(options.input_file, "rb")
+    status = 0
+    try:
+        if options.check:
+            if not check_stream(infile, options.length,
+                                verbose=options.verbose):
+                status = 2
+        else:
+            if outfile is None:
+                outfile = open(options.output_file, "wb")
+            patch_stream(infile, outfile, options.length,
+                         verbose=options.verbose)
+            outfile.flush()
+    except (IOError, ValueError, IndexError) as e:
+        logger.error(u"ERROR: {0}".format(e))
+        status = 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not None and outfile is not sys.stdout:
+            outfile.close()
+    return status
+
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,7 +1,24 @@
-import os, sys, traceback
-from cStringIO import StringIO
+from __future__ import absolute_import
+
+import os, sys, threading, time, traceback, Queue
 import Tkinter, tkFileDialog, tkMessageBox
 from r21buddy import oggpatch
+from r21buddy.logger import ThreadQueueLogger
+from r21buddy.logview import LogView
+
+# Interval to poll the batch workers for status updates.
+POLL_INTERVAL = 100  # milliseconds
+WORKER_COUNT = 2
+
+STATUS_COLORS = {
+    "queued": "black",
+    "working": "blue",
+    "patched": "dark green",
+    "ok": "dark green",
+    "too long": "red",
+    "error": "red",
+    "cancelled": "gray",
+    }
 
 
 class CompositeControl(object):
@@ -67,6 +84,136 @@ class File(CompositeControl):
         self.button.configure(**kwargs)
 
 
+def _norm_path(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def find_output_conflicts(jobs):
+    """Returns the output files which more than one job would write
+    to, or which another job reads as its input.
+
+    The batch workers run concurrently, so such jobs would clobber
+    each other's output (or input) mid-write.
+
+    """
+    writers = {}
+    readers = set()
+    for input_file, output_file in jobs:
+        if output_file is None:
+            continue
+        key = _norm_path(output_file)
+        writers.setdefault(key, []).append(output_file)
+        if key != _norm_path(input_file):
+            readers.add(_norm_path(input_file))
+    conflicts = []
+    for key, output_files in sorted(writers.iteritems()):
+        if len(output_files) > 1 or key in readers:
+            conflicts.append(output_files[0])
+    return conflicts
+
+
+class BatchRunner(object):
+
+    """Patches/checks a list of files on a pool of worker threads.
+
+    Status updates are passed back via a queue as (index, status)
+    tuples, and log output via a ThreadQueueLogger, so the GUI thread
+    only has to poll.
+
+    """
+
+    def __init__(self, jobs, mode, length, verbose=False,
+                 worker_count=WORKER_COUNT):
+        self.jobs = jobs  # list of (input_file, output_file)
+        self.mode = mode
+        self.length = length
+        self.verbose = verbose
+        self.logger = ThreadQueueLogger()
+        self.events = Queue.Queue()
+        self.cancel_event = threading.Event()
+        self.sizes = []
+        for input_file, output_file in jobs:
+            try:
+                self.sizes.append(os.path.getsize(input_file))
+            except OSError:
+                self.sizes.append(0)
+        self.total_bytes = sum(self.sizes)
+        self.done_bytes = 0
+        self.done_count = 0
+        self.start_time = None
+        self.todo = Queue.Queue()
+        for i in xrange(len(jobs)):
+            self.todo.put(i)
+        self.threads = [threading.Thread(target=self._work)
+                        for i in xrange(min(worker_count, len(jobs)))]
+
+    def start(self):
+        oggpatch.set_logger(self.logger)
+        self.start_time = time.time()
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+    def _work(self):
+        while True:
+            try:
+                i = self.todo.get(False)
+            except Queue.Empty:
+                return
+            if self.cancel_event.is_set():
+                self.events.put((i, "cancelled"))
+                continue
+            self.events.put((i, "working"))
+            input_file, output_file = self.jobs[i]
+            if self.verbose:
+                self.logger.info(u"{0}:".format(input_file))
+            try:
+                if self.mode == "patch":
+                    patched = oggpatch.patch_file(
+                        input_file, self.length, output_file=output_file,
+                        verbose=self.verbose)
+                    status = "patched" if patched else "ok"
+                else:
+                    ok = oggpatch.check_file(
+                        input_file, self.length, verbose=self.verbose)
+                    status = "ok" if ok else "too long"
+            except Exception:
+                self.logger.error(u"{0}:\n{1}".format(
+                    input_file, traceback.format_exc().decode("utf-8", "replace")))
+                status = "error"
+            self.events.put((i, status))
+
+    def read_events(self):
+        """Returns the status updates since the last call."""
+        events = []
+        while True:
+            try:
+                i, status = self.events.get(False)
+            except Queue.Empty:
+                break
+            if status not in ("working", "cancelled"):
+                self.done_bytes += self.sizes[i]
+                self.done_count += 1
+            events.append((i, status))
+        return events
+
+    def get_progress_text(self):
+        elapsed = time.time() - self.start_time
+        text = "{0}/{1} files".format(self.done_count, len(self.jobs))
+        if elapsed > 0 and self.done_bytes > 0:
+            rate = self.done_bytes / elapsed
+            remaining = (self.total_bytes - self.done_bytes) / rate
+            text += ", {0:.1f} MB/s, ETA {1}".format(
+                rate / (1024.0 * 1024), oggpatch.pprint_time(remaining))
+        return text
+
+
 class MainWindow(object):
     def __init__(self):
         self.root = Tkinter.Tk()
@@ -77,6 +224,8 @@ class MainWindow(object):
         main_frame.grid(row=0, column=0,
                         sticky=(Tkinter.N, Tkinter.S, Tkinter.E, Tkinter.W))
         main_frame.columnconfigure(1, weight=1)
+        main_frame.rowconfigure(5, weight=1)
+        main_frame.rowconfigure(8, weight=1)
 
         self.input_file = File(main_frame, "Input file name:")
         self.input_file.grid(row=0)
@@ -102,9 +251,72 @@ class MainWindow(object):
         self.song_length = Input(main_frame, "Desired song length:", "1:45")
         self.song_length.grid(row=4)
 
-        self.execute_btn = Tkinter.Button(main_frame, text="Make it so!", command=self.execute)
-        self.execute_btn.grid(row=5, columnspan=3)
-
+        # Batch queue.  If any files are queued, these are processed
+        # instead of the single input file above.
+        batch_frame = Tkinter.LabelFrame(
+            main_frame, text="Batch queue (optional)")
+        batch_frame.grid(row=5, column=0, columnspan=3,
+                         sticky=(Tkinter.N, Tkinter.S, Tkinter.E, Tkinter.W))
+        batch_frame.rowconfigure(0, weight=1)
+        batch_frame.columnconfigure(0, weight=1)
+        self.batch_list = Tkinter.Listbox(
+            batch_frame, width=1, height=6, activestyle=Tkinter.NONE,
+            selectmode=Tkinter.EXTENDED)
+        self.batch_list.grid(
+            row=0, column=0,
+            sticky=(Tkinter.N, Tkinter.S, Tkinter.E, Tkinter.W))
+        scroll = Tkinter.Scrollbar(batch_frame)
+        scroll.grid(row=0, column=1, sticky=(Tkinter.N, Tkinter.S))
+        self.batch_list.configure(yscrollcommand=scroll.set)
+        scroll.configure(command=self.batch_list.yview)
+        button_frame = Tkinter.Frame(batch_frame)
+        button_frame.grid(row=0, column=2, sticky=Tkinter.N)
+        self.add_files_btn = Tkinter.Button(
+            button_frame, text="Add files...", width=10,
+            command=self.on_add_files)
+        self.add_files_btn.pack()
+        self.add_folder_btn = Tkinter.Button(
+            button_frame, text="Add folder...", width=10,
+            command=self.on_add_folder)
+        self.add_folder_btn.pack()
+        self.remove_btn = Tkinter.Button(
+            button_frame, text="Remove", width=10, command=self.on_remove)
+        self.remove_btn.pack()
+        self.clear_btn = Tkinter.Button(
+            button_frame, text="Clear", width=10, command=self.on_clear)
+        self.clear_btn.pack()
+        self.batch_files = []
+
+        run_frame = Tkinter.Frame(main_frame)
+        run_frame.grid(row=6, columnspan=3)
+        self.execute_btn = Tkinter.Button(run_frame, text="Make it so!", command=self.execute)
+        self.execute_btn.pack(side=Tkinter.LEFT)
+        self.cancel_btn = Tkinter.Button(
+            run_frame, text="Cancel", command=self.on_cancel,
+            state=Tkinter.DISABLED)
+        self.cancel_btn.pack(side=Tkinter.LEFT)
+
+        self.status = Tkinter.StringVar()
+        Tkinter.Label(main_frame, textvariable=self.status).grid(
+            row=7, column=0, columnspan=3, sticky=Tkinter.W)
+
+        self.log_view = LogView(main_frame, text="Log", height=8)
+        self.log_view.grid(row=8, column=0, columnspan=3,
+                           sticky=(Tkinter.N, Tkinter.S, Tkinter.E, Tkinter.W))
+
+        self.toggle_control_set = (
+            self.input_file,
+            self.song_length.entry,
+            patch_mode,
+            check_mode,
+            self.add_files_btn,
+            self.add_folder_btn,
+            self.remove_btn,
+            self.clear_btn,
+            self.execute_btn,
+            )
+
+        self.runner = None
         self.on_patch_mode()
 
     def mainloop(self):
@@ -113,12 +325,75 @@ class MainWindow(object):
     def on_patch_mode(self):
         # Enable output file
         self.output_file.configure(state=Tkinter.NORMAL)
-        self.execute_btn.configure(text="Patch file")
+        self.execute_btn.configure(text="Patch file(s)")
 
     def on_check_mode(self):
         # Disable output file
         self.output_file.configure(state=Tkinter.DISABLED)
-        self.execute_btn.configure(text="Check file")
+        self.execute_btn.configure(text="Check file(s)")
+
+    def disable(self):
+        for control in self.toggle_control_set:
+            control.configure(state=Tkinter.DISABLED)
+        self.output_file.configure(state=Tkinter.DISABLED)
+        self.cancel_btn.configure(state=Tkinter.NORMAL)
+
+    def enable(self):
+        for control in self.toggle_control_set:
+            control.configure(state=Tkinter.NORMAL)
+        if self.mode.get() == "patch":
+            self.output_file.configure(state=Tkinter.NORMAL)
+        self.cancel_btn.configure(state=Tkinter.DISABLED)
+
+    def add_batch_files(self, paths):
+        for path in paths:
+            if path not in self.batch_files:
+                self.batch_files.append(path)
+                self.batch_list.insert(Tkinter.END, self.get_batch_text(path, "queued"))
+
+    def get_batch_text(self, path, status):
+        return "[{0}] {1}".format(status, path)
+
+    def set_batch_status(self, i, status):
+        self.batch_list.delete(i)
+        self.batch_list.insert(i, self.get_batch_text(self.batch_files[i], status))
+        self.batch_list.itemconfigure(i, foreground=STATUS_COLORS[status])
+
+    def on_add_files(self):
+        paths = tkFileDialog.askopenfilenames(
+            filetypes=[
+                ("Ogg files", "*.ogg"),
+                ("All files", "*.*"),
+                ])
+        if isinstance(paths, basestring):
+            # Some Tk versions return a Tcl list as a single string.
+            paths = self.root.tk.splitlist(paths)
+        self.add_batch_files(paths)
+
+    def on_add_folder(self):
+        path = tkFileDialog.askdirectory(mustexist=True)
+        if len(path) == 0:
+            return
+        found = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            found.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                         if f.lower().endswith(".ogg"))
+        self.add_batch_files(found)
+
+    def on_remove(self):
+        for i in sorted(map(int, self.batch_list.curselection()), reverse=True):
+            self.batch_list.delete(i)
+            del self.batch_files[i]
+
+    def on_clear(self):
+        self.batch_list.delete(0, Tkinter.END)
+        self.batch_files = []
+
+    def on_cancel(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            self.status.set("Cancelling after the current file(s)...")
 
     def get_time(self):
         length = self.song_length.get()
@@ -137,18 +412,61 @@ class MainWindow(object):
             raise ValueError("Bad time", length)
         return (h*3600) + (m*60) + s
 
-    def execute(self):
-        input_file = self.input_file.get()
-        if len(input_file) == 0:
+    def get_output_file(self, input_file, batch=False):
+        """Returns the output file for input_file, or None if the
+        output file setting is unusable (after telling the user)."""
+        output_file = self.output_file.get()
+        if len(output_file) == 0:
+            return input_file
+        output_dir = os.path.split(output_file)[0]
+
+        # Allow the output file to be a dir.  In this case take
+        # the input file's name and append it.
+        if os.path.isdir(output_file):
+            output_dir = output_file
+            output_file = os.path.join(output_dir,
+                                       os.path.basename(input_file))
+        elif batch:
             tkMessageBox.showinfo(
-                title="No input file",
-                message="Please select an input file")
-            return
-        elif not os.path.isfile(input_file):
+                title="Bad output directory",
+                message=("When patching a batch of files, the output must "
+                         "be an existing directory, or left blank to "
+                         "patch the files in place."))
+            return None
+
+        if not os.path.exists(output_dir):
+            tkMessageBox.showinfo(
+                title="Output directory not found",
+                message=("Output directory does not exist.  "
+                         "Please check your output file name."))
+            return None
+        elif not os.path.isdir(output_dir):
             tkMessageBox.showinfo(
-                title="Bad input file",
-                message=("Could not find the specified input file.  "
-                         "Please re-select the file."))
+                title="Bad output directory",
+                message=("The specified output directory conflicts with "
+                         "an existing file.  Please use a different "
+                         "output file name."))
+            return None
+        return output_file
+
+    def execute(self):
+        batch = len(self.batch_files) > 0
+        if batch:
+            input_files = list(self.batch_files)
+        else:
+            input_file = self.input_file.get()
+            if len(input_file) == 0:
+                tkMessageBox.showinfo(
+                    title="No input file",
+                    message="Please select an input file, or add files to the batch queue")
+                return
+            elif not os.path.isfile(input_file):
+                tkMessageBox.showinfo(
+                    title="Bad input file",
+                    message=("Could not find the specified input file.  "
+                             "Please re-select the file."))
+                return
+            input_files = [input_file]
 
         try:
             length = self.get_time()
@@ -159,61 +477,61 @@ class MainWindow(object):
             return
 
         mode = self.mode.get()
-        if mode == "patch":
-            output_file = self.output_file.get()
-            if len(output_file) == 0:
-                output_file = input_file
-            output_dir = os.path.split(output_file)[0]
-
-            # Allow the output file to be a dir.  In this case take
-            # the input file's name and append it.
-            if os.path.isdir(output_file):
-                output_dir = output_file
-                output_file = os.path.join(output_dir,
-                                           os.path.basename(input_file))
-
-            if not os.path.exists(output_dir):
-                tkMessageBox.showinfo(
-                    title="Output directory not found",
-                    message=("Output directory does not exist.  "
-                             "Please check your output file name."))
-            elif not os.path.isdir(output_dir):
-                tkMessageBox.showinfo(
-                    title="Bad output directory",
-                    message=("The specified output directory conflicts with "
-                             "an existing file.  Please use a different "
-                             "output file name."))
-
-            self.hijack_output()
-            try:
-                oggpatch.patch_file(
-                    input_file, length, output_file=output_file, verbose=True)
-            except:
-                print traceback.format_exc()
-            self.restore_output()
-        elif mode == "check":
-            self.hijack_output()
-            try:
-                oggpatch.check_file(input_file, length, verbose=True)
-            except:
-                print traceback.format_exc()
-            self.restore_output()
-        else:
+        if mode not in ("patch", "check"):
             raise ValueError("Bad mode", mode)
+        jobs = []
+        for input_file in input_files:
+            output_file = None
+            if mode == "patch":
+                output_file = self.get_output_file(input_file, batch=batch)
+                if output_file is None:
+                    return
+            jobs.append((input_file, output_file))
+
+        conflicts = find_output_conflicts(jobs)
+        if len(conflicts) > 0:
+            tkMessageBox.showinfo(
+                title="Conflicting output files",
+                message=("More than one file in the batch would be written "
+                         "to the same output file:\n\n{0}\n\n"
+                         "Please rename the inputs or patch them in "
+                         "separate batches.".format(
+                             "\n".join(conflicts))))
+            return
+
+        if batch:
+            for i in xrange(len(self.batch_files)):
+                self.set_batch_status(i, "queued")
+
+        # Only log the details if we're working on a single file;
+        # otherwise the per-file status in the queue says it all.
+        self.runner = BatchRunner(jobs, mode, length, verbose=(not batch))
+        self.disable()
+        self.runner.start()
+        self._on_run(self.runner, batch)
+
+    def _on_run(self, runner, batch):
+        self.log_view.append(runner.logger.read())
+        for i, status in runner.read_events():
+            if batch:
+                self.set_batch_status(i, status)
+        self.status.set(runner.get_progress_text())
+        if runner.is_alive():
+            self.root.after(POLL_INTERVAL, self._on_run, runner, batch)
+            return
 
-    def hijack_output(self):
-        self.old_stdout = sys.stdout
-        self.old_stderr = sys.stderr
-        sys.stdout = sys.stderr = StringIO()
-
-    def restore_output(self):
-        sio = sys.stdout
-        sys.stdout = self.old_stdout
-        sys.stderr = self.old_stderr
-        output = sio.getvalue()
-        tkMessageBox.showinfo(
-            title="Execution log",
-            message=output)
+        self.log_view.append(runner.logger.read())
+        for i, status in runner.read_events():
+            if batch:
+                self.set_batch_status(i, status)
+        text = runner.get_progress_text()
+        if runner.cancel_event.is_set():
+            text += " (cancelled)"
+        self.status.set(text)
+        self.log_view.append(u"Operation complete.\n\n")
+        self.log_view.flush()
+        self.runner = None
+        self.enable()
 
 def main():
     root = MainWindow()
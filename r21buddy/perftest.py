@@ -0,0 +1,492 @@
+"""Performance checks for r21buddy.
+
+Run with "python -m r21buddy.perftest".  The exit status is non-zero if
+any check fails.
+
+Checks:
+  startup  "r21buddy check" on a single file must start in
+           milliseconds, and must not import GUI, database or
+           argument-parsing modules to do so.
+  pipe     "oggpatch - -" must produce the same bytes as patching the
+           file in place, for a short file and for one needing a patch.
+
+Benchmarks (hot paths, timed on generated fixtures):
+  parse_pages  Scan PARSE_PAGES Ogg pages from memory
+  packets      Iterate over the packets on those pages
+  crc          Ogg CRC over CRC_SIZE bytes
+  patch        Patch PATCH_FILES files, half needing a full rewrite
+  walk         Find the songs in a WALK_DIRS directory song tree
+  walk_threaded  The same, with 4 walker threads
+
+Reports (informational; never fail):
+  write_order  Copy WRITE_SONGS songs with the write scheduler and
+               song by song, and compare.  Use --target-dir to run this
+               against the drive that matters (e.g. a thumb drive).
+  sync_jobs    Sync WRITE_SONGS songs which all need patching, with one
+               and with SYNC_JOBS patching threads (also --target-dir).
+
+Benchmark times are divided by the time of a fixed pure-Python
+calibration loop, so that results from faster or slower machines are
+comparable.  They are compared against perf_baseline.json (next to this
+module); a benchmark fails if it is more than its threshold slower than
+the baseline.  Use --update-baseline to record new baseline values
+after an intentional change.
+
+"""
+
+from __future__ import absolute_import
+
+import gc, os, sys, time, json, struct, shutil, argparse, tempfile, subprocess
+from cStringIO import StringIO
+from r21buddy import crc
+
+
+STARTUP_RUNS = 15
+STARTUP_BUDGET = 0.030  # Seconds allowed on top of a bare interpreter
+# Modules which "r21buddy check <file>" has no business importing.
+HEAVY_MODULES = ("Tkinter", "ttk", "argparse", "sqlite3", "multiprocessing",
+                 "r21buddy.r21buddy", "r21buddy.catalog")
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "perf_baseline.json")
+DEFAULT_THRESHOLD = 0.25  # Allowed slowdown relative to the baseline
+REPEATS = 7               # Best of this many runs is used
+
+PARSE_PAGES = 5000
+CRC_SIZE = 16 * 1024 * 1024
+PATCH_FILES = 20
+WALK_DIRS = 5000
+WRITE_SONGS = 30
+WRITE_REPEATS = 3
+SYNC_JOBS = 4
+
+
+def _page(flags, granule, serial, seq, segs, payload):
+    raw = "".join(["OggS", chr(0), chr(flags),
+                   struct.pack("<qII", granule, serial, seq), chr(0) * 4,
+                   chr(len(segs)), "".join(chr(s) for s in segs), payload])
+    return raw[:22] + struct.pack("<I", crc.fast(raw)) + raw[26:]
+
+def _lace(packet):
+    segs = [255] * (len(packet) // 255)
+    segs.append(len(packet) % 255)
+    return segs
+
+def make_ogg(path, seconds=120, rate=44100, serial=1, packet_size=1000):
+    """Writes a structurally valid Vorbis file of the given length.
+    The audio packets are random bytes; only the Ogg layer is real."""
+    id_header = "\x01vorbis" + struct.pack(
+        "<IBIiiiBB", 0, 2, rate, 0, 128000, 0, 0xB8, 1)
+    comments = "\x03vorbis" + struct.pack("<I", 8) + "perftest" + \
+        struct.pack("<I", 0) + "\x01"
+    setup = "\x05vorbis" + chr(0) * 100
+    pages = [_page(2, 0, serial, 0, _lace(id_header), id_header),
+             _page(0, 0, serial, 1, _lace(comments) + _lace(setup),
+                   comments + setup)]
+    total = int(seconds * rate)
+    samples_per_page = 8192
+    page_count = max(1, total // samples_per_page)
+    for i in xrange(page_count):
+        packets = [os.urandom(packet_size) for j in xrange(4)]
+        segs = []
+        for packet in packets:
+            segs.extend(_lace(packet))
+        flags = 4 if i == page_count - 1 else 0
+        granule = min(total, (i + 1) * samples_per_page)
+        pages.append(_page(flags, granule, serial, i + 2, segs,
+                           "".join(packets)))
+    with open(path, "wb") as outfile:
+        outfile.write("".join(pages))
+
+
+def time_command(args, runs):
+    """Returns the median wall time of running args."""
+    times = []
+    with open(os.devnull, "wb") as devnull:
+        for i in xrange(runs):
+            start = time.time()
+            subprocess.call(args, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def imported_modules(code):
+    """Returns the modules loaded after running code in a fresh
+    interpreter."""
+    output = subprocess.check_output([
+        sys.executable, "-c",
+        code + "\nimport sys\nprint ' '.join(sys.modules)"])
+    return set(output.splitlines()[-1].split())
+
+
+class CheckResult(object):
+    def __init__(self, name, value, budget, unit, notes=()):
+        self.name = name
+        self.value = value
+        self.budget = budget
+        self.unit = unit
+        self.notes = list(notes)
+
+    @property
+    def ok(self):
+        return self.value <= self.budget and len(self.notes) == 0
+
+    def __str__(self):
+        lines = [u"{0:10s} {1:8.1f} {3}  (budget {2:.1f} {3})  {4}".format(
+            self.name, self.value, self.budget, self.unit,
+            u"ok" if self.ok else u"FAIL")]
+        lines.extend(u"    {0}".format(note) for note in self.notes)
+        return u"\n".join(lines)
+
+
+def check_startup(work_dir, runs=STARTUP_RUNS):
+    ogg_file = os.path.join(work_dir, "startup.ogg")
+    make_ogg(ogg_file, seconds=10)
+    bare = time_command([sys.executable, "-c", "pass"], runs)
+    check = time_command(
+        [sys.executable, "-m", "r21buddy", "check", ogg_file], runs)
+    modules = imported_modules(
+        "from r21buddy.cli import main\nmain(['check', {0!r}])".format(ogg_file))
+    heavy = sorted(m for m in modules
+                   if m in HEAVY_MODULES or m.split(".")[0] in HEAVY_MODULES)
+    notes = []
+    if heavy:
+        notes.append(u"Imported: {0}".format(u", ".join(heavy)))
+    return CheckResult("startup", (check - bare) * 1000,
+                       STARTUP_BUDGET * 1000, "ms", notes)
+
+
+def check_pipe(work_dir):
+    from r21buddy.oggpatch import Patcher
+    notes = []
+    for seconds in (10, 200):
+        ogg_file = os.path.join(work_dir, "pipe{0}.ogg".format(seconds))
+        make_ogg(ogg_file, seconds=seconds)
+        with open(ogg_file, "rb") as infile:
+            proc = subprocess.Popen(
+                [sys.executable, "-m", "r21buddy.oggpatch", "-", "-"],
+                stdin=infile, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = proc.communicate()
+        Patcher(logger=_NullLogger()).patch(ogg_file)
+        with open(ogg_file, "rb") as infile:
+            expected = infile.read()
+        if proc.returncode != 0:
+            notes.append(u"{0} s file: exit status {1}: {2}".format(
+                seconds, proc.returncode, errors.strip()))
+        elif output != expected:
+            notes.append(u"{0} s file: output differs from an in-place "
+                         u"patch".format(seconds))
+    return CheckResult("pipe", len(notes), 0, "bad", notes)
+
+
+CHECKS = [check_startup, check_pipe]
+
+
+def _flush_disks():
+    # Count the time to get the data onto the drive, not just into the
+    # page cache.
+    if hasattr(os, "fsync") and sys.platform != "win32":
+        subprocess.call(["sync"])
+
+
+def _make_song_library(work_dir, name, junk=False):
+    """Writes WRITE_SONGS songs to work_dir/name; returns its path.
+    With junk set, every other .ogg needs a full rewrite to patch."""
+    source = os.path.join(work_dir, name)
+    ogg_file = os.path.join(work_dir, "write.ogg")
+    make_ogg(ogg_file, seconds=130 if junk else 40)
+    with open(ogg_file, "rb") as infile:
+        ogg_data = infile.read()
+    for i in xrange(WRITE_SONGS):
+        song_dir = os.path.join(source, "Song{0:02d}".format(i))
+        os.makedirs(song_dir)
+        with open(os.path.join(song_dir, "song.sm"), "wb") as outfile:
+            outfile.write("#TITLE:Song {0};\n#MUSIC:song.ogg;\n#NOTES:\n".format(i))
+            outfile.write(os.urandom(16 * 1024).encode("hex"))
+        for name, size in (("bn.png", 60 * 1024), ("bg.png", 150 * 1024)):
+            with open(os.path.join(song_dir, name), "wb") as outfile:
+                outfile.write(os.urandom(size))
+        with open(os.path.join(song_dir, "song.ogg"), "wb") as outfile:
+            outfile.write("junk" * (junk and i % 2) + ogg_data)
+    return source
+
+
+def _time_runs(work_dir, target_dir, source, variants):
+    """Times r21buddy.run from source into a fresh target for each
+    variant (a dict of run() arguments), WRITE_REPEATS times each;
+    returns the best time of each variant."""
+    from r21buddy import r21buddy
+    target_root = tempfile.mkdtemp(prefix="r21buddy-perftest-",
+                                   dir=target_dir or work_dir)
+    times = [[] for variant in variants]
+    saved = r21buddy.logger
+    try:
+        for i in xrange(WRITE_REPEATS):
+            for variant, variant_times in zip(variants, times):
+                target = os.path.join(target_root, "target")
+                _flush_disks()
+                start = time.time()
+                r21buddy.run(target, [source], ext_logger=_NullLogger(),
+                             walkers=1, **variant)
+                _flush_disks()
+                variant_times.append(time.time() - start)
+                shutil.rmtree(target)
+    finally:
+        r21buddy.logger = saved
+        shutil.rmtree(target_root)
+    return [min(t) for t in times]
+
+
+def report_write_order(work_dir, target_dir=None):
+    """Times copying a song library with and without the write
+    scheduler; returns a report line."""
+    source = _make_song_library(work_dir, "write_songs")
+    scheduled, listing = _time_runs(work_dir, target_dir, source, [
+        {"length_patch": False, "schedule_writes": True},
+        {"length_patch": False, "schedule_writes": False}])
+    return u"write_order  scheduled {0:.1f} ms, song by song {1:.1f} ms ({2:+.1%} time)".format(
+        scheduled * 1000, listing * 1000, scheduled / listing - 1)
+
+
+def report_sync_jobs(work_dir, target_dir=None):
+    """Times a sync which patches every song with one and with
+    SYNC_JOBS patching threads; returns a report line."""
+    source = _make_song_library(work_dir, "sync_songs", junk=True)
+    serial, parallel = _time_runs(work_dir, target_dir, source, [
+        {"jobs": 1}, {"jobs": SYNC_JOBS}])
+    return u"sync_jobs    -j 1 {0:.1f} ms, -j {1} {2:.1f} ms ({3:+.1%} time)".format(
+        serial * 1000, SYNC_JOBS, parallel * 1000, parallel / serial - 1)
+
+
+def calibrate():
+    """Times a fixed pure-Python workload; returns seconds."""
+    def loop():
+        total = 0
+        d = {}
+        for i in xrange(200000):
+            total += i * 7 % 13
+            d[i & 1023] = total
+        return "".join(str(v) for v in d.itervalues())
+    return best_time(loop)
+
+
+def best_time(func, repeats=REPEATS):
+    times = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i in xrange(repeats):
+            gc.collect()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return min(times)
+
+
+class _NullLogger(object):
+    def info(self, msg):
+        pass
+    error = info
+
+
+def setup_parse_pages(work_dir):
+    from r21buddy import oggpatch
+    path = os.path.join(work_dir, "parse.ogg")
+    # 8192 samples per page.
+    make_ogg(path, seconds=PARSE_PAGES * 8192.0 / 44100)
+    with open(path, "rb") as infile:
+        data = infile.read()
+    def run():
+        count = sum(1 for page in oggpatch.PageScanner(StringIO(data)))
+        assert count >= PARSE_PAGES
+    return run
+
+
+def setup_packets(work_dir):
+    from r21buddy import oggpatch
+    path = os.path.join(work_dir, "parse.ogg")
+    make_ogg(path, seconds=PARSE_PAGES * 8192.0 / 44100)
+    with open(path, "rb") as infile:
+        pages = list(oggpatch.PageScanner(infile))
+    def run():
+        count = sum(1 for packet in oggpatch.iter_packets(pages))
+        assert count >= PARSE_PAGES * 4
+    return run
+
+
+def setup_crc(work_dir):
+    data = os.urandom(1024 * 1024)
+    def run():
+        for i in xrange(CRC_SIZE // len(data)):
+            crc.fast(data)
+    return run
+
+
+def setup_patch(work_dir):
+    from r21buddy import oggpatch
+    source = os.path.join(work_dir, "patch.ogg")
+    make_ogg(source, seconds=130)
+    with open(source, "rb") as infile:
+        data = infile.read()
+    paths = [os.path.join(work_dir, "patch{0}.ogg".format(i))
+             for i in xrange(PATCH_FILES)]
+    def run():
+        for i, path in enumerate(paths):
+            # Junk up front forces every other file down the full
+            # rewrite path.
+            with open(path, "wb") as outfile:
+                outfile.write("junk" * (i % 2) + data)
+        patcher = oggpatch.Patcher(logger=_NullLogger())
+        for result in patcher.patch_many(paths):
+            assert result.patched, result
+    return run
+
+
+def setup_walk(work_dir, walkers=1):
+    from r21buddy import r21buddy, smfile
+    root = os.path.join(work_dir, "songs")
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    for i in xrange(WALK_DIRS):
+        song_dir = os.path.join(root, "Pack{0:02d}".format(i // 100),
+                                "Song{0:04d}".format(i))
+        os.makedirs(song_dir)
+        with open(os.path.join(song_dir, "song.sm"), "wb") as outfile:
+            outfile.write("#TITLE:Song {0};\n#MUSIC:song.ogg;\n#NOTES:\n".format(i))
+        open(os.path.join(song_dir, "song.ogg"), "wb").close()
+    def run():
+        smfile._header_cache.clear()
+        saved = r21buddy.logger
+        r21buddy.logger = _NullLogger()
+        try:
+            count = sum(1 for song in r21buddy.walk_songs([root],
+                                                          walkers=walkers))
+        finally:
+            r21buddy.logger = saved
+        assert count == WALK_DIRS, count
+    return run
+
+
+BENCHMARKS = [
+    ("parse_pages", setup_parse_pages),
+    ("packets", setup_packets),
+    ("crc", setup_crc),
+    ("patch", setup_patch),
+    ("walk", setup_walk),
+    ("walk_threaded", lambda work_dir: setup_walk(work_dir, walkers=4)),
+    ]
+
+
+def run_benchmarks(work_dir, names=None):
+    """Returns (calibration seconds, {name: normalized time})."""
+    calibration = calibrate()
+    results = {}
+    for name, setup in BENCHMARKS:
+        if names and name not in names:
+            continue
+        run = setup(work_dir)
+        results[name] = best_time(run) / calibration
+    return calibration, results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as infile:
+        return json.load(infile)
+
+
+def save_baseline(path, calibration, results):
+    with open(path, "wb") as outfile:
+        json.dump({
+            "python": sys.version.split()[0],
+            "calibration_seconds": calibration,
+            "threshold": DEFAULT_THRESHOLD,
+            "benchmarks": results,
+            }, outfile, indent=1, sort_keys=True)
+        outfile.write("\n")
+
+
+def compare(baseline, calibration, results):
+    """Returns (report lines, number of regressions)."""
+    lines = [u"{0:12s} {1:>10s} {2:>10s} {3:>8s} {4:>8s}".format(
+        u"benchmark", u"baseline", u"now", u"change", u"ms")]
+    regressions = 0
+    default_threshold = baseline.get("threshold", DEFAULT_THRESHOLD)
+    thresholds = baseline.get("thresholds", {})
+    for name, value in sorted(results.items()):
+        old = baseline["benchmarks"].get(name)
+        ms = value * calibration * 1000
+        if old is None:
+            lines.append(u"{0:12s} {1:>10s} {2:10.2f} {3:>8s} {4:8.1f}  (new)".format(
+                name, u"-", value, u"", ms))
+            continue
+        change = value / old - 1
+        threshold = thresholds.get(name, default_threshold)
+        status = u""
+        if change > threshold:
+            status = u"  REGRESSION (allowed +{0:.0%})".format(threshold)
+            regressions += 1
+        lines.append(u"{0:12s} {1:10.2f} {2:10.2f} {3:+8.1%} {4:8.1f}{5}".format(
+            name, old, value, change, ms, status))
+    return lines, regressions
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description="r21buddy performance checks.")
+    ap.add_argument("--baseline", default=BASELINE_FILE,
+                    help="Baseline file.  (Default: %(default)s)")
+    ap.add_argument("--update-baseline", action="store_true",
+                    help="Save the results as the new baseline.")
+    ap.add_argument("--only", nargs="+", metavar="NAME",
+                    help="Only run these benchmarks (and skip the checks "
+                    "and reports).")
+    ap.add_argument("--target-dir",
+                    help="Directory to write to for the write_order and "
+                    "sync_jobs reports.  "
+                    "(Default: a temporary directory)")
+    return ap.parse_args()
+
+
+def main():
+    options = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="r21buddy-perftest-")
+    failed = 0
+    try:
+        if not options.only:
+            for check in CHECKS:
+                result = check(work_dir)
+                print unicode(result)
+                if not result.ok:
+                    failed += 1
+            print report_write_order(work_dir, options.target_dir)
+            print report_sync_jobs(work_dir, options.target_dir)
+        calibration, results = run_benchmarks(work_dir, options.only)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print u"Calibration loop: {0:.1f} ms".format(calibration * 1000)
+    baseline = load_baseline(options.baseline)
+    if options.update_baseline:
+        if baseline is not None and options.only:
+            merged = dict(baseline["benchmarks"])
+            merged.update(results)
+            results = merged
+        save_baseline(options.baseline, calibration, results)
+        print u"Baseline saved to {0}".format(options.baseline)
+    elif baseline is None:
+        print u"No baseline found at {0}; run with --update-baseline.".format(
+            options.baseline)
+    else:
+        lines, regressions = compare(baseline, calibration, results)
+        print u"\n".join(lines)
+        failed += regressions
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,312 @@
+"""Dry-run planning for r21buddy runs.
+
+A plan lists which songs would be copied, which .ogg files would need
+patching and which songs would be skipped, along with byte totals and
+a time estimate.  Only metadata is used to build it: directory
+listings, file sizes and the first/last pages of each .ogg file (all
+of a file only if it needs a full rewrite to patch).
+
+Plans can be saved as JSON and executed later without rescanning the
+input paths.
+
+"""
+
+from __future__ import absolute_import
+
+import os, json, time, shutil, tempfile
+from r21buddy import oggpatch
+
+
+PLAN_VERSION = 1
+PROBE_SIZE = 8 * 1024 * 1024  # Bytes used for measuring throughput
+PROBE_NAME = u"r21buddy-probe.tmp"
+
+
+class SongPlan(object):
+    def __init__(self, name, source, files, sizes, patch, full=()):
+        self.name = name
+        self.source = source
+        self.files = files
+        self.sizes = sizes  # Sizes of files, in the same order
+        self.patch = patch  # .ogg files (from files) needing a patch
+        self.full = list(full)  # Those of patch needing a full rewrite
+
+    @property
+    def size(self):
+        return sum(self.sizes)
+
+    @property
+    def patch_size(self):
+        return sum(size for f, size in zip(self.files, self.sizes)
+                   if f in self.patch)
+
+    @property
+    def full_size(self):
+        return sum(size for f, size in zip(self.files, self.sizes)
+                   if f in self.full)
+
+    def to_dict(self):
+        return {"song": self.name, "source": self.source,
+                "files": self.files, "sizes": self.sizes,
+                "patch": self.patch, "full": self.full}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["song"], d["source"], d["files"], d["sizes"],
+                   d["patch"], d.get("full", ()))
+
+
+class Plan(object):
+
+    def __init__(self, target_dir, length_patch=True):
+        self.target_dir = target_dir
+        self.length_patch = length_patch
+        self.songs = []
+        self.skipped = []         # (source, reason) tuples
+        self.existing_patch = []  # (target file, size) tuples
+        self.existing_full = []   # Those of existing_patch needing a full rewrite
+        # Measured throughputs in bytes/second; None if not measured.
+        self.read_rate = None
+        self.write_rate = None
+        self.patch_rate = None    # Full rewrites
+        # Measured seconds per file patched in place; None if not
+        # measured.
+        self.tail_patch_time = None
+
+    @property
+    def copy_size(self):
+        return sum(song.size for song in self.songs)
+
+    @property
+    def copy_files(self):
+        return sum(len(song.files) for song in self.songs)
+
+    @property
+    def patch_files(self):
+        return (sum(len(song.patch) for song in self.songs)
+                + len(self.existing_patch))
+
+    @property
+    def patch_size(self):
+        return (sum(song.patch_size for song in self.songs)
+                + sum(size for f, size in self.existing_patch))
+
+    @property
+    def full_files(self):
+        return (sum(len(song.full) for song in self.songs)
+                + len(self.existing_full))
+
+    @property
+    def full_size(self):
+        existing_full = set(self.existing_full)
+        return (sum(song.full_size for song in self.songs)
+                + sum(size for f, size in self.existing_patch
+                      if f in existing_full))
+
+    def estimate(self):
+        """Returns the estimated run time in seconds, or None if the
+        needed throughputs haven't been measured."""
+        # Copying reads and writes every byte.  Most files are patched
+        # in place from their first and last pages, at a cost per file;
+        # the rest are parsed whole and rewritten.
+        total = 0.0
+        for size, rates in ((self.copy_size, (self.read_rate, self.write_rate)),
+                            (self.full_size, (self.patch_rate, self.write_rate))):
+            if size == 0:
+                continue
+            if None in rates:
+                return None
+            total += sum(float(size) / rate for rate in rates)
+        tail_files = self.patch_files - self.full_files
+        if tail_files > 0:
+            if self.tail_patch_time is None:
+                return None
+            total += tail_files * self.tail_patch_time
+        return total
+
+    def to_dict(self):
+        return {
+            "version": PLAN_VERSION,
+            "target_dir": self.target_dir,
+            "length_patch": self.length_patch,
+            "songs": [song.to_dict() for song in self.songs],
+            "skipped": [list(s) for s in self.skipped],
+            "existing_patch": [list(e) for e in self.existing_patch],
+            "existing_full": self.existing_full,
+            "read_rate": self.read_rate,
+            "write_rate": self.write_rate,
+            "patch_rate": self.patch_rate,
+            "tail_patch_time": self.tail_patch_time,
+            "totals": {
+                "songs": len(self.songs),
+                "copy_files": self.copy_files,
+                "copy_bytes": self.copy_size,
+                "patch_files": self.patch_files,
+                "patch_bytes": self.patch_size,
+                "full_rewrite_files": self.full_files,
+                "full_rewrite_bytes": self.full_size,
+                "estimated_seconds": self.estimate(),
+                },
+            }
+
+    @classmethod
+    def from_dict(cls, d):
+        if d.get("version") != PLAN_VERSION:
+            raise ValueError("Unsupported plan version", d.get("version"))
+        plan = cls(d["target_dir"], d["length_patch"])
+        plan.songs = [SongPlan.from_dict(s) for s in d["songs"]]
+        plan.skipped = [tuple(s) for s in d["skipped"]]
+        plan.existing_patch = [tuple(e) for e in d["existing_patch"]]
+        plan.existing_full = d.get("existing_full", [])
+        plan.read_rate = d["read_rate"]
+        plan.write_rate = d["write_rate"]
+        plan.patch_rate = d["patch_rate"]
+        plan.tail_patch_time = d.get("tail_patch_time")
+        return plan
+
+    def save(self, path):
+        with open(path, "wb") as outfile:
+            json.dump(self.to_dict(), outfile, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as infile:
+            return cls.from_dict(json.load(infile))
+
+
+def needs_patch(ogg_file, target_length=oggpatch.TARGET_LENGTH):
+    """Returns whether a file needs patching, using only its first and
+    last pages.  Files which can't be read this way are assumed to need
+    patching; the full parse during the run will sort them out."""
+    try:
+        return oggpatch.read_length(ogg_file) > target_length
+    except (ValueError, IOError):
+        return True
+
+
+def patch_method(ogg_file, patcher):
+    """Returns how ogg_file would be patched: None if it doesn't need
+    a patch, "tail" if in place, or "full" if it must be rewritten.
+    Files which can't be checked are assumed to need a full rewrite;
+    the run will sort them out."""
+    result = patcher.check(ogg_file)
+    if not result.ok:
+        return "full"
+    if not result.needs_patch:
+        return None
+    return result.method
+
+
+def build_plan(target_dir, songs, length_patch=True, existing_oggs=()):
+    """Builds a Plan.
+
+    songs is an iterable of (song_dir, song_files, target_song_dir)
+    tuples; existing_oggs lists .ogg files already in the target
+    which would be patched.  All paths are stored absolute, so that the
+    plan can be executed from any directory.
+
+    """
+    plan = Plan(os.path.abspath(target_dir), length_patch=length_patch)
+    patcher = oggpatch.Patcher()
+    names = set()
+    for song_dir, song_files, target_song_dir in songs:
+        name = os.path.basename(target_song_dir)
+        if os.path.exists(target_song_dir) or name in names:
+            plan.skipped.append(
+                (song_dir, u"{0} already exists".format(target_song_dir)))
+            continue
+        names.add(name)
+        song_dir = os.path.abspath(song_dir)
+        song_files = [os.path.abspath(f) for f in song_files]
+        sizes = [os.path.getsize(f) for f in song_files]
+        patch = []
+        full = []
+        if length_patch:
+            for f in song_files:
+                if not f.endswith(".ogg"):
+                    continue
+                method = patch_method(f, patcher)
+                if method is not None:
+                    patch.append(f)
+                if method == "full":
+                    full.append(f)
+        plan.songs.append(SongPlan(name, song_dir, song_files, sizes, patch,
+                                   full))
+    if length_patch:
+        for f in existing_oggs:
+            f = os.path.abspath(f)
+            method = patch_method(f, patcher)
+            if method is not None:
+                plan.existing_patch.append((f, os.path.getsize(f)))
+            if method == "full":
+                plan.existing_full.append(f)
+    return plan
+
+
+def measure_write_rate(target_dir, size=PROBE_SIZE):
+    """Times writing (and syncing) a scratch file in target_dir."""
+    path = os.path.join(target_dir, PROBE_NAME)
+    block = "\0" * (1024 * 1024)
+    start = time.time()
+    try:
+        with open(path, "wb") as outfile:
+            for i in xrange(max(1, size // len(block))):
+                outfile.write(block)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        elapsed = time.time() - start
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+    return max(1, size // len(block)) * len(block) / max(elapsed, 1e-6)
+
+
+def measure_read_rate(files, size=PROBE_SIZE):
+    """Times reading up to size bytes from the given files."""
+    done = 0
+    start = time.time()
+    for f in files:
+        with open(f, "rb") as infile:
+            done += len(infile.read(size - done))
+        if done >= size:
+            break
+    elapsed = time.time() - start
+    if done == 0:
+        return None
+    return done / max(elapsed, 1e-6)
+
+
+def time_patch(ogg_file):
+    """Times Patcher.patch on a scratch copy of ogg_file, made in the
+    system's temporary directory.  Returns seconds."""
+    temp_dir = tempfile.mkdtemp(prefix="r21buddy-plan-")
+    try:
+        sample = os.path.join(temp_dir, u"sample.ogg")
+        shutil.copyfile(ogg_file, sample)
+        patcher = oggpatch.Patcher()
+        start = time.time()
+        result = patcher.patch(sample)
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(temp_dir)
+    if not result.ok:
+        return None
+    return max(elapsed, 1e-6)
+
+
+def measure(plan):
+    """Fills in the plan's throughput figures using small probes of
+    the source files and the target directory."""
+    all_files = [f for song in plan.songs for f in song.files]
+    plan.read_rate = measure_read_rate(all_files)
+    plan.write_rate = measure_write_rate(plan.target_dir)
+    full = [f for song in plan.songs for f in song.full] + plan.existing_full
+    tail = [f for song in plan.songs for f in song.patch if f not in song.full]
+    tail.extend(f for f, size in plan.existing_patch
+                if f not in plan.existing_full)
+    if len(tail) > 0:
+        plan.tail_patch_time = time_patch(tail[0])
+    if len(full) > 0:
+        elapsed = time_patch(full[0])
+        if elapsed is not None:
+            plan.patch_rate = os.path.getsize(full[0]) / elapsed
@@ -0,0 +1,157 @@
+"""Progress reporting and cancellation for long-running operations.
+
+Both classes here are meant to be shared between a worker thread
+(which updates them) and a monitoring thread such as a GUI (which
+polls them), in the same spirit as logger.ThreadQueueLogger.
+
+"""
+
+from __future__ import absolute_import
+
+import threading, time
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken(object):
+
+    """Set by the monitoring thread; checked by the worker between
+    files and copy chunks."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise Cancelled()
+
+
+class ProgressEvent(object):
+
+    PLAN = "plan"      # More work was planned, or planning finished
+    START = "start"    # Started work on a file
+    BYTES = "bytes"    # Some bytes of the current file were processed
+    FINISH = "finish"  # Finished work on a file
+
+    def __init__(self, kind, path=None, size=0):
+        self.kind = kind
+        self.path = path
+        self.size = size
+
+    def __repr__(self):
+        return "<ProgressEvent {0} path:{1!r} size:{2}>".format(
+            self.kind, self.path, self.size)
+
+
+class ProgressSnapshot(object):
+    def __init__(self, done_files, total_files, done_bytes, total_bytes,
+                 elapsed, current, provisional=False):
+        self.done_files = done_files
+        self.total_files = total_files
+        self.done_bytes = done_bytes
+        self.total_bytes = total_bytes
+        self.elapsed = elapsed
+        self.current = current
+        # Set while more work may still be added to the totals, which
+        # makes fraction and eta meaningless.
+        self.provisional = provisional
+
+    @property
+    def fraction(self):
+        if self.total_bytes == 0:
+            return 0.0
+        return min(1.0, float(self.done_bytes) / self.total_bytes)
+
+    @property
+    def rate(self):
+        """Bytes per second."""
+        if self.elapsed <= 0:
+            return 0.0
+        return self.done_bytes / self.elapsed
+
+    @property
+    def eta(self):
+        """Estimated seconds remaining, or None if unknown."""
+        if self.provisional or self.rate <= 0:
+            return None
+        return max(0, self.total_bytes - self.done_bytes) / self.rate
+
+
+class Progress(object):
+
+    """Tracks planned and completed work.
+
+    Work is measured in files and bytes; each file may be counted more
+    than once if it is both copied and patched.  Between
+    start_planning() and finish_planning() the totals are provisional,
+    e.g. while songs are still being found.  If callback is given, it
+    is called with a ProgressEvent for every update (from the worker's
+    thread).
+
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.total_files = 0
+        self.total_bytes = 0
+        self.done_files = 0
+        self.done_bytes = 0
+        self.current = None
+        self.provisional = False
+        self.start_time = time.time()
+
+    def _notify(self, kind, path=None, size=0):
+        if self.callback is not None:
+            self.callback(ProgressEvent(kind, path, size))
+
+    def plan(self, files, size):
+        with self.lock:
+            self.total_files += files
+            self.total_bytes += size
+        self._notify(ProgressEvent.PLAN, None, size)
+
+    def start_planning(self):
+        with self.lock:
+            self.provisional = True
+
+    def finish_planning(self):
+        with self.lock:
+            self.provisional = False
+        self._notify(ProgressEvent.PLAN)
+
+    def start_file(self, path, size=0):
+        with self.lock:
+            self.current = path
+        self._notify(ProgressEvent.START, path, size)
+
+    def add_bytes(self, size):
+        with self.lock:
+            self.done_bytes += size
+        self._notify(ProgressEvent.BYTES, self.current, size)
+
+    def finish_file(self, path, size=0):
+        """Marks a file as done.  size is any byte count not already
+        reported via add_bytes."""
+        with self.lock:
+            self.done_files += 1
+            self.done_bytes += size
+            self.current = None
+        self._notify(ProgressEvent.FINISH, path, size)
+
+    def snapshot(self):
+        with self.lock:
+            return ProgressSnapshot(
+                self.done_files, self.total_files,
+                self.done_bytes, self.total_bytes,
+                time.time() - self.start_time, self.current,
+                self.provisional)
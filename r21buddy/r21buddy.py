@@ -6,24 +6,103 @@ This is the console version; a GUI version is intended eventually.
 
 from __future__ import absolute_import
 
-import os, sys, argparse, shutil, traceback
-from r21buddy import oggpatch
+import os, sys, argparse, shutil, itertools, posixpath, threading, traceback
+from multiprocessing.pool import ThreadPool
+from r21buddy import oggpatch, smfile, watch, journal, planner, archive, discovery
+from r21buddy import isolate
+from r21buddy.fanout import FanoutWriter
+from r21buddy.progress import Progress, CancelToken, Cancelled
+from r21buddy.dedup import AudioIndex
+from r21buddy.copier import Copier, preallocate
+from r21buddy.budget import MemoryBudget, DEFAULT_LIMIT
+from r21buddy.validate import validate_file
+from r21buddy.scheduler import WriteScheduler
 from r21buddy.logger import logger
 
 
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument(
-        "target_dir",
+        "target_dir", nargs="+",
         help=("Output directory.  NOTE: An ITG2-compatible directory "
-              "structure will be created *within* this directory."))
+              "structure will be created *within* this directory.  "
+              "If several are given, the same songs are written to "
+              "all of them at once."))
     ap.add_argument(
         "-i", "--input-path", default=[], nargs="*",
-        help=("Input path(s) to extract songs from."))
+        help=("Input path(s) to extract songs from.  .zip and .tar "
+              "archives of song packs may be given directly."))
     ap.add_argument(
         "-n", "--no-length-patch", dest="length_patch",
         action="store_false", default=True,
         help="Skip patching of .ogg files.")
+    ap.add_argument(
+        "-d", "--dedup", action="store_true",
+        help=("Copy and patch identical .ogg files only once, linking "
+              "duplicates where the target filesystem allows it."))
+    ap.add_argument(
+        "-r", "--resume", action="store_true",
+        help=("Resume an interrupted run using the journal in the target "
+              "directory, instead of scanning the input path(s) again."))
+    ap.add_argument(
+        "-p", "--plan", action="store_true",
+        help=("Don't copy or patch anything; just report what would be "
+              "done and how long it should take."))
+    ap.add_argument(
+        "--save-plan", metavar="FILE",
+        help="With --plan: also save the plan as JSON to FILE.")
+    ap.add_argument(
+        "--execute-plan", metavar="FILE",
+        help=("Execute a plan saved with --save-plan, without scanning "
+              "the input path(s) again."))
+    ap.add_argument(
+        "--block-size", type=int, metavar="MB",
+        help=("Copy in blocks of this many megabytes.  (Default: tuned "
+              "automatically for the target drive.)"))
+    ap.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of files to patch at once.  (Default: %(default)s)")
+    ap.add_argument(
+        "--memory-budget", type=int, metavar="MB",
+        default=DEFAULT_LIMIT // (1024 * 1024),
+        help=("Max. megabytes of file data held in memory across all "
+              "patching jobs; larger files are streamed.  "
+              "(Default: %(default)s)"))
+    ap.add_argument(
+        "--walkers", type=int, default=discovery.DEFAULT_WALKERS,
+        help=("Number of threads listing input directories.  Try 4 or "
+              "more for song libraries on network drives; on local disks "
+              "extra threads slow the walk down.  (Default: %(default)s)"))
+    ap.add_argument(
+        "--validate", action="store_true",
+        help=("Check the Ogg structure of each song's audio before copying "
+              "it, and skip songs the cabinet would likely reject."))
+    ap.add_argument(
+        "--isolate", action="store_true",
+        help=("Patch each file in a separate worker process, so a damaged "
+              "file can't hang or crash the run.  Failed files are retried "
+              "once at the end and listed in {0} in the target "
+              "directory.".format(isolate.QUARANTINE_NAME)))
+    ap.add_argument(
+        "--timeout", type=float, default=isolate.DEFAULT_TIMEOUT,
+        help=("With --isolate: seconds allowed for patching one file.  "
+              "(Default: %(default)s)"))
+    ap.add_argument(
+        "--memory-limit", type=int, metavar="MB",
+        default=isolate.DEFAULT_MEMORY_LIMIT // (1024 * 1024),
+        help=("With --isolate: max. megabytes of memory for each worker "
+              "process, where supported.  (Default: %(default)s)"))
+    ap.add_argument(
+        "-w", "--watch", action="store_true",
+        help=("Keep running, copying and patching new or changed songs "
+              "as they appear in the input path(s)."))
+    ap.add_argument(
+        "--poll-interval", type=float, default=watch.POLL_INTERVAL,
+        help="Seconds between checks in watch mode.  (Default: %(default)s)")
+    ap.add_argument(
+        "--settle-time", type=float, default=watch.SETTLE_TIME,
+        help=("Seconds a song's files must go unmodified before they "
+              "are copied in watch mode.  (Default: %(default)s)"))
     ap.add_argument(
         "-v", "--verbose", action="store_true", help="Verbose output.")
     return ap.parse_args()
@@ -40,91 +119,1209 @@ def create_target_dir_structure(target_dir, verbose=False):
         if verbose:
             logger.info(u"Directory already exists: {0}".format(song_dir))
 
-def copy_songs(input_path, target_dir, verbose=False):
+def copy_songs(input_path, target_dir, verbose=False, audio_index=None,
+               fanout=None, length_patch=True):
+    for song_dir, song_files in find_songs(input_path, verbose=verbose):
+        if fanout is not None:
+            fanout_song(song_dir, song_files, fanout,
+                        length_patch=length_patch, verbose=verbose)
+        else:
+            copy_song(song_dir, song_files, target_dir, verbose=verbose,
+                      audio_index=audio_index)
+
+def find_songs(input_path, verbose=False, lister=None):
+    """Yields (song_dir, song_files) for each compatible song directory
+    within input_path.
+
+    If a discovery.ParallelLister is given, directory listings are
+    taken from it rather than read here.
+
+    """
+    if lister is None:
+        listing = discovery.list_dir(input_path)
+        if listing.error is not None:
+            raise listing.error
+    else:
+        listing = lister.get(input_path)
     logger.info(u"INPUT DIR: {0}".format(repr(input_path)))
-    all_files = [os.path.join(input_path, f) for f in os.listdir(input_path)]
-    dirs = [f for f in all_files if os.path.isdir(f)]
+    dirs = listing.dirs
 
-    oddballs = [f for f in all_files if (not os.path.isdir(f)) and (not os.path.isfile(f))]
+    oddballs = listing.oddballs
     if len(oddballs) > 0:
         logger.info(u"ODDBALLS: {0}".format(repr(oddballs)))
 
     # If directories present: recurse into them.
     if len(dirs) > 0:
         for d in dirs:
-            copy_songs(d, target_dir, verbose=verbose)
+            for song in find_songs(d, verbose=verbose, lister=lister):
+                yield song
 
     # Check whether this is a song directory.
-    files = [f for f in all_files if os.path.isfile(f)]
+    files = listing.files
+    song_files = get_song_files(input_path, files, verbose=verbose)
+    if song_files is not None:
+        yield input_path, song_files
+
+def get_song_files(input_path, files, verbose=False):
+    """Returns the list of files to copy for a song directory.
+
+    Returns None if input_path is not a song directory, or is not a
+    compatible one.
+
+    """
     stepfile_exists = any(
         (f.endswith(".sm") or f.endswith(".dwi"))
-        for f in all_files)
+        for f in files)
 
     if not stepfile_exists:
-        return
+        return None
 
     # This is a song directory.  Are we compatible?
     # Currently we must have a .sm and .ogg file.  .dwi and .mp3 are
     # not supported.
-    sm_exists = any(f.endswith(".sm") for f in all_files)
-    ogg_exists = any(f.endswith(".ogg") for f in all_files)
-    mp3_exists = any(f.endswith(".mp3") for f in all_files)
+    sm_exists = any(f.endswith(".sm") for f in files)
+    ogg_exists = any(f.endswith(".ogg") for f in files)
 
     if not sm_exists:
         logger.error(u"Directory {0}: Could not find .sm; only .dwi was found.  Skipping.".format(input_path))
-        return
+        return None
     if not ogg_exists:
-        if any(f.endswith(".mp3") for f in all_files):
+        if any(f.endswith(".mp3") for f in files):
             logger.error(u"Directory {0}: Could not find .ogg; only .mp3 was found.  Skipping.".format(input_path))
         else:
             logger.error(u"Directory {0}: Could not find .ogg.  Skipping.".format(input_path))
-        return
+        return None
 
-    # We are compatible.  Check for destination directory; complain
-    # LOUDLY if not able to create it.
+    # Only copy the audio actually referenced by the charts; packs
+    # frequently carry previews or alternate mixes we don't need.
+    sm_files = [f for f in files if f.endswith(".sm")]
+    ogg_files = smfile.referenced_audio(
+        sm_files, [f for f in files if f.endswith(".ogg")])
+    if verbose:
+        skipped = [f for f in files
+                   if f.endswith(".ogg") and f not in ogg_files]
+        for f in skipped:
+            logger.info(u"Skipping unreferenced audio: {0}".format(f))
+    return sm_files + ogg_files
+
+def get_target_song_dir(input_path, target_dir):
     song_dir_name = os.path.split(input_path)[-1]
-    target_song_dir = os.path.join(
+    return os.path.join(
         target_dir, u"In The Groove 2", u"Songs", song_dir_name)
-    if os.path.exists(target_song_dir):
+
+def copy_song(input_path, song_files, target_dir, verbose=False,
+              overwrite=False, audio_index=None, progress=None, cancel=None,
+              copier=None):
+    """Copies a song's files into the target directory.
+
+    If an audio_index (see r21buddy.dedup) is given, .ogg files are
+    deduplicated and patched as they are copied.
+
+    Returns the target song directory, or None if nothing was copied.
+
+    """
+    # Check for destination directory; complain LOUDLY if not able to
+    # create it.
+    target_song_dir = get_target_song_dir(input_path, target_dir)
+    if not os.path.exists(target_song_dir):
+        os.makedirs(target_song_dir)
+    elif not overwrite:
         logger.error(u"ERROR: {0} already exists; not copying files from {1}.".format(target_song_dir, input_path))
-        return
+        return None
+
+    if progress is None:
+        progress = Progress()
+    if copier is None:
+        copier = Copier()
+    for src_file in song_files:
+        copy_file(src_file, target_song_dir, verbose=verbose,
+                  audio_index=audio_index, progress=progress, cancel=cancel,
+                  copier=copier)
+    return target_song_dir
+
+def copy_file(src_file, target_song_dir, verbose=False, audio_index=None,
+              progress=None, cancel=None, copier=None):
+    """Copies one of a song's files into its target directory.  Returns
+    a copier.CopyResult, or None if the file was deduplicated."""
+    if cancel is not None:
+        cancel.check()
+    dest_file = os.path.join(
+        target_song_dir, os.path.basename(src_file))
+    if verbose:
+        logger.info(u"Copying: {0}\n     to: {1}".format(src_file, dest_file))
+    progress.start_file(dest_file, os.path.getsize(src_file))
+    if os.path.lexists(dest_file):
+        # Never write through an existing file; it may be a
+        # hardlink shared with another song.
+        os.remove(dest_file)
+    if audio_index is not None and src_file.endswith(".ogg"):
+        method = audio_index.copy(src_file, dest_file)
+        if verbose and method != "copied":
+            logger.info(u"Duplicate audio, reused via {0}: {1}".format(method, dest_file))
+        progress.finish_file(dest_file, os.path.getsize(src_file))
+        return None
+    result = copier.copy(src_file, dest_file, progress=progress,
+                         cancel=cancel)
+    if verbose:
+        logger.info(u"Copied at {0}".format(result))
+    progress.finish_file(dest_file)
+    return result
 
-    os.makedirs(target_song_dir)
-    for ext in ".sm", ".ogg":
-        for src_file in (f for f in all_files if f.endswith(ext)):
-            dest_file = os.path.join(
-                target_song_dir, os.path.basename(src_file))
+def copy_batch(songs, target_dir, scheduler=None, verbose=False,
+               audio_index=None, progress=None, cancel=None, copier=None):
+    """Copies a batch of journal songs, in the order given by the
+    scheduler (a scheduler.WriteScheduler), or else song by song.
+    Returns the songs which failed to copy."""
+    failed = set()
+    for song in songs:
+        target_song_dir = get_target_song_dir(song.source, target_dir)
+        try:
+            # Anything here is a partial copy from an earlier,
+            # interrupted attempt.
+            if os.path.exists(target_song_dir):
+                logger.info(u"Removing partial copy: {0}".format(target_song_dir))
+                shutil.rmtree(target_song_dir)
+            # All directories go first, so the directory entries are
+            # written together rather than between files.
+            os.makedirs(target_song_dir)
+        except (IOError, OSError) as e:
+            logger.error(u"ERROR: Failed to copy {0}: {1}".format(song.source, e))
+            failed.add(song)
+    if scheduler is not None:
+        writes = scheduler.order(songs)
+    else:
+        writes = [(song, f) for song in songs for f in song.files]
+    for song, src_file in writes:
+        if song in failed:
+            continue
+        try:
+            result = copy_file(src_file, get_target_song_dir(song.source, target_dir),
+                               verbose=verbose, audio_index=audio_index,
+                               progress=progress, cancel=cancel, copier=copier)
+        except Cancelled:
+            raise
+        except Exception:
+            logger.error(u"ERROR: Failed to copy {0}:\n{1}".format(
+                song.source, traceback.format_exc()))
+            failed.add(song)
+            continue
+        if result is not None and scheduler is not None:
+            scheduler.record(result.size, result.elapsed)
+    return failed
+
+def validate_song(song_files):
+    """Returns a message for each structural problem found in a song's
+    .ogg files.  Raises IOError if a file can't be read."""
+    problems = []
+    for f in song_files:
+        if f.endswith(".ogg"):
+            result = validate_file(f)
+            problems.extend(u"{0}: {1}".format(f, problem)
+                            for problem in result.problems)
+    return problems
+
+def fanout_song(input_path, song_files, fanout, length_patch=True,
+                verbose=False, progress=None, cancel=None):
+    """Reads (and patches) a song's files once, handing the results to
+    a FanoutWriter for writing to all targets.  The whole song is read
+    before any of it is handed over, so a song which can't be read
+    isn't started on any target."""
+    if progress is None:
+        progress = Progress()
+    song_dir_name = os.path.split(input_path)[-1]
+    files = []
+    for src_file in song_files:
+        if cancel is not None:
+            cancel.check()
+        if verbose:
+            logger.info(u"Copying: {0}".format(src_file))
+        with open(src_file, "rb") as infile:
+            data = infile.read()
+        if length_patch and src_file.endswith(".ogg"):
+            data = oggpatch.patch_data(data, verbose=verbose)
+        files.append((src_file, data))
+    fanout.add_song(song_dir_name)
+    for src_file, data in files:
+        progress.start_file(src_file, len(data))
+        fanout.add_file(song_dir_name, os.path.basename(src_file), data)
+        progress.finish_file(src_file, len(data))
+
+def copy_archive(archive_path, target_dir, length_patch=True, verbose=False,
+                 progress=None, cancel=None, copier=None):
+    """Copies the songs in a .zip/.tar song pack into the target
+    directory, patching .ogg files as they are streamed out.  Nothing
+    is extracted to disk first, and the archive is only read once.
+
+    Tar files have no index, so their .sm and .ogg files are copied as
+    they come; audio which the .sm files turn out not to use, and
+    directories which turn out not to be usable songs, are removed at
+    the end.  If the copy fails or is cancelled, songs which weren't
+    finished are removed, so that the next run copies them again.
+
+    Returns the number of songs which couldn't be copied.
+
+    """
+    logger.info(u"INPUT ARCHIVE: {0}".format(repr(archive_path)))
+    if progress is None:
+        progress = Progress()
+    if copier is None:
+        copier = Copier()
+    song_root = os.path.join(target_dir, u"In The Groove 2", u"Songs")
+    song_archive = archive.SongArchive(archive_path)
+    owners = {}        # target song dir -> member dir, for dirs made here
+    existing = set()   # member dirs whose song is already in the target
+    failed = set()     # member dirs with a file which couldn't be copied
+    written = {}       # member name -> target file
+    done = set()       # target song dirs which are complete
+    try:
+        names = None
+        by_dir = {}
+        if song_archive.indexed:
+            songs, problems = song_archive.find_songs()
+            names = [name for song in songs for name in song.members]
+            by_dir = dict((song.member_dir, song) for song in songs)
+        progress.start_planning()
+        for name, size, infile in song_archive.iter_members(names):
+            member_dir = posixpath.dirname(name)
+            if not name.lower().endswith((".sm", ".ogg")) or \
+                    member_dir in existing or member_dir in failed:
+                continue
+            target_song_dir = os.path.join(
+                song_root, song_archive.dir_song_name(member_dir))
+            owner = owners.get(target_song_dir)
+            if (owner is None and os.path.exists(target_song_dir)) or \
+                    owner not in (None, member_dir):
+                existing.add(member_dir)
+                continue
+            if owner is None:
+                os.makedirs(target_song_dir)
+                owners[target_song_dir] = member_dir
+            dest_file = os.path.join(target_song_dir,
+                                     song_archive.dest_name(name))
+            if verbose:
+                logger.info(u"Copying: {0}\n     to: {1}".format(name, dest_file))
+            progress.plan(1, size)
+            try:
+                copy_archive_member(infile, dest_file, size,
+                                    length_patch=length_patch,
+                                    verbose=verbose, progress=progress,
+                                    cancel=cancel, copier=copier)
+            except (IOError, ValueError, IndexError) as e:
+                logger.error(u"ERROR: Could not copy {0} from {1}: {2}".format(
+                    name, archive_path, e))
+                failed.add(member_dir)
+                continue
+            written[name] = dest_file
+            song = by_dir.get(member_dir)
+            if song is not None and all(n in written for n in song.members):
+                done.add(target_song_dir)
+        progress.finish_planning()
+
+        if not song_archive.indexed:
+            songs, problems = song_archive.find_songs()
+        for member_dir, message in problems:
+            logger.error(u"Archive {0}, directory {1}: {2}  Skipping.".format(
+                archive_path, member_dir, message))
+        keep = set()
+        for song in songs:
+            target_song_dir = os.path.join(song_root,
+                                           song_archive.song_name(song))
+            if song.member_dir in existing:
+                logger.error(u"ERROR: {0} already exists; not copying files from {1}.".format(
+                    target_song_dir, archive_path))
+            elif song.member_dir not in failed:
+                keep.update(song.members)
+                done.add(target_song_dir)
+        for name, dest_file in written.items():
+            if name not in keep:
+                os.remove(dest_file)
+    finally:
+        song_archive.close()
+        progress.finish_planning()
+        for target_song_dir in owners:
+            if target_song_dir not in done:
+                shutil.rmtree(target_song_dir, ignore_errors=True)
+    return len(set(song.member_dir for song in songs) & failed)
+
+def copy_archive_member(infile, dest_file, size, length_patch=True,
+                        verbose=False, progress=None, cancel=None,
+                        copier=None):
+    """Copies (and patches) an archive member to dest_file.  On failure
+    no partial file is left behind."""
+    if cancel is not None:
+        cancel.check()
+    progress.start_file(dest_file, size)
+    try:
+        if length_patch and dest_file.lower().endswith(".ogg"):
+            # Patching doesn't change the file size.
+            with open(dest_file, "wb") as outfile:
+                preallocate(outfile, size)
+                oggpatch.patch_stream(infile, outfile, verbose=verbose)
+            progress.finish_file(dest_file, size)
+        else:
+            result = copier.copy_stream(infile, dest_file, size,
+                                        progress=progress, cancel=cancel)
             if verbose:
-                logger.info(u"Copying: {0}\n     to: {1}".format(src_file, dest_file))
-            shutil.copyfile(src_file, dest_file)
+                logger.info(u"Copied at {0}".format(result))
+            progress.finish_file(dest_file)
+    except:
+        if os.path.exists(dest_file):
+            os.remove(dest_file)
+        raise
+    finally:
+        infile.close()
+
+def split_archives(input_paths):
+    """Splits input paths into (directories, archives)."""
+    dirs = []
+    archives = []
+    for input_path in input_paths:
+        if archive.is_archive(input_path):
+            archives.append(input_path)
+        else:
+            dirs.append(input_path)
+    return dirs, archives
+
+def patch_length(target_dir, verbose=False, skip=(), progress=None,
+                 cancel=None, jobs=1, budget=None, supervisor=None,
+                 pool=None):
+    """Patches all .ogg files in the target directory.
+
+    Files listed in skip (e.g. those already patched while being
+    copied) are left alone.
 
-def patch_length(target_dir, verbose=False):
+    """
+    ogg_files = get_target_ogg_files(target_dir, skip=skip)
+    if progress is not None:
+        plan_files(ogg_files, progress)
+    patch_files(ogg_files, verbose=verbose, progress=progress, cancel=cancel,
+                jobs=jobs, budget=budget, supervisor=supervisor, pool=pool)
+
+def get_target_ogg_files(target_dir, skip=()):
     song_dir = os.path.join(target_dir, u"In The Groove 2", u"Songs")
     all_files = [os.path.join(song_dir, f) for f in os.listdir(song_dir)]
     dirs = [d for d in all_files if os.path.isdir(d)]
+    ogg_files = []
     for song_dir in dirs:
-        song_files = (os.path.join(song_dir, f) for f in os.listdir(song_dir))
-        ogg_files = (f for f in song_files if f.endswith(".ogg"))
-        for ogg_file in ogg_files:
+        ogg_files.extend(get_ogg_files(song_dir, skip=skip))
+    return ogg_files
+
+def plan_files(files, progress):
+    progress.plan(len(files), sum(os.path.getsize(f) for f in files))
+
+def get_ogg_files(song_dir, skip=()):
+    song_files = (os.path.join(song_dir, f) for f in os.listdir(song_dir))
+    return [f for f in song_files if f.endswith(".ogg") and f not in skip]
+
+def patch_song_dir(song_dir, verbose=False, skip=(), progress=None,
+                   cancel=None, jobs=1, budget=None, supervisor=None):
+    patch_files(get_ogg_files(song_dir, skip=skip), verbose=verbose,
+                progress=progress, cancel=cancel, jobs=jobs, budget=budget,
+                supervisor=supervisor)
+
+class PatchPool(object):
+
+    """Patches files jobs at a time, on threads which are kept for a
+    whole run.  If a budget.MemoryBudget is given, the workers share
+    it.
+
+    If an isolate.Supervisor is given, files are patched in its worker
+    processes instead, and failures are quarantined with it.
+
+    """
+
+    def __init__(self, jobs=1, budget=None, supervisor=None, progress=None,
+                 cancel=None):
+        self.budget = budget
+        self.supervisor = supervisor
+        self.progress = progress if progress is not None else Progress()
+        self.cancel = cancel
+        self.local = threading.local()
+        self.pool = ThreadPool(jobs) if jobs > 1 else None
+
+    def imap(self, ogg_files):
+        """Patches ogg_files, yielding a PatchResult for each in order
+        as they're done."""
+        if self.pool is None:
+            return itertools.imap(self._work, ogg_files)
+        return self.pool.imap(self._work, ogg_files)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _work(self, ogg_file):
+        if self.cancel is not None:
+            self.cancel.check()
+        if self.supervisor is not None:
+            patcher = self.supervisor.checkout()
+        else:
+            patcher = getattr(self.local, "patcher", None)
+            if patcher is None:
+                patcher = self.local.patcher = oggpatch.Patcher(
+                    logger=logger, budget=self.budget)
+        try:
+            size = os.path.getsize(ogg_file)
+            self.progress.start_file(ogg_file, size)
+            result = patcher.patch(ogg_file)
+            self.progress.finish_file(ogg_file, size)
+        except (IOError, OSError) as e:
+            result = oggpatch.PatchResult(ogg_file, error=e)
+        finally:
+            if self.supervisor is not None:
+                self.supervisor.checkin(patcher)
+        if not result.ok and self.supervisor is not None:
+            self.supervisor.quarantine(result)
+        return result
+
+def report_patch_result(result, verbose=False, supervisor=None):
+    if not result.ok:
+        # One bad file shouldn't stop the rest of the run.
+        logger.error(u"ERROR: Could not patch {0}: {1}".format(
+            result.path, result.error))
+        if supervisor is not None:
+            logger.error(u"Quarantined; will retry at the end of the run.")
+    elif verbose:
+        logger.info(unicode(result))
+    for start, end in result.skipped:
+        logger.error(u"WARNING: {0}: skipped {1} bytes of invalid data at offset {2}.".format(
+            result.path, end - start, start))
+
+def patch_files(ogg_files, verbose=False, progress=None, cancel=None,
+                jobs=1, budget=None, supervisor=None, pool=None):
+    """Patches the given files, using pool (a PatchPool) if given, or
+    else a new one with the other arguments."""
+    own_pool = pool is None
+    if own_pool:
+        pool = PatchPool(jobs, budget=budget, supervisor=supervisor,
+                         progress=progress, cancel=cancel)
+    try:
+        for result in pool.imap(ogg_files):
+            report_patch_result(result, verbose=verbose,
+                                supervisor=pool.supervisor)
+    finally:
+        if own_pool:
+            pool.close()
+
+def retry_quarantined(supervisor, target_dir, verbose=False):
+    """Retries the files quarantined during a run, and reports any
+    which still fail."""
+    if len(supervisor.quarantined) == 0:
+        return
+    logger.info(u"Retrying {0} quarantined file(s)...".format(
+        len(supervisor.quarantined)))
+    for result in supervisor.retry():
+        if not result.ok:
+            logger.error(u"ERROR: Could not patch {0}: {1}".format(
+                result.path, result.error))
+        elif verbose:
+            logger.info(unicode(result))
+    report_path = os.path.join(target_dir, isolate.QUARANTINE_NAME)
+    if len(supervisor.failed) > 0:
+        supervisor.write_report(report_path)
+        logger.error(u"{0} file(s) could not be patched; see {1}".format(
+            len(supervisor.failed), report_path))
+    elif os.path.exists(report_path):
+        os.remove(report_path)  # Stale, from an earlier run
+
+def watch_songs(target_dir, input_paths, length_patch=True, verbose=False,
+                poll_interval=watch.POLL_INTERVAL,
+                settle_time=watch.SETTLE_TIME, stop_event=None,
+                audio_index=None, progress=None, cancel=None, copier=None,
+                pool=None, validate=False):
+    """Keeps copying/patching songs as they appear in input_paths.
+
+    Runs until stop_event is set or cancel (a progress.CancelToken) is
+    cancelled, or forever if neither is specified.  Files are patched
+    by pool (a PatchPool) if given.  As there's no end to the work,
+    progress totals stay provisional.
+
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    if progress is None:
+        progress = Progress()
+    own_pool = pool is None and length_patch
+    if own_pool:
+        pool = PatchPool(progress=progress, cancel=cancel)
+    poller = watch.DirectoryPoller(input_paths, settle_time=settle_time)
+    logger.info(u"Watching for new songs.  (Press Ctrl-C to stop.)")
+    progress.start_planning()
+    try:
+        _watch_loop(target_dir, poller, length_patch=length_patch,
+                    verbose=verbose, poll_interval=poll_interval,
+                    stop_event=stop_event, audio_index=audio_index,
+                    progress=progress, cancel=cancel, copier=copier,
+                    pool=pool, validate=validate)
+    except (KeyboardInterrupt, Cancelled):
+        logger.info(u"Stopped watching.")
+    finally:
+        progress.finish_planning()
+        if own_pool:
+            pool.close()
+
+def _watch_loop(target_dir, poller, length_patch=True, verbose=False,
+                poll_interval=watch.POLL_INTERVAL, stop_event=None,
+                audio_index=None, progress=None, cancel=None, copier=None,
+                pool=None, validate=False):
+    owners = {}  # target song dir -> source song dir
+    first_poll = True
+    while not stop_event.is_set():
+        for input_path, files in poller.poll():
+            if cancel is not None:
+                cancel.check()
+            try:
+                _watch_copy_song(input_path, files, target_dir, owners,
+                                 first_poll, length_patch=length_patch,
+                                 verbose=verbose, audio_index=audio_index,
+                                 progress=progress, cancel=cancel,
+                                 copier=copier, pool=pool, validate=validate)
+            except (IOError, OSError) as e:
+                # E.g. a file deleted between the poll and the copy.
+                # One bad song mustn't end the watch; it's copied again
+                # (over any partial copy) once it changes.
+                logger.error(u"ERROR: Failed to copy {0}: {1}".format(
+                    input_path, e))
+        first_poll = False
+        stop_event.wait(poll_interval)
+        if cancel is not None:
+            cancel.check()
+
+def _watch_copy_song(input_path, files, target_dir, owners, first_poll,
+                     length_patch=True, verbose=False, audio_index=None,
+                     progress=None, cancel=None, copier=None, pool=None,
+                     validate=False):
+    """Copies and patches a song found by the watch poller, recording
+    in owners which source each target song directory came from."""
+    song_files = get_song_files(input_path, files, verbose=verbose)
+    if song_files is None:
+        return
+    target_song_dir = get_target_song_dir(input_path, target_dir)
+    owner = owners.get(target_song_dir)
+    if owner is None and os.path.exists(target_song_dir):
+        if first_poll:
+            # Copied by an earlier run; only pick it up again if it
+            # changes.
+            owners[target_song_dir] = input_path
             if verbose:
-                logger.info(u"Patching file: {0}".format(ogg_file))
-            oggpatch.patch_file(ogg_file, verbose=verbose)
+                logger.info(u"Already present: {0}".format(target_song_dir))
+        else:
+            logger.error(u"ERROR: {0} already exists; not copying files from {1}.".format(target_song_dir, input_path))
+        return
+    elif owner is not None and owner != input_path:
+        logger.error(u"ERROR: {0} already exists; not copying files from {1}.".format(target_song_dir, input_path))
+        return
+    if validate:
+        problems = validate_song(song_files)
+        if len(problems) > 0:
+            logger.error(u"ERROR: Not copying {0}; its audio looks broken:".format(
+                input_path))
+            for problem in problems:
+                logger.error(u"  {0}".format(problem))
+            return
+    logger.info(u"New or changed song: {0}".format(input_path))
+    progress.plan(len(song_files), sum(os.path.getsize(f) for f in song_files))
+    # Claimed before copying, so that if the copy fails part way, the
+    # next change to the song is copied over it.
+    owners[target_song_dir] = input_path
+    copied_dir = copy_song(input_path, song_files, target_dir,
+                           verbose=verbose, overwrite=(owner is not None),
+                           audio_index=audio_index, progress=progress,
+                           cancel=cancel, copier=copier)
+    if length_patch:
+        skip = audio_index.handled if audio_index is not None else ()
+        ogg_files = get_ogg_files(copied_dir, skip=skip)
+        plan_files(ogg_files, progress)
+        patch_files(ogg_files, verbose=verbose, pool=pool)
+
+def run_fanout(target_dirs, input_paths, length_patch=True, verbose=False,
+               walkers=discovery.DEFAULT_WALKERS, progress=None, cancel=None,
+               validate=False):
+    """Copies songs to several targets, reading each source file once.
+    A song which can't be read is skipped; a target which fails is
+    dropped, and the others carry on.  Returns 0 if everything was
+    copied to every target, else 1."""
+    if progress is None:
+        progress = Progress()
+    for target_dir in target_dirs:
+        create_target_dir_structure(target_dir, verbose=verbose)
+
+    fanout = FanoutWriter(target_dirs)
+    failed = 0
+    progress.start_planning()
+    try:
+        for song_dir, song_files in walk_songs(input_paths, verbose=verbose,
+                                               walkers=walkers):
+            if cancel is not None:
+                cancel.check()
+            try:
+                if validate:
+                    problems = validate_song(song_files)
+                    if len(problems) > 0:
+                        logger.error(u"ERROR: Not copying {0}; its audio looks broken:".format(
+                            song_dir))
+                        for problem in problems:
+                            logger.error(u"  {0}".format(problem))
+                        continue
+                progress.plan(len(song_files),
+                              sum(os.path.getsize(f) for f in song_files))
+                fanout_song(song_dir, song_files, fanout,
+                            length_patch=length_patch, verbose=verbose,
+                            progress=progress, cancel=cancel)
+            except (IOError, OSError, ValueError, IndexError) as e:
+                logger.error(u"ERROR: Failed to copy {0}: {1}".format(
+                    song_dir, e))
+                failed += 1
+    finally:
+        progress.finish_planning()
+        results = fanout.close()
+
+    for result in results:
+        # Pick up any pre-existing files on the target which still
+        # need patching.
+        if length_patch and result.failure is None:
+            patch_length(result.target_dir, verbose=verbose,
+                         skip=result.written, progress=progress,
+                         cancel=cancel)
+        for error in result.errors:
+            logger.error(u"ERROR: {0}".format(error))
+        if result.failure is not None:
+            logger.error(result.failure)
+    logger.info(u"Results per target:")
+    for result in results:
+        logger.info(u"  {0}".format(result))
+    if failed > 0:
+        logger.error(u"{0} song(s) could not be read.".format(failed))
+    return 0 if failed == 0 and all(result.ok for result in results) else 1
+
+def walk_songs(input_paths, verbose=False, walkers=discovery.DEFAULT_WALKERS):
+    """Yields (song_dir, song_files) for all input paths, in order.
+    With more than one walker, directories are listed in parallel."""
+    lister = None
+    if walkers > 1:
+        lister = discovery.ParallelLister(walkers)
+        for input_path in input_paths:
+            lister.submit(input_path)
+    try:
+        for input_path in input_paths:
+            for song in find_songs(input_path, verbose=verbose, lister=lister):
+                yield song
+    finally:
+        if lister is not None:
+            lister.close()
+
+def plan_songs(song_journal, target_dir, songs, resume=False):
+    """Records each (song_dir, song_files) to copy in the journal as it
+    is found, and yields its journal entry.  Entries are synced to disk
+    a batch at a time, before any of them is yielded (and copied).
+
+    With resume set, songs are added to an existing journal, and those
+    already in it are passed over.
+
+    """
+    if not resume:
+        song_journal.start()
+    batch = []
+    for song_dir, song_files in songs:
+        target_song_dir = get_target_song_dir(song_dir, target_dir)
+        name = os.path.basename(target_song_dir)
+        if resume and name in song_journal.by_name:
+            continue
+        if os.path.exists(target_song_dir) or name in song_journal.by_name:
+            logger.error(u"ERROR: {0} already exists; not copying files from {1}.".format(target_song_dir, song_dir))
+            continue
+        batch.append(song_journal.plan(name, song_dir, song_files,
+                                       sync=False))
+        if len(batch) >= journal.SYNC_BATCH:
+            song_journal.sync()
+            for entry in batch:
+                yield entry
+            batch = []
+    song_journal.finish_planning()
+    for entry in batch:
+        yield entry
+
+def make_plan(target_dir, input_paths, length_patch=True, verbose=False,
+              walkers=discovery.DEFAULT_WALKERS):
+    """Builds a planner.Plan for a run, without writing anything (aside
+    from a short throughput probe in the target directory)."""
+    songs = [(song_dir, song_files, get_target_song_dir(song_dir, target_dir))
+             for song_dir, song_files in walk_songs(input_paths, verbose=verbose,
+                                                    walkers=walkers)]
+    existing_oggs = []
+    song_root = os.path.join(target_dir, u"In The Groove 2", u"Songs")
+    if length_patch and os.path.isdir(song_root):
+        for d in os.listdir(song_root):
+            if os.path.isdir(os.path.join(song_root, d)):
+                existing_oggs.extend(get_ogg_files(os.path.join(song_root, d)))
+    plan = planner.build_plan(target_dir, songs, length_patch=length_patch,
+                              existing_oggs=existing_oggs)
+    try:
+        planner.measure(plan)
+    except (IOError, OSError):
+        logger.error(u"Could not measure throughput; no time estimate available.")
+    return plan
+
+def report_plan(plan, verbose=False):
+    def mb(size):
+        return u"{0:.1f} MB".format(size / (1024.0 * 1024))
+    def rate(r):
+        if r is None:
+            return u"n/a"
+        return u"{0}/s".format(mb(r))
+    if verbose:
+        for song in plan.songs:
+            logger.info(u"Copy: {0} ({1}, {2} to patch)".format(
+                song.source, mb(song.size), len(song.patch)))
+        for f, size in plan.existing_patch:
+            logger.info(u"Patch existing: {0}".format(f))
+    for source, reason in plan.skipped:
+        logger.info(u"Skip: {0} ({1})".format(source, reason))
+    logger.info(u"Songs to copy:   {0} ({1} files, {2})".format(
+        len(plan.songs), plan.copy_files, mb(plan.copy_size)))
+    logger.info(u"Files to patch:  {0} ({1} in place, {2} rewritten: {3})".format(
+        plan.patch_files, plan.patch_files - plan.full_files,
+        plan.full_files, mb(plan.full_size)))
+    logger.info(u"Songs skipped:   {0}".format(len(plan.skipped)))
+    if plan.tail_patch_time is None:
+        tail_time = u"n/a"
+    else:
+        tail_time = u"{0:.1f} ms".format(plan.tail_patch_time * 1000)
+    logger.info(u"Measured read: {0}, write: {1}, patch in place: {2} per file, rewrite: {3}".format(
+        rate(plan.read_rate), rate(plan.write_rate), tail_time,
+        rate(plan.patch_rate)))
+    estimate = plan.estimate()
+    if estimate is not None:
+        logger.info(u"Estimated time:  {0}".format(oggpatch.pprint_time(estimate)))
+
+def verify_song(song, target_song_dir, length_patch=True):
+    """Returns a list of problems with a copied song; empty if OK."""
+    problems = []
+    for src_file in song.files:
+        dest_file = os.path.join(target_song_dir, os.path.basename(src_file))
+        if not os.path.isfile(dest_file):
+            problems.append(u"Missing file: {0}".format(dest_file))
+        elif os.path.getsize(dest_file) != os.path.getsize(src_file):
+            problems.append(u"Size mismatch: {0}".format(dest_file))
+        elif (length_patch and dest_file.endswith(".ogg")
+              and planner.needs_patch(dest_file)):
+            problems.append(u"Not patched: {0}".format(dest_file))
+    return problems
 
-def run(target_dir, input_paths, length_patch=True, verbose=False, ext_logger=None):
+def plan_progress(songs, progress, length_patch=True, dedup=False):
+    """Adds the work needed to finish the given journal songs to the
+    progress totals."""
+    files = 0
+    size = 0
+    for song in songs:
+        for f in song.files:
+            try:
+                file_size = os.path.getsize(f)
+            except OSError:
+                continue  # Reported when we try to copy it.
+            if not song.reached(journal.COPIED):
+                files += 1
+                size += file_size
+            if (length_patch and not dedup and f.endswith(".ogg")
+                    and not song.reached(journal.PATCHED)):
+                files += 1
+                size += file_size
+    progress.plan(files, size)
+
+def plan_progress_as_found(songs, progress, length_patch=True, dedup=False):
+    """Yields the journal songs from songs (an iterator), adding each
+    one's work to the progress totals as it comes.  The totals are
+    marked provisional until songs runs out."""
+    progress.start_planning()
+    try:
+        for song in songs:
+            plan_progress([song], progress, length_patch=length_patch,
+                          dedup=dedup)
+            yield song
+    finally:
+        progress.finish_planning()
+
+def process_journal(song_journal, target_dir, length_patch=True,
+                    verbose=False, audio_index=None, progress=None,
+                    cancel=None, copier=None, jobs=1, budget=None,
+                    supervisor=None, validate=False, scheduler=None,
+                    pool=None, songs=None):
+    """Copies, patches and verifies every song in the journal which
+    isn't verified yet, or else the journal entries yielded by songs
+    (e.g. by plan_songs, as they're found).  Work recorded as done is
+    not repeated.  If validate is set, songs with structurally broken
+    audio are skipped rather than copied.
+
+    Songs are copied in the batches and order given by scheduler (a
+    scheduler.WriteScheduler), then the .ogg files of a whole batch are
+    patched together by pool (a PatchPool; a new one is made from jobs,
+    budget and supervisor if not given).  Without a scheduler, each
+    song is copied on its own.
+
+    If songs is a list, all of its work is added to progress up front;
+    otherwise each song's work is added as it is found.
+
+    """
+    if progress is None:
+        progress = Progress()
+    if copier is None:
+        copier = Copier()
+    own_pool = pool is None and length_patch
+    if own_pool:
+        pool = PatchPool(jobs, budget=budget, supervisor=supervisor,
+                         progress=progress, cancel=cancel)
+    dedup = audio_index is not None
+    if songs is None:
+        songs = song_journal.pending
+    if isinstance(songs, list):
+        plan_progress(songs, progress, length_patch=length_patch, dedup=dedup)
+        pending = songs
+    else:
+        pending = plan_progress_as_found(songs, progress,
+                                         length_patch=length_patch,
+                                         dedup=dedup)
+    if scheduler is not None:
+        batches = scheduler.batches(pending)
+    else:
+        batches = ([song] for song in pending)
+    try:
+        for batch in batches:
+            if cancel is not None:
+                cancel.check()
+            to_copy = []
+            for song in batch:
+                if song.reached(journal.COPIED):
+                    continue
+                if validate:
+                    try:
+                        problems = validate_song(song.files)
+                    except IOError as e:
+                        logger.error(u"ERROR: Failed to check {0}: {1}".format(
+                            song.source, e))
+                        song_journal.record(song.name, journal.FAILED)
+                        continue
+                    if len(problems) > 0:
+                        logger.error(u"ERROR: Not copying {0}; its audio looks broken:".format(
+                            song.source))
+                        for problem in problems:
+                            logger.error(u"  {0}".format(problem))
+                        # Retrying won't fix the files, so don't leave
+                        # the song pending.
+                        song_journal.record(song.name, journal.SKIPPED)
+                        continue
+                to_copy.append(song)
+            failed = copy_batch(to_copy, target_dir, scheduler=scheduler,
+                                verbose=verbose, audio_index=audio_index,
+                                progress=progress, cancel=cancel,
+                                copier=copier)
+            for song in to_copy:
+                song_journal.record(song.name, journal.FAILED if song in failed
+                                    else journal.COPIED)
+            process_copied_songs(
+                song_journal,
+                [song for song in batch if song.reached(journal.COPIED)],
+                target_dir, length_patch=length_patch, verbose=verbose,
+                audio_index=audio_index, pool=pool)
+    finally:
+        if own_pool:
+            pool.close()
+
+def process_copied_songs(song_journal, songs, target_dir, length_patch=True,
+                         verbose=False, audio_index=None, pool=None):
+    """Patches and verifies songs which have been copied.  All their
+    .ogg files are handed to pool at once; each song is recorded as
+    patched and verified as soon as its own files are done."""
+    skip = audio_index.handled if audio_index is not None else ()
+    ogg_files = []
+    remaining = {}      # Song name -> number of files still being patched
+    owners = {}         # .ogg file -> song
+    ready = []
+    for song in songs:
+        if not length_patch or song.reached(journal.PATCHED):
+            ready.append(song)
+            continue
+        target_song_dir = get_target_song_dir(song.source, target_dir)
+        try:
+            song_oggs = get_ogg_files(target_song_dir, skip=skip)
+        except OSError as e:
+            logger.error(u"ERROR: Failed to patch {0}: {1}".format(song.source, e))
+            song_journal.record(song.name, journal.FAILED)
+            continue
+        if len(song_oggs) == 0:
+            song_journal.record(song.name, journal.PATCHED)
+            ready.append(song)
+            continue
+        remaining[song.name] = len(song_oggs)
+        for ogg_file in song_oggs:
+            owners[ogg_file] = song
+        ogg_files.extend(song_oggs)
+
+    for song in ready:
+        verify_copied_song(song_journal, song, target_dir,
+                           length_patch=length_patch)
+    if len(ogg_files) == 0:
+        return
+    for result in pool.imap(ogg_files):
+        report_patch_result(result, verbose=verbose,
+                            supervisor=pool.supervisor)
+        song = owners[result.path]
+        remaining[song.name] -= 1
+        if remaining[song.name] == 0:
+            song_journal.record(song.name, journal.PATCHED)
+            verify_copied_song(song_journal, song, target_dir,
+                               length_patch=length_patch)
+
+def verify_copied_song(song_journal, song, target_dir, length_patch=True):
+    target_song_dir = get_target_song_dir(song.source, target_dir)
+    try:
+        problems = verify_song(song, target_song_dir,
+                               length_patch=length_patch)
+    except Exception:
+        # Keep going with the other songs; a later --resume will
+        # retry this one.
+        logger.error(u"ERROR: Failed to verify {0}:\n{1}".format(
+            song.source, traceback.format_exc()))
+        song_journal.record(song.name, journal.FAILED)
+        return
+    if len(problems) > 0:
+        for problem in problems:
+            logger.error(u"ERROR: {0}".format(problem))
+        song_journal.record(song.name, journal.FAILED)
+    else:
+        song_journal.record(song.name, journal.VERIFIED)
+
+def run(target_dir, input_paths, length_patch=True, verbose=False, ext_logger=None,
+        watch=False, poll_interval=None, settle_time=None, stop_event=None,
+        dedup=False, resume=False, progress=None, cancel=None,
+        plan_only=False, save_plan=None, execute_plan=None, block_size=None,
+        jobs=1, memory_budget=DEFAULT_LIMIT,
+        walkers=discovery.DEFAULT_WALKERS, validate=False, isolated=False,
+        timeout=isolate.DEFAULT_TIMEOUT,
+        memory_limit=isolate.DEFAULT_MEMORY_LIMIT, schedule_writes=True):
+    """Copies and/or patches songs into target_dir.
+
+    progress (a progress.Progress) and cancel (a progress.CancelToken)
+    allow another thread to monitor and stop the run.  block_size is the
+    copy block size in bytes; if None, it is tuned automatically.  jobs
+    files are patched at once, holding at most memory_budget bytes of
+    file data in memory between them.  walkers threads list input
+    directories in parallel.  validate checks each song's audio before
+    copying it (see validate.py).  If isolated is set, each file is
+    patched in a worker process limited to timeout seconds and
+    memory_limit bytes (see isolate.Supervisor).  Unless
+    schedule_writes is False, copies are batched and ordered for the
+    target drive (see scheduler.WriteScheduler).
+
+    Returns 0 on success, or 1 if any song failed or the run stopped
+    early.
+
+    """
     global logger
+    old_loggers = logger, oggpatch.get_logger()
     try:
-        if logger is not None:
+        if ext_logger is not None:
             logger = ext_logger
             oggpatch.set_logger(logger)
+
+        # target_dir may also be a list of several targets.
+        if not isinstance(target_dir, basestring):
+            target_dir = list(target_dir)
+            if len(target_dir) == 1:
+                target_dir = target_dir[0]
+
+        input_paths, archive_paths = split_archives(input_paths)
+        if len(archive_paths) > 0 and (
+                watch or plan_only or resume or execute_plan is not None
+                or not isinstance(target_dir, basestring)):
+            logger.error(u"Archives can only be used as input for plain copies to a single target; ignoring: {0}".format(
+                u", ".join(archive_paths)))
+            archive_paths = []
+
+        # Dry runs come first: whatever the other options, nothing may
+        # be written.
+        if plan_only:
+            if isinstance(target_dir, basestring):
+                plan_targets = [target_dir]
+            elif save_plan is not None:
+                logger.error(u"Plans can only be saved for a single target directory.")
+                return 1
+            else:
+                plan_targets = target_dir
+            for plan_target in plan_targets:
+                if len(plan_targets) > 1:
+                    logger.info(u"Plan for {0}:".format(plan_target))
+                plan = make_plan(plan_target, input_paths,
+                                 length_patch=length_patch, verbose=verbose,
+                                 walkers=walkers)
+                report_plan(plan, verbose=verbose)
+            if save_plan is not None:
+                plan.save(save_plan)
+                logger.info(u"Plan saved to {0}".format(save_plan))
+            return 0
+
+        if watch and (resume or execute_plan is not None):
+            logger.error(u"Watch mode can't be combined with --resume or --execute-plan.")
+            return 1
+
+        if not isinstance(target_dir, basestring):
+            if watch or dedup or resume or execute_plan is not None:
+                logger.error(u"Watch, dedup, resume and saved plans only support a single target directory.")
+                return 1
+            if jobs > 1 or isolated:
+                # Songs are patched in memory, once for all targets.
+                logger.error(u"--jobs and --isolate only support a single target directory.")
+                return 1
+            return run_fanout(target_dir, input_paths,
+                              length_patch=length_patch, verbose=verbose,
+                              walkers=walkers, progress=progress,
+                              cancel=cancel, validate=validate)
+
+        if execute_plan is not None:
+            plan = planner.Plan.load(execute_plan)
+            # The plan's list of existing files to patch belongs to the
+            # target it was made for.
+            if os.path.normcase(os.path.realpath(plan.target_dir)) != \
+                    os.path.normcase(os.path.realpath(target_dir)):
+                logger.error(u"The plan in {0} was made for {1}, not {2}; make a new plan for this target.".format(
+                    execute_plan, plan.target_dir, target_dir))
+                return 1
+
         create_target_dir_structure(target_dir, verbose=verbose)
 
-        for input_path in input_paths:
-            copy_songs(input_path, target_dir, verbose=verbose)
+        audio_index = None
+        if dedup:
+            audio_index = AudioIndex(length_patch=length_patch,
+                                     verbose=verbose)
+
+        if progress is None:
+            progress = Progress()
+        copier = Copier(block_size=block_size)
+        scheduler = WriteScheduler() if schedule_writes else None
+        budget = MemoryBudget(memory_budget)
+        supervisor = None
+        if isolated and length_patch:
+            supervisor = isolate.Supervisor(timeout=timeout,
+                                            memory_limit=memory_limit)
 
-        # *NOTE:* If no input paths are specified, this tool can be used
-        # to patch the length on existing ogg files in the target dir.
-        if length_patch:
-            patch_length(target_dir, verbose=verbose)
+        if watch:
+            kwargs = {}
+            if poll_interval is not None:
+                kwargs["poll_interval"] = poll_interval
+            if settle_time is not None:
+                kwargs["settle_time"] = settle_time
+            pool = PatchPool(jobs, budget=budget, supervisor=supervisor,
+                             progress=progress, cancel=cancel)
+            try:
+                watch_songs(target_dir, input_paths,
+                            length_patch=length_patch, verbose=verbose,
+                            stop_event=stop_event, audio_index=audio_index,
+                            progress=progress, cancel=cancel, copier=copier,
+                            pool=pool, validate=validate, **kwargs)
+                if supervisor is not None:
+                    retry_quarantined(supervisor, target_dir,
+                                      verbose=verbose)
+            finally:
+                pool.close()
+                if supervisor is not None:
+                    supervisor.close()
+            return 0
+        song_journal = journal.Journal(target_dir)
+        if resume:
+            if not song_journal.load():
+                logger.error(u"No journal found in {0}; nothing to resume.".format(target_dir))
+                return 1
+            if song_journal.complete:
+                logger.info(u"The last run already completed; nothing to resume.")
+                return 0
+            logger.info(u"Resuming: {0} of {1} songs left to do.".format(
+                len(song_journal.pending), len(song_journal.songs)))
+            songs = song_journal.pending
+            if not song_journal.all_planned:
+                if len(input_paths) > 0:
+                    logger.info(u"The interrupted run hadn't found every song yet; scanning the input path(s) for the rest.")
+                    songs = itertools.chain(songs, plan_songs(
+                        song_journal, target_dir,
+                        walk_songs(input_paths, verbose=verbose,
+                                   walkers=walkers),
+                        resume=True))
+                else:
+                    logger.error(u"The interrupted run hadn't found every song yet; give the input path(s) again to pick up the rest.")
+        elif execute_plan is not None:
+            length_patch = plan.length_patch
+            songs = plan_songs(song_journal, target_dir,
+                               [(song.source, song.files) for song in plan.songs])
+        else:
+            songs = plan_songs(song_journal, target_dir,
+                               walk_songs(input_paths, verbose=verbose,
+                                          walkers=walkers))
+
+        # *NOTE:* If no input paths are specified, this tool can be
+        # used to patch the length on existing ogg files in the target
+        # dir.  They're listed now so the progress total includes them
+        # from the start; the songs this run copies can't be among
+        # them, as existing song directories are never copied over.
+        existing_oggs = []
+        if length_patch and execute_plan is not None:
+            existing_oggs = [f for f, size in plan.existing_patch
+                             if os.path.isfile(f)]
+        elif length_patch:
+            # Songs from the journal are dealt with by process_journal.
+            skip = set()
+            for song in song_journal.songs:
+                target_song_dir = get_target_song_dir(song.source, target_dir)
+                skip.update(os.path.join(target_song_dir, os.path.basename(f))
+                            for f in song.files)
+            existing_oggs = get_target_ogg_files(target_dir, skip=skip)
+        plan_files(existing_oggs, progress)
+
+        # One set of patching threads for the whole run.
+        pool = PatchPool(jobs, budget=budget, supervisor=supervisor,
+                         progress=progress, cancel=cancel)
+        try:
+            process_journal(song_journal, target_dir,
+                            length_patch=length_patch, verbose=verbose,
+                            audio_index=audio_index, progress=progress,
+                            cancel=cancel, copier=copier,
+                            validate=validate, scheduler=scheduler,
+                            pool=pool, songs=songs)
+            if verbose and scheduler is not None:
+                logger.info(u"Write scheduling: {0}".format(scheduler))
+            archive_failures = 0
+            for archive_path in archive_paths:
+                archive_failures += copy_archive(
+                    archive_path, target_dir, length_patch=length_patch,
+                    verbose=verbose, progress=progress, cancel=cancel,
+                    copier=copier)
+            patch_files(existing_oggs, verbose=verbose, pool=pool)
+            if supervisor is not None:
+                retry_quarantined(supervisor, target_dir, verbose=verbose)
+            elif jobs > 1 or verbose:
+                logger.info(u"Memory use while patching: {0}".format(budget))
+            if len(song_journal.skipped) > 0:
+                logger.error(u"{0} song(s) with broken audio were not copied.".format(
+                    len(song_journal.skipped)))
+            if archive_failures > 0:
+                logger.error(u"{0} song(s) from archives failed.".format(
+                    archive_failures))
+            if len(song_journal.pending) > 0:
+                logger.error(u"{0} song(s) failed; rerun with --resume to retry them.".format(
+                    len(song_journal.pending)))
+                return 1
+            elif song_journal.all_planned:
+                song_journal.finish()
+            else:
+                return 1
+            return 1 if archive_failures > 0 else 0
+        finally:
+            song_journal.close()
+            pool.close()
+            if supervisor is not None:
+                supervisor.close()
+    except Cancelled:
+        logger.error(u"Cancelled.  Rerun with --resume to continue where this run stopped.")
+        return 1
     except:
         msg = traceback.format_exc()
         try:
@@ -132,12 +1329,26 @@ def run(target_dir, input_paths, length_patch=True, verbose=False, ext_logger=No
         except UnicodeDecodeError:
             enc_msg = repr(msg).decode()
         logger.error(enc_msg)
+        return 1
+    finally:
+        logger = old_loggers[0]
+        oggpatch.set_logger(old_loggers[1])
 
 def main():
     options = parse_args()
-    run(options.target_dir, options.input_path,
-        length_patch=options.length_patch, verbose=options.verbose)
-    return 0
+    return run(options.target_dir, options.input_path,
+        length_patch=options.length_patch, verbose=options.verbose,
+        watch=options.watch, poll_interval=options.poll_interval,
+        settle_time=options.settle_time, dedup=options.dedup,
+        resume=options.resume, plan_only=(options.plan or options.save_plan is not None),
+        save_plan=options.save_plan, execute_plan=options.execute_plan,
+        block_size=(options.block_size * 1024 * 1024
+                    if options.block_size else None),
+        jobs=options.jobs, memory_budget=options.memory_budget * 1024 * 1024,
+        walkers=options.walkers, validate=options.validate,
+        isolated=options.isolate,
+        timeout=options.timeout,
+        memory_limit=options.memory_limit * 1024 * 1024)
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -2,13 +2,17 @@ from __future__ import absolute_import
 
 import os, sys, threading, time
 from cStringIO import StringIO
-import Tkinter, tkFileDialog, tkMessageBox
+import Tkinter, ttk, tkFileDialog, tkMessageBox
 from r21buddy import oggpatch, r21buddy
 from r21buddy.logger import ThreadQueueLogger
+from r21buddy.logview import LogView
+from r21buddy.progress import Progress, CancelToken
 
 # Interval to poll stdout/stderr capture of r21buddy console code.
 POLL_INTERVAL = 100  # milliseconds
 
+LOG_FILE_NAME = u"r21buddy-log.txt"
+
 
 def askdirectory(*args, **kwargs):
     """Workaround for Tkinter-related encoding oddities."""
@@ -139,20 +143,36 @@ class MainWindow(object):
             variable=self.skip_ogg_patch)
         self.skip_ogg_chk.pack(anchor=Tkinter.W)
 
+        self.save_log = Tkinter.IntVar()
+        self.save_log_chk = Tkinter.Checkbutton(
+            control_frame,
+            text=u"Save full log to {0} in the target directory".format(LOG_FILE_NAME),
+            variable=self.save_log)
+        self.save_log_chk.pack(anchor=Tkinter.W)
+
+        run_frame = Tkinter.Frame(control_frame)
+        run_frame.pack()
         self.run_btn = Tkinter.Button(
-            control_frame, text="Run", command=self.on_run, width=10)
-        self.run_btn.pack()
-
-        # Scrollable text area for log output
-        log_frame = Tkinter.LabelFrame(main_frame, text="Log")
-        log_frame.pack(fill=Tkinter.BOTH, expand=True)
-        # Note: using really small width since we'll auto-expand.
-        self.log_window = Tkinter.Text(log_frame, width=1, height=10, state=Tkinter.DISABLED)
-        self.log_window.pack(side=Tkinter.LEFT, fill=Tkinter.BOTH, expand=True)
-        scroll = Tkinter.Scrollbar(log_frame)
-        scroll.pack(side=Tkinter.RIGHT, fill=Tkinter.Y)
-        self.log_window.configure(yscrollcommand=scroll.set)
-        scroll.configure(command=self.log_window.yview)
+            run_frame, text="Run", command=self.on_run, width=10)
+        self.run_btn.pack(side=Tkinter.LEFT)
+        self.cancel_btn = Tkinter.Button(
+            run_frame, text="Cancel", command=self.on_cancel, width=10,
+            state=Tkinter.DISABLED)
+        self.cancel_btn.pack(side=Tkinter.LEFT)
+
+        self.progress_bar = ttk.Progressbar(
+            control_frame, orient=Tkinter.HORIZONTAL, mode="determinate",
+            maximum=1000)
+        self.progress_bar.pack(fill=Tkinter.X)
+        self.status = Tkinter.StringVar()
+        Tkinter.Label(control_frame, textvariable=self.status) \
+            .pack(anchor=Tkinter.W)
+        self.cancel = None
+
+        # Scrollable text area for log output.  Only the most recent
+        # lines are kept; the full log can be saved to a file.
+        self.log_view = LogView(main_frame, text="Log")
+        self.log_view.pack(fill=Tkinter.BOTH, expand=True)
 
         self.toggle_control_set = (
             self.target_dir,
@@ -162,16 +182,19 @@ class MainWindow(object):
             self.move_down_btn,
             self.delete_btn,
             self.skip_ogg_chk,
+            self.save_log_chk,
             self.run_btn,
             )
 
     def disable(self):
         for control in self.toggle_control_set:
             control.configure(state=Tkinter.DISABLED)
+        self.cancel_btn.configure(state=Tkinter.NORMAL)
 
     def enable(self):
         for control in self.toggle_control_set:
             control.configure(state=Tkinter.NORMAL)
+        self.cancel_btn.configure(state=Tkinter.DISABLED)
 
     def mainloop(self):
         self.root.mainloop()
@@ -240,45 +263,82 @@ class MainWindow(object):
                        for ip in input_paths]
         no_length_patch = bool(self.skip_ogg_patch.get())
 
+        if self.save_log.get():
+            log_file = os.path.join(target_dir, LOG_FILE_NAME)
+            try:
+                self.log_view.open_spill_file(log_file)
+            except IOError:
+                tkMessageBox.showinfo(
+                    title="Could not open log file",
+                    message=u"Could not write the log file: {0}".format(log_file))
+                return
+
         # Disable GUI
         self.disable()
 
         logger = ThreadQueueLogger()
+        progress = Progress()
+        self.cancel = CancelToken()
 
         # To avoid locking the GUI, run execution in another thread.
         thread = threading.Thread(
             target=r21buddy.run,
             args=(target_dir, input_paths),
             kwargs={"length_patch": (not no_length_patch), "verbose": True,
-                    "ext_logger": logger})
+                    "ext_logger": logger, "progress": progress,
+                    "cancel": self.cancel})
         thread.start()
 
         # Initiate a polling function which will update until the
         # thread finishes.
-        self._on_run(thread, logger)
-
-    def _on_run(self, thread, logger):
-        def append_log(msg):
-            self.log_window.configure(state=Tkinter.NORMAL)
-            self.log_window.insert(Tkinter.END, msg)
-            self.log_window.see(Tkinter.END)
-            self.log_window.configure(state=Tkinter.DISABLED)
-
-        msg = logger.read()
-        if len(msg) > 0:
-            append_log(msg)
+        self._on_run(thread, logger, progress)
+
+    def on_cancel(self):
+        if self.cancel is not None:
+            self.cancel.cancel()
+            self.cancel_btn.configure(state=Tkinter.DISABLED)
+            self.status.set("Cancelling...")
+
+    def update_progress(self, progress):
+        snap = progress.snapshot()
+        if snap.provisional:
+            # The total is still growing, so a fraction of it would
+            # only jump back; just show that work is going on.
+            if str(self.progress_bar.cget("mode")) != "indeterminate":
+                self.progress_bar.configure(mode="indeterminate", value=0)
+            self.progress_bar.step(10)
+        else:
+            self.progress_bar.configure(mode="determinate",
+                                        value=int(snap.fraction * 1000))
+        text = "{0}/{1}{5} files, {2:.1f}/{3:.1f}{5} MB, {4:.1f} MB/s".format(
+            snap.done_files, snap.total_files,
+            snap.done_bytes / (1024.0 * 1024),
+            snap.total_bytes / (1024.0 * 1024),
+            snap.rate / (1024.0 * 1024),
+            "+" if snap.provisional else "")
+        if snap.provisional:
+            text += ", still finding songs"
+        if snap.eta is not None and snap.done_bytes < snap.total_bytes:
+            text += ", ETA {0}".format(oggpatch.pprint_time(snap.eta))
+        if self.cancel is not None and self.cancel.cancelled:
+            text += " (cancelling)"
+        self.status.set(text)
+
+    def _on_run(self, thread, logger, progress):
+        # Everything logged since the last poll goes in as one insert.
+        self.log_view.append(logger.read())
+        self.update_progress(progress)
         if thread.is_alive():
-            self.after(POLL_INTERVAL, self._on_run, thread, logger)
+            self.after(POLL_INTERVAL, self._on_run, thread, logger, progress)
         else:
-            msg = logger.read()
-            if len(msg) > 0:
-                append_log(msg)
-            append_log("Operation complete.\n\n")
+            self.log_view.append(logger.read())
+            self.log_view.append(u"Operation complete.\n\n")
+            self.log_view.flush()
+            self.log_view.close_spill_file()
+            self.cancel = None
+            self.update_progress(progress)
             self.enable()
 
-    def log(self, msg, *tags):
-        self.log_window.insert(Tkinter.INSERT, msg, *tags)
-
 def main():
     root = MainWindow()
     root.mainloop()
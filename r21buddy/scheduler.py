@@ -0,0 +1,104 @@
+"""Write ordering for slow removable targets.
+
+Copying song by song, in directory listing order, alternates small
+chart writes with multi-megabyte audio writes, and creates a directory
+in between.  On cheap flash that's close to the worst case: every
+directory and small file means FAT and directory entry updates in the
+middle of what could have been long sequential writes.
+
+The WriteScheduler instead hands out songs in batches.  For a batch,
+all song directories are created first, then all small files (charts,
+banners, lyrics...) are written back to back, and then the large files
+one after another.  Batches are sized from the measured write
+throughput so that each takes about BATCH_SECONDS: long enough to keep
+writes sequential, short enough that an interrupted run doesn't lose
+much (songs are only recorded as copied once their batch is done).
+
+"""
+
+from __future__ import absolute_import
+
+import os
+
+
+SMALL_FILE_SIZE = 256 * 1024
+BATCH_SECONDS = 20.0
+INITIAL_BATCH_BYTES = 64 * 1024 * 1024
+MIN_BATCH_BYTES = 8 * 1024 * 1024
+MAX_BATCH_BYTES = 512 * 1024 * 1024
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0  # Reported when the copy fails
+
+
+class WriteScheduler(object):
+
+    def __init__(self, batch_seconds=BATCH_SECONDS,
+                 small_file_size=SMALL_FILE_SIZE):
+        self.batch_seconds = batch_seconds
+        self.small_file_size = small_file_size
+        self.batch_bytes = INITIAL_BATCH_BYTES
+        self.rate = None        # Bytes per second, smoothed
+        self.written = 0
+        self.elapsed = 0.0
+        self._sizes = {}        # File sizes of the batches handed out
+
+    def batches(self, songs):
+        """Splits songs (anything with a .files list) into batches of
+        about batch_bytes each, in their original order.  Batches are
+        formed as they are consumed, so they follow the latest
+        throughput measurements."""
+        batch = []
+        size = 0
+        for song in songs:
+            batch.append(song)
+            for f in song.files:
+                self._sizes[f] = _size(f)
+                size += self._sizes[f]
+            if size >= self.batch_bytes:
+                yield batch
+                batch = []
+                size = 0
+        if len(batch) > 0:
+            yield batch
+
+    def order(self, songs):
+        """Returns the (song, file) pairs of a batch in the order they
+        should be written: small files first, then large ones."""
+        small = []
+        large = []
+        for song in songs:
+            for f in song.files:
+                size = self._sizes.pop(f, None)
+                if size is None:
+                    size = _size(f)
+                if size < self.small_file_size:
+                    small.append((song, f))
+                else:
+                    large.append((song, f))
+        return small + large
+
+    def record(self, size, elapsed):
+        """Feeds the time taken to write size bytes back into the batch
+        size."""
+        self.written += size
+        self.elapsed += elapsed
+        if size < self.small_file_size or elapsed <= 0:
+            return  # Too small to say much about throughput
+        rate = size / elapsed
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate = 0.7 * self.rate + 0.3 * rate
+        self.batch_bytes = int(max(MIN_BATCH_BYTES, min(
+            MAX_BATCH_BYTES, self.rate * self.batch_seconds)))
+
+    def __str__(self):
+        mb = 1024.0 * 1024
+        return u"wrote {0:.1f} MB at {1:.1f} MB/s; batches of {2:.0f} MB".format(
+            self.written / mb, self.written / mb / max(self.elapsed, 1e-6),
+            self.batch_bytes / mb)
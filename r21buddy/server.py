@@ -0,0 +1,388 @@
+"""Long-lived local r21buddy server, plus a client for it.
+
+Tools which call r21buddy many times pay for interpreter startup and
+imports on every call.  "r21buddy serve" instead keeps one process
+warm (modules imported, CRC tables built, a pool of patching threads
+running) and takes requests over a Unix domain socket.
+
+Each request is a line of JSON with a "command" key:
+
+  {"command": "check", "paths": [...]}   Check lengths of .ogg files
+  {"command": "patch", "paths": [...]}   Patch .ogg files in place
+  {"command": "audit", "paths": [...]}   Check every .ogg under dirs
+  {"command": "sync", "target_dir": ..., "input_paths": [...], ...}
+      Same as the r21buddy script; other keys are passed on to
+      r21buddy.run (length_patch, dedup, jobs, verbose, ...)
+
+The server answers with a stream of JSON lines ("events"), each with
+an "event" key: "result" (one per file, for check/patch/audit),
+"progress" and "log" (sync), "error" (bad request) and finally "done",
+whose "status" is the exit status the command line tool would give.
+Several requests may be sent over one connection, one after another.
+Relative paths are taken from the server's working directory, so
+clients should normally send absolute paths.
+
+"""
+
+from __future__ import absolute_import
+
+import os, sys, json, signal, socket, threading, argparse, contextlib
+import SocketServer
+from multiprocessing.pool import ThreadPool
+from r21buddy import crc, oggpatch
+from r21buddy.budget import MemoryBudget, DEFAULT_LIMIT
+from r21buddy.progress import Progress, ProgressEvent, CancelToken
+from r21buddy.logger import logger
+
+
+DEFAULT_SOCKET = os.path.expanduser(u"~/.r21buddy.sock")
+DEFAULT_JOBS = 4
+
+COMMANDS = ("check", "patch", "audit", "sync")
+
+# r21buddy.run options which may be given in a sync request.
+SYNC_OPTIONS = ("length_patch", "verbose", "dedup", "resume", "block_size",
+                "jobs", "memory_budget", "walkers", "validate", "isolated",
+                "timeout", "memory_limit")
+
+
+class RequestError(Exception):
+    pass
+
+
+def result_to_dict(result):
+    return {
+        "path": result.path,
+        "ok": result.ok,
+        "length": result.length,
+        "needs_patch": result.needs_patch,
+        "patched": result.patched,
+        "method": result.method,
+        "skipped": result.skipped,
+        "error": None if result.ok else unicode(result.error),
+        }
+
+
+class EventLogger(object):
+
+    """Logger sending each message to the client as a "log" event."""
+
+    def __init__(self, emit):
+        self.emit = emit
+
+    def info(self, msg):
+        self.emit({"event": "log", "level": "info", "message": msg})
+
+    def error(self, msg):
+        self.emit({"event": "log", "level": "error", "message": msg})
+
+
+class RequestLock(object):
+
+    """Lets any number of file requests run at once, or else one sync.
+
+    A sync routes the r21buddy and oggpatch module loggers to its own
+    client, so nothing else may log while it runs.  Waiting syncs are
+    let in before new file requests, so they can't be starved.
+
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.shared = 0        # File requests running
+        self.exclusive = False  # A sync is running
+        self.waiting = 0       # Syncs waiting
+
+    @contextlib.contextmanager
+    def for_files(self):
+        with self.cond:
+            while self.exclusive or self.waiting > 0:
+                self.cond.wait()
+            self.shared += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.shared -= 1
+                self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def for_sync(self):
+        with self.cond:
+            self.waiting += 1
+            while self.exclusive or self.shared > 0:
+                self.cond.wait()
+            self.waiting -= 1
+            self.exclusive = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.exclusive = False
+                self.cond.notify_all()
+
+
+class Handler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.cancel = CancelToken()
+        self.write_lock = threading.Lock()
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass  # The client has gone already
+
+    def emit(self, event):
+        # Sync writes from several threads; a vanished client cancels
+        # whatever it asked for.
+        with self.write_lock:
+            if self.cancel.cancelled:
+                return
+            try:
+                self.wfile.write(json.dumps(event) + "\n")
+                self.wfile.flush()
+            except socket.error:
+                self.cancel.cancel()
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or \
+                        request.get("command") not in COMMANDS:
+                    raise RequestError(u"Unknown command; use one of: {0}".format(
+                        u", ".join(COMMANDS)))
+                status = getattr(self.server, "do_" + request["command"])(
+                    request, self.emit, self.cancel)
+            except Exception as e:
+                # Bad JSON or arguments; reported, and the server lives on.
+                self.emit({"event": "error", "message": unicode(e)})
+                status = 1
+            self.emit({"event": "done", "status": status})
+            if self.cancel.cancelled:
+                break
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    """Serves requests on socket_path until shutdown() is called.
+
+    Check, patch and audit requests share a pool of jobs threads, each
+    with its own oggpatch.Patcher, and a memory budget between them.
+    Sync requests run one at a time, and not alongside any other
+    request, since r21buddy.run logs through module globals (see
+    RequestLock).
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, jobs=DEFAULT_JOBS,
+                 memory_budget=DEFAULT_LIMIT):
+        if os.path.exists(socket_path):
+            _remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, Handler)
+        os.chmod(socket_path, 0600)
+        self.socket_path = socket_path
+        self.budget = MemoryBudget(memory_budget)
+        self.pool = ThreadPool(jobs)
+        self.local = threading.local()
+        self.request_lock = RequestLock()
+        # Import and build everything now, rather than on the first
+        # request.
+        from r21buddy import r21buddy
+        self.r21buddy = r21buddy
+        crc.fast("")
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _patcher(self):
+        patcher = getattr(self.local, "patcher", None)
+        if patcher is None:
+            patcher = self.local.patcher = oggpatch.Patcher(
+                logger=logger, budget=self.budget)
+        return patcher
+
+    def _run_files(self, paths, check, emit, cancel):
+        def work(path):
+            if cancel.cancelled:
+                return None
+            if check:
+                return self._patcher().check(path)
+            return self._patcher().patch(path)
+        status = 0
+        with self.request_lock.for_files():
+            for result in self.pool.imap(work, paths):
+                if result is None:
+                    break
+                emit(dict(result_to_dict(result), event="result"))
+                if not result.ok:
+                    status = 1
+                elif check and result.needs_patch and status == 0:
+                    status = 2
+        return status
+
+    def do_check(self, request, emit, cancel):
+        return self._run_files(_paths(request), True, emit, cancel)
+
+    def do_patch(self, request, emit, cancel):
+        return self._run_files(_paths(request), False, emit, cancel)
+
+    def do_audit(self, request, emit, cancel):
+        return self._run_files(oggpatch.walk_ogg_files(_paths(request)),
+                               True, emit, cancel)
+
+    def do_sync(self, request, emit, cancel):
+        if not isinstance(request.get("target_dir"), basestring):
+            raise RequestError(u"sync needs a target_dir")
+        kwargs = dict((k, v) for k, v in request.iteritems()
+                      if k in SYNC_OPTIONS)
+        ext_logger = EventLogger(emit)
+        def on_progress(event):
+            if event.kind == ProgressEvent.BYTES:
+                return  # Far too many to send
+            snapshot = progress.snapshot()
+            emit({"event": "progress", "kind": event.kind,
+                  "path": event.path, "done_files": snapshot.done_files,
+                  "total_files": snapshot.total_files,
+                  "done_bytes": snapshot.done_bytes,
+                  "total_bytes": snapshot.total_bytes,
+                  "provisional": snapshot.provisional})
+        progress = Progress(callback=on_progress)
+        with self.request_lock.for_sync():
+            # run() puts the module loggers back when it's done.
+            return self.r21buddy.run(request["target_dir"],
+                                     request.get("input_paths", []),
+                                     ext_logger=ext_logger,
+                                     progress=progress, cancel=cancel,
+                                     **kwargs)
+
+
+def _paths(request):
+    paths = request.get("paths")
+    if not isinstance(paths, list) or \
+            not all(isinstance(p, basestring) for p in paths):
+        raise RequestError(u"paths must be a list of file names")
+    return paths
+
+
+def _remove_stale_socket(socket_path):
+    # Refuse to take over from a server which is still running.
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socket_path)
+    except socket.error:
+        os.remove(socket_path)
+    else:
+        raise IOError(u"A server is already listening on {0}".format(
+            socket_path))
+    finally:
+        s.close()
+
+
+class Reply(object):
+    def __init__(self):
+        self.status = None
+        self.results = []   # "result" events
+        self.errors = []    # Messages of "error" events
+
+
+class Client(object):
+
+    """Talks to a running server.
+
+    request() yields each event of a reply as it arrives; call() waits
+    for the whole reply and returns a Reply.  For example:
+
+      client = Client()
+      reply = client.call("check", paths=["song.ogg"])
+      print reply.status, reply.results[0]["length"]
+
+    """
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.rfile = self.sock.makefile("rb")
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def request(self, command, **args):
+        args["command"] = command
+        self.sock.sendall(json.dumps(args) + "\n")
+        while True:
+            line = self.rfile.readline()
+            if line == "":
+                raise IOError("Server closed the connection")
+            event = json.loads(line)
+            yield event
+            if event["event"] == "done":
+                return
+
+    def call(self, command, on_event=None, **args):
+        """Sends a request and waits for the reply.  on_event, if
+        given, is called with every event as it arrives."""
+        reply = Reply()
+        for event in self.request(command, **args):
+            if on_event is not None:
+                on_event(event)
+            if event["event"] == "result":
+                reply.results.append(event)
+            elif event["event"] == "error":
+                reply.errors.append(event["message"])
+            elif event["event"] == "done":
+                reply.status = event["status"]
+        return reply
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description="Serve r21buddy requests over a Unix domain socket.")
+    ap.add_argument("-s", "--socket", default=DEFAULT_SOCKET,
+                    help="Socket path.  (Default: %(default)s)")
+    ap.add_argument("-j", "--jobs", type=int, default=DEFAULT_JOBS,
+                    help="Number of files to check or patch at once.  "
+                    "(Default: %(default)s)")
+    return ap.parse_args()
+
+
+def main():
+    options = parse_args()
+    try:
+        server = Server(options.socket, jobs=options.jobs)
+    except IOError as e:
+        logger.error(u"ERROR: {0}".format(e))
+        return 1
+    logger.info(u"Listening on {0}".format(options.socket))
+    # Clean up the socket when stopped by kill, too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Minimal StepMania .sm header reader.
+
+Only the tags before the first #NOTES section are read; the note data
+itself (which makes up the bulk of most .sm files) is never touched.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+
+
+# Tags we care about.  Anything else in the header is skipped.
+HEADER_TAGS = frozenset([
+    "TITLE", "SUBTITLE", "ARTIST", "CREDIT", "MUSIC", "OFFSET",
+    "SAMPLESTART", "SAMPLELENGTH", "BANNER", "BACKGROUND",
+    ])
+
+# Cache of parsed headers: path -> (mtime, size, SmHeader)
+_header_cache = {}
+
+
+def _decode(value):
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        # Older simfiles are frequently in a Windows codepage.
+        return value.decode("latin-1")
+
+
+def _iter_tags(infile):
+    """Yields (tag, value) pairs until the first #NOTES tag is found."""
+    tag = None
+    value = []
+    for line in infile:
+        comment = line.find("//")
+        if comment >= 0:
+            line = line[:comment]
+        while len(line) > 0:
+            if tag is None:
+                start = line.find("#")
+                if start < 0:
+                    break
+                colon = line.find(":", start)
+                if colon < 0:
+                    break
+                tag = line[start+1:colon].strip().upper()
+                if tag == "NOTES":
+                    return
+                line = line[colon+1:]
+            end = line.find(";")
+            if end < 0:
+                value.append(line)
+                break
+            value.append(line[:end])
+            yield tag, "".join(value).strip()
+            tag = None
+            value = []
+            line = line[end+1:]
+
+
+class SmHeader(object):
+
+    def __init__(self, infile):
+        self.tags = {}
+        for tag, value in _iter_tags(infile):
+            if tag in HEADER_TAGS:
+                self.tags[tag] = _decode(value)
+
+    def get(self, tag, default=None):
+        return self.tags.get(tag, default)
+
+    @property
+    def title(self):
+        return self.get("TITLE")
+    @property
+    def artist(self):
+        return self.get("ARTIST")
+    @property
+    def music(self):
+        return self.get("MUSIC")
+    @property
+    def sample_start(self):
+        return float(self.get("SAMPLESTART", 0) or 0)
+    @property
+    def sample_length(self):
+        return float(self.get("SAMPLELENGTH", 0) or 0)
+
+    def __repr__(self):
+        return "<SmHeader title:{0!r} music:{1!r}>".format(
+            self.title, self.music)
+
+
+def get_header(sm_file):
+    """Returns the SmHeader for a .sm file, reusing cached results if
+    the file has not changed since it was last parsed."""
+    st = os.stat(sm_file)
+    cached = _header_cache.get(sm_file)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    with open(sm_file, "rb") as infile:
+        header = SmHeader(infile)
+    _header_cache[sm_file] = (st.st_mtime, st.st_size, header)
+    return header
+
+
+def referenced_audio(sm_files, audio_files):
+    """Returns the subset of audio_files referenced via #MUSIC by any
+    of the given .sm files.
+
+    If no .sm file references any of the given audio files, all of
+    them are returned rather than risking an empty song.
+
+    """
+    return match_audio([get_header(f).music for f in sm_files], audio_files)
+
+
+def match_audio(music_tags, audio_files):
+    """Returns the subset of audio_files named by the given #MUSIC tag
+    values, or all of them if none match.
+
+    Matching is case-insensitive since the R21 target filesystem is
+    FAT32.
+
+    """
+    by_name = dict((os.path.basename(f).lower(), f) for f in audio_files)
+    result = []
+    for music in music_tags:
+        if not music:
+            continue
+        f = by_name.get(os.path.basename(music.replace("\\", "/")).lower())
+        if f is not None and f not in result:
+            result.append(f)
+    if len(result) == 0:
+        return list(audio_files)
+    return result
@@ -0,0 +1,212 @@
+"""One-pass structural validation of Ogg Vorbis files.
+
+The patcher only cares about the final page; the cabinet is pickier.
+This checks the framing of a whole file in a single forward pass over
+its pages (using oggpatch.PageScanner, so CRCs are checked too),
+holding only a few numbers per logical stream:
+
+- the file starts with a beginning-of-stream (BOS) page, each stream
+  has exactly one BOS page and starts with a Vorbis ID header;
+- streams follow one another rather than being interleaved, and none
+  has pages after its end-of-stream (EOS) page;
+- page sequence numbers have no gaps or repeats;
+- granule positions never go backwards;
+- the continued-packet flag agrees with whether the previous page left
+  a packet unfinished, and no stream ends mid-packet;
+- every stream ends with an EOS page;
+- there's no junk or damaged data between pages.
+
+Usage: python -m r21buddy.validate <file.ogg> [<file.ogg> ...]
+
+"""
+
+from __future__ import absolute_import
+
+import sys, time, struct
+from r21buddy import oggpatch
+from r21buddy.logger import logger
+
+
+# Granule position of pages on which no packet ends.
+NO_GRANULE = 0xFFFFFFFFFFFFFFFF
+
+# Header type flags, granule position, serial and page sequence number,
+# read in one go rather than through OggPage's properties.
+_PAGE_HEADER = struct.Struct("<BQII")
+
+# Only this many problems are kept per file; the rest are just counted.
+MAX_PROBLEMS = 50
+
+
+class Problem(object):
+    def __init__(self, offset, message):
+        self.offset = offset
+        self.message = message
+
+    def __str__(self):
+        return u"offset {0}: {1}".format(self.offset, self.message)
+
+
+class _StreamState(object):
+    def __init__(self, serial):
+        self.serial = serial
+        self.page_seq = None
+        self.granule_pos = None
+        self.open_packet = False    # Last page ended mid-packet
+        self.ended = False          # EOS page seen
+
+
+class ValidationResult(object):
+    def __init__(self, path):
+        self.path = path
+        self.pages = 0
+        self.streams = 0
+        self.size = 0
+        self.elapsed = 0.0
+        self.problems = []
+        self.problem_count = 0
+
+    @property
+    def ok(self):
+        return self.problem_count == 0
+
+    def add(self, offset, message):
+        self.problem_count += 1
+        if len(self.problems) < MAX_PROBLEMS:
+            self.problems.append(Problem(offset, message))
+
+    def __str__(self):
+        if self.ok:
+            return u"{0}: ok ({1} pages, {2} stream(s))".format(
+                self.path, self.pages, self.streams)
+        return u"{0}: {1} problem(s)".format(self.path, self.problem_count)
+
+
+def validate_stream(infile, path=None):
+    """Checks the Ogg framing of infile, reading it once from its
+    current position.  Returns a ValidationResult."""
+    result = ValidationResult(path)
+    start = time.time()
+    scanner = oggpatch.PageScanner(infile)
+    streams = {}
+    current = None      # The stream whose pages we're in
+    reported_skips = 0
+    for page in scanner:
+        offset = scanner.page_offset
+        result.size = offset + len(page.raw)
+        result.pages += 1
+        # Gaps found by the scanner before this page.
+        while reported_skips < len(scanner.skipped):
+            skip_start, skip_end = scanner.skipped[reported_skips]
+            result.add(skip_start, u"{0} bytes of junk or damaged data".format(
+                skip_end - skip_start))
+            reported_skips += 1
+
+        flags, granule_pos, serial, page_seq = _PAGE_HEADER.unpack_from(page.raw, 5)
+        stream = streams.get(serial)
+        if flags & 0x02:
+            if stream is not None:
+                # Check the rest as a new stream, rather than reporting
+                # every page of it.
+                result.add(offset, u"second BOS page for stream {0}".format(serial))
+                if current is stream:
+                    current = None
+            stream = streams[serial] = _StreamState(serial)
+            result.streams += 1
+            if not oggpatch._first_packet(page).startswith("\x01vorbis"):
+                result.add(offset, u"stream {0} is not Vorbis".format(serial))
+            if flags & 0x01:
+                result.add(offset, u"BOS page continues a packet")
+        elif stream is None:
+            stream = streams[serial] = _StreamState(serial)
+            result.streams += 1
+            result.add(offset, u"stream {0} has no BOS page".format(serial))
+
+        if current is not None and current is not stream and not current.ended:
+            result.add(offset, u"stream {0} interleaved with stream {1}".format(
+                serial, current.serial))
+        current = stream
+        if stream.ended:
+            result.add(offset, u"page after the end of stream {0}".format(serial))
+
+        if stream.page_seq is not None and page_seq != stream.page_seq + 1:
+            result.add(offset, u"page sequence jumps from {0} to {1}".format(
+                stream.page_seq, page_seq))
+        stream.page_seq = page_seq
+
+        if granule_pos != NO_GRANULE:
+            if stream.granule_pos is not None and granule_pos < stream.granule_pos:
+                result.add(offset, u"granule position goes back from {0} to {1}".format(
+                    stream.granule_pos, granule_pos))
+            stream.granule_pos = granule_pos
+
+        if bool(flags & 0x01) != stream.open_packet and not flags & 0x02:
+            if stream.open_packet:
+                result.add(offset, u"unfinished packet is not continued")
+            else:
+                result.add(offset, u"page continues a packet which had ended")
+        segments = ord(page.raw[26])
+        if segments > 0:
+            stream.open_packet = ord(page.raw[26 + segments]) == 255
+        if flags & 0x04:
+            stream.ended = True
+            if stream.open_packet:
+                result.add(offset, u"stream {0} ends mid-packet".format(serial))
+
+    while reported_skips < len(scanner.skipped):
+        skip_start, skip_end = scanner.skipped[reported_skips]
+        result.add(skip_start, u"{0} bytes of junk or damaged data".format(
+            skip_end - skip_start))
+        reported_skips += 1
+    if result.pages == 0:
+        result.add(0, u"no Ogg pages found")
+    for stream in sorted(streams.itervalues(), key=lambda s: s.serial):
+        if not stream.ended:
+            result.add(result.size, u"stream {0} has no EOS page (truncated?)".format(
+                stream.serial))
+    if len(scanner.skipped) > 0:
+        result.size = max(result.size, scanner.skipped[-1][1])
+    result.elapsed = time.time() - start
+    return result
+
+
+def validate_file(path):
+    with open(path, "rb") as infile:
+        return validate_stream(infile, path)
+
+
+def main():
+    paths = sys.argv[1:]
+    if len(paths) == 0 or paths[0] in ("-h", "--help"):
+        sys.stderr.write(__doc__.split("\n\n")[-1].strip() + "\n")
+        return 1
+    status = 0
+    total_size = 0
+    start = time.time()
+    for path in oggpatch.expand_inputs(paths):
+        try:
+            result = validate_file(path)
+        except IOError as e:
+            logger.error(u"{0}: ERROR: {1}".format(path, e))
+            status = 1
+            continue
+        total_size += result.size
+        if result.ok:
+            logger.info(unicode(result))
+            continue
+        status = 1
+        logger.error(unicode(result))
+        for problem in result.problems:
+            logger.error(u"  {0}".format(problem))
+        if result.problem_count > len(result.problems):
+            logger.error(u"  ... and {0} more".format(
+                result.problem_count - len(result.problems)))
+    elapsed = time.time() - start
+    if elapsed > 0:
+        logger.info(u"Checked {0:.1f} MB at {1:.0f} MB/s".format(
+            total_size / 1e6, total_size / 1e6 / elapsed))
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
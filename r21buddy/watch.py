@@ -0,0 +1,131 @@
+"""Incremental polling of source directories for watch mode.
+
+Rather than re-walking the entire library on every pass, we remember
+the mtime of each directory we have seen.  A directory's mtime only
+changes when entries are added, removed or renamed within it, so
+unchanged directories can reuse their previous listing and cost a
+single stat() per poll.  Files overwritten in place don't change the
+directory's mtime, though, so the files of song directories (only a
+handful each) are stat()ed as well and compared by size and mtime.
+
+"""
+
+from __future__ import absolute_import
+
+import os, time
+
+
+POLL_INTERVAL = 10.0  # seconds
+SETTLE_TIME = 5.0     # seconds
+
+
+def is_song_dir(files):
+    return any((f.endswith(".sm") or f.endswith(".dwi")) for f in files)
+
+
+def file_stats(files):
+    """Returns (size, mtime) for each of files; None for any which
+    can't be stat()ed."""
+    stats = []
+    for f in files:
+        try:
+            st = os.stat(f)
+        except OSError:
+            stats.append(None)
+        else:
+            stats.append((st.st_size, st.st_mtime))
+    return stats
+
+
+class DirState(object):
+    def __init__(self, mtime, dirs, files):
+        self.mtime = mtime
+        self.dirs = dirs
+        self.files = files
+        # Only tracked for song directories.
+        self.file_stats = file_stats(files) if is_song_dir(files) else None
+
+
+class DirectoryPoller(object):
+
+    """Reports song directories which are new or have changed.
+
+    Song directories are only reported once their files have stopped
+    changing for settle_time seconds, so that packs which are still
+    being copied/extracted are not picked up half-written.
+
+    """
+
+    def __init__(self, input_paths, settle_time=SETTLE_TIME):
+        self.input_paths = list(input_paths)
+        self.settle_time = settle_time
+        self.dirs = {}     # path -> DirState
+        self.pending = set()  # song dirs waiting for their files to settle
+
+    def _scan(self, path):
+        """Returns the DirState for path, listing it only if needed.
+
+        Also returns whether the directory changed since the last poll.
+
+        """
+        mtime = os.stat(path).st_mtime
+        state = self.dirs.get(path)
+        if state is not None and state.mtime == mtime:
+            if state.file_stats is None:
+                return state, False
+            stats = file_stats(state.files)
+            if stats == state.file_stats:
+                return state, False
+            state.file_stats = stats
+            return state, True
+        all_files = [os.path.join(path, f) for f in os.listdir(path)]
+        dirs = sorted(f for f in all_files if os.path.isdir(f))
+        files = sorted(f for f in all_files if os.path.isfile(f))
+        state = DirState(mtime, dirs, files)
+        self.dirs[path] = state
+        return state, True
+
+    def _newest_mtime(self, files):
+        newest = 0
+        for f in files:
+            try:
+                newest = max(newest, os.stat(f).st_mtime)
+            except OSError:
+                # Vanished between listing and stat; try again later.
+                return None
+        return newest
+
+    def poll(self, now=None):
+        """Returns a list of (song_dir, files) tuples which are ready
+        to be copied."""
+        if now is None:
+            now = time.time()
+        seen = set()
+        stack = list(reversed(self.input_paths))
+        while len(stack) > 0:
+            path = stack.pop()
+            try:
+                state, changed = self._scan(path)
+            except OSError:
+                # Directory removed since the last poll.
+                self.dirs.pop(path, None)
+                self.pending.discard(path)
+                continue
+            seen.add(path)
+            stack.extend(reversed(state.dirs))
+            if changed and is_song_dir(state.files):
+                self.pending.add(path)
+
+        # Forget about directories which have disappeared.
+        for path in [p for p in self.dirs if p not in seen]:
+            del self.dirs[path]
+            self.pending.discard(path)
+
+        ready = []
+        for path in sorted(self.pending):
+            files = self.dirs[path].files
+            newest = self._newest_mtime(files)
+            if newest is not None and newest <= now - self.settle_time:
+                self.pending.remove(path)
+                ready.append((path, files))
+        return ready
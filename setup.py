@@ -17,9 +17,13 @@ setup(
     packages=["r21buddy"],
 
     # py2exe-specific
+    # r21buddy.exe and oggpatch.exe keep their old command lines; the
+    # command with subcommands (see r21buddy/cli.py) is r21buddy-cli.exe.
+    # The GUIs are built separately so they open without a console.
     console=[
         "r21buddy/r21buddy.py",
         "r21buddy/oggpatch.py",
+        {"script": "r21buddy/cli.py", "dest_base": "r21buddy-cli"},
         ],
     windows=[
         "r21buddy/r21buddy_gui.py",